@@ -0,0 +1,73 @@
+import re
+import time
+import pandas as pd
+import yfinance as yf
+from yfinance.exceptions import YFPricesMissingError
+
+# Stands in for the Yahoo Finance API during benchmarks. install() swaps yf.download and yf.Ticker for versions
+# that answer from a synthetic universe in the same shape yfinance returns, so et_price's batching and splitting
+# code runs unchanged. An optional per-request latency simulates the network.
+
+PERIOD_PATTERN = re.compile(r"^(\d+)(d|wk|mo|y)$")
+PERIOD_UNITS = {"d": "days", "wk": "weeks", "mo": "months", "y": "years"}
+
+
+def select_window(raw_df, period=None, start=None, end=None):
+    if start is not None:
+        raw_df = raw_df[raw_df.index >= pd.Timestamp(start)]
+    if end is not None:
+        raw_df = raw_df[raw_df.index < pd.Timestamp(end)]
+    if period is None or period == "max" or raw_df.empty:
+        return raw_df
+    last = raw_df.index[-1]
+    if period == "ytd":
+        return raw_df[raw_df.index.year == last.year]
+    match = PERIOD_PATTERN.match(period)
+    if match is None:
+        raise ValueError(f"Unsupported period {period}")
+    number, unit = int(match.group(1)), PERIOD_UNITS[match.group(2)]
+    if unit == "days":
+        return raw_df.iloc[-number:] # yfinance counts trading days for the day periods
+    return raw_df[raw_df.index > last - pd.DateOffset(**{unit: number})]
+
+
+class FakeYahoo:
+    def __init__(self, universe, latency=0.0):
+        self.universe = universe
+        self.latency = latency
+        self.requests = 0
+
+    def download(self, tickers, period=None, start=None, end=None, group_by="column", **kwargs):
+        self.requests += 1
+        time.sleep(self.latency)
+        tickers = [tickers] if isinstance(tickers, str) else list(tickers)
+        yf.shared._ERRORS = {ticker: "No data found, symbol may be delisted" for ticker in tickers if ticker not in self.universe}
+        frames = {ticker: select_window(self.universe[ticker], period, start, end) for ticker in tickers if ticker in self.universe}
+        if not frames:
+            return pd.DataFrame()
+        # one row per date of any ticker, padded with NaN where a ticker's exchange was closed
+        data = pd.concat(frames, axis=1, names=["Ticker", "Price"])
+        return data if group_by == "ticker" else data.swaplevel(axis=1)
+
+    def ticker(self, ticker):
+        fake = self
+
+        class FakeTicker:
+            def history(self, period="1mo", start=None, end=None, raise_errors=False, **kwargs):
+                fake.requests += 1
+                time.sleep(fake.latency)
+                if ticker not in fake.universe:
+                    if raise_errors:
+                        raise YFPricesMissingError(ticker, "")
+                    return pd.DataFrame()
+                return select_window(fake.universe[ticker], period, start, end)
+
+        return FakeTicker()
+
+
+def install(universe, latency=0.0):
+    """Replaces the yfinance entry points et_price uses. Returns the fake, which counts the requests made."""
+    fake = FakeYahoo(universe, latency)
+    yf.download = fake.download
+    yf.Ticker = fake.ticker
+    return fake
@@ -0,0 +1,305 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+from psycopg2.extras import execute_values
+from benchmarks import fake_yfinance
+from benchmarks.synthetic import generate_universe
+from scripts.schema import migrate
+from utils.config_loader import CONSTANTS
+from utils.db_connection import DB_DSN_ENV, close_pool, connection
+from utils.parallel_engine import compute_indicators_parallel, worker_count
+
+# Times every stage of main.py separately on a synthetic universe and writes the results as JSON, so two runs
+# (e.g. before and after a change) can be compared with --compare. Yahoo Finance is replaced by a local fake.
+#
+# The database stages need a throwaway Postgres whose price, indicator and asset tables are wiped on every run:
+#   INVESTASSIST_BENCH_DSN="host=localhost dbname=bench user=postgres" python -m benchmarks.run --tickers 10 1000 --years 1 20
+# Without INVESTASSIST_BENCH_DSN only the stages that don't need a database are run.
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = BASE_DIR / "benchmarks" / "results"
+BENCH_DSN_ENV = "INVESTASSIST_BENCH_DSN"
+STARTUP_REPEATS = 5
+
+
+def measure(results, name, trace_memory, function, *args):
+    """Runs one stage and records its wall time and peak traced memory. function returns (result, rows)."""
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result, rows = function(*args)
+    seconds = time.perf_counter() - start
+    peak_mb = None
+    if trace_memory:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    results[name] = {
+        "seconds": round(seconds, 4),
+        "rows": rows,
+        "rows_per_sec": round(rows / seconds, 1) if seconds > 0 else None,
+        "peak_mb": round(peak_mb, 2) if peak_mb is not None else None,
+    }
+    print(f"  {name:<20} {seconds:8.3f}s {rows:>10} rows" + (f" {peak_mb:8.1f} MB" if peak_mb is not None else ""))
+    return result
+
+
+def reset_database(tickers):
+    """Creates the tables in the benchmark database (migrating them to the partitioned schema) and empties them,
+    with an asset row per synthetic ticker."""
+    migrate()
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS indicator_state, latest_indicator;")
+        cur.execute("TRUNCATE price, indicator, asset RESTART IDENTITY CASCADE;")
+        execute_values(cur, "INSERT INTO asset (yahoo_ticker, name) VALUES %s", [(ticker, ticker) for ticker in tickers])
+
+
+def clear_loaded_rows():
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS indicator_state, latest_indicator;")
+        cur.execute("TRUNCATE price, indicator;")
+
+
+def run_size(n_tickers, years, seed, latency, use_db, trace_memory, tickers_path, store_dir):
+    # imported here, so the fake is installed before anything talks to yfinance
+    from scripts import l_indicators, l_price, pipeline
+    from scripts.email import analyse_indicators
+    from scripts.et_indicators import calculate_rsi, indicator_config, indicators_from_prices
+    from scripts.et_indicators import main as calculate_indicators
+    from scripts.et_price import api_call, clean
+    from scripts.etl_indicator_library import library_config
+    from utils.indicator_engine import build_panel, compute_indicators, indicator_history
+    from utils.indicator_library import PRICE_COLUMNS, compute_library, library_values
+    from utils.momentum_engine import momentum_scores, window_bars
+    from utils import price_store
+    from utils.price_store import write_prices
+
+    universe = generate_universe(n_tickers, years, seed)
+    tickers_path.write_text(json.dumps({"tickers": list(universe)}))
+    fake = fake_yfinance.install(universe, latency)
+    rsi_window, short_sma_window, long_sma_window, max_calculation_range = indicator_config()
+    momentum_vol_window = CONSTANTS.get("momentum_vol_window", 63)
+    print(f"{n_tickers} tickers x {years} years")
+
+    # every stage returns (result, rows processed)
+    def extract():
+        data_dict = api_call(tickers_path, "max")
+        return data_dict, sum(len(raw_df) for raw_df in data_dict.values())
+
+    def clean_all(data_dict):
+        prices = pd.concat([clean(ticker, raw_df, write_csv=False) for ticker, raw_df in data_dict.items()], ignore_index=True)
+        return prices, len(prices)
+
+    def load_price(prices):
+        return None, (l_price.main(prices=prices) or {}).get("staged", 0)
+
+    def store_prices(prices):
+        return None, write_prices(prices, store_dir)
+
+    def calculate(prices):
+        indicators = calculate_indicators(tickers_path, write_csv=False) if use_db else indicators_from_prices(prices)
+        return indicators, len(indicators)
+
+    def load_indicators(indicators):
+        return None, (l_indicators.main(indicators=indicators) or {}).get("staged", 0)
+
+    def screen(indicators):
+        return analyse_indicators(indicators=indicators), len(indicators)
+
+    def engine_history(history):
+        panel = build_panel(history)
+        indicators = compute_indicators(panel, rsi_window, short_sma_window, long_sma_window)
+        return None, len(indicator_history(panel, indicators))
+
+    def engine_history_parallel(history):
+        panel = build_panel(history)
+        indicators = compute_indicators_parallel(panel, rsi_window, short_sma_window, long_sma_window, workers)
+        return None, len(indicator_history(panel, indicators))
+
+    def momentum(history):
+        # a cold score of the universe, the daily run appends one bar to a cached window first
+        closes = build_panel(history)["close_price"][:, -window_bars(momentum_vol_window, 0):]
+        return None, int((~momentum_scores(closes, momentum_vol_window)["rank"].isna()).sum())
+
+    def indicator_library(prices):
+        # every indicator of constants.json over the full OHLCV history, in one pass
+        panel = build_panel(prices.assign(date=pd.to_datetime(prices["date"])), PRICE_COLUMNS)
+        return None, len(library_values(panel, compute_library(panel, library_config()[0])))
+
+    def rsi_per_ticker(history):
+        # the pandas implementation the engine replaced, still used by the stateful verification
+        return None, sum(len(calculate_rsi(close_price_df.set_index("date"), rsi_window))
+                         for _, close_price_df in history.groupby("yahoo_ticker"))
+
+    def streaming_pipeline():
+        indicators, screened = pipeline.main(tickers_path, "max", False, False)
+        return None, 0 if indicators is None else len(indicators)
+
+    stages = {}
+    data_dict = measure(stages, "extract", trace_memory, extract)
+    prices = measure(stages, "clean", trace_memory, clean_all, data_dict)
+    del data_dict
+    if CONSTANTS.get("price_store", False):
+        measure(stages, "price_store", trace_memory, store_prices, prices)
+    if use_db:
+        reset_database(list(universe))
+        measure(stages, "load_price", trace_memory, load_price, prices)
+    indicators = measure(stages, "indicators", trace_memory, calculate, prices)
+    if use_db:
+        measure(stages, "load_indicators", trace_memory, load_indicators, indicators)
+    measure(stages, "screen", trace_memory, screen, indicators)
+
+    # the kernels behind the indicator stage, over the full history
+    history = prices[["yahoo_ticker", "date", "close_price"]].assign(date=pd.to_datetime(prices["date"]))
+    measure(stages, "engine_history", trace_memory, engine_history, history)
+    # tracemalloc only sees this process, the workers' memory is not in peak_mb
+    workers = worker_count(CONSTANTS.get("indicator_workers", 1))
+    measure(stages, "engine_parallel", trace_memory, engine_history_parallel, history)
+    stages["engine_parallel"]["workers"] = workers
+    stages["engine_parallel"]["speedup"] = round(stages["engine_history"]["seconds"] / stages["engine_parallel"]["seconds"], 2)
+    print(f"  {'':<20} x{stages['engine_parallel']['speedup']:.2f} speedup with {workers} workers")
+    measure(stages, "calculate_rsi", trace_memory, rsi_per_ticker, history)
+    measure(stages, "momentum", trace_memory, momentum, history)
+    measure(stages, "indicator_library", trace_memory, indicator_library, prices)
+
+    if use_db:
+        clear_loaded_rows()
+        price_store.STORE_DIR = store_dir / "streaming" # keep the pipeline's writes out of data/price_store
+        measure(stages, "streaming_pipeline", trace_memory, streaming_pipeline)
+
+    return {"tickers": n_tickers, "years": years, "price_rows": len(prices), "yahoo_requests": fake.requests, "stages": stages}
+
+
+def startup_seconds(command):
+    """Median wall time of starting a fresh interpreter that runs command."""
+    timings = []
+    for _ in range(STARTUP_REPEATS):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *command], cwd=BASE_DIR, capture_output=True, check=True)
+        timings.append(time.perf_counter() - start)
+    return round(statistics.median(timings), 4)
+
+
+# the modules every command of main.py imports when it runs (see its run_* functions)
+COMMAND_IMPORTS = {
+    "fetch": ["scripts.et_price"],
+    "load": ["scripts.l_price"],
+    "indicators": ["scripts.et_indicators", "scripts.l_indicators"],
+    "screen": ["scripts.email", "scripts.l_screen_hits"],
+    "email": ["scripts.email"],
+    "all": ["scripts.et_price", "scripts.l_price", "scripts.et_indicators", "scripts.l_indicators", "scripts.email",
+            "scripts.l_screen_hits"],
+    "backfill": ["scripts.etl_backfill_indicators"],
+}
+
+
+def measure_startup():
+    """Startup of the CLI and of every command: main.py plus the modules the command imports, without running it."""
+    startup = {
+        "python": startup_seconds(["-c", "pass"]),
+        "main_help": startup_seconds(["main.py", "--help"]), # the CLI without any stage imported
+        "import_stages": startup_seconds(["-c", "import scripts.pipeline"]), # every stage of the daily run
+    }
+    for command, modules in COMMAND_IMPORTS.items():
+        startup[command] = startup_seconds(["-c", "; ".join(f"import {module}" for module in ["main", *modules])])
+    print("startup " + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in startup.items()))
+    return startup
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline_path, report):
+    """Prints the time of every stage relative to an earlier report, for the sizes both reports ran."""
+    baseline = json.loads(Path(baseline_path).read_text())
+    baseline_runs = {(run["tickers"], run["years"]): run for run in baseline["runs"]}
+    print(f"Compared with {baseline_path} (commit {baseline['meta'].get('commit')})")
+    for name, seconds in report["startup"].items():
+        if name in baseline.get("startup", {}):
+            print(f"  startup {name:<12} {baseline['startup'][name]:8.3f}s -> {seconds:8.3f}s")
+    for run in report["runs"]:
+        before = baseline_runs.get((run["tickers"], run["years"]))
+        if before is None:
+            continue
+        print(f"{run['tickers']} tickers x {run['years']} years")
+        for name, stage in run["stages"].items():
+            if name in before["stages"] and before["stages"][name]["seconds"]:
+                ratio = stage["seconds"] / before["stages"][name]["seconds"]
+                print(f"  {name:<20} {before['stages'][name]['seconds']:8.3f}s -> {stage['seconds']:8.3f}s  x{ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the InvestAssist pipeline stages on synthetic data.")
+    parser.add_argument("--tickers", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 5])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated latency of every Yahoo request")
+    parser.add_argument("--indicator-workers", type=int, help="processes of the parallel indicator stage "
+                        "(default: indicator_workers in constants.json, 0 = one per core)")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc, which slows down the stages")
+    parser.add_argument("--output", type=Path, help="where to write the JSON report (default: benchmarks/results/)")
+    parser.add_argument("--compare", type=Path, help="an earlier JSON report to compare the timings with")
+    args = parser.parse_args()
+
+    bench_dsn = os.environ.get(BENCH_DSN_ENV)
+    if bench_dsn:
+        os.environ[DB_DSN_ENV] = bench_dsn # the pipeline's pool connects to the throwaway database
+    else:
+        print(f"{BENCH_DSN_ENV} is not set, skipping the database stages.")
+    CONSTANTS["incremental"] = False
+    CONSTANTS["yahoo_cache"] = False # every run measures the download
+    CONSTANTS["rate_limit_yahoo_per_second"] = CONSTANTS["rate_limit_exchange_per_second"] = 1e9 # measure the pipeline, not Yahoo's limits
+    if args.indicator_workers is not None:
+        CONSTANTS["indicator_workers"] = args.indicator_workers
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "latency_ms": args.latency_ms,
+            "database": bool(bench_dsn),
+            "memory_traced": not args.no_memory,
+            "cpus": worker_count(0),
+        },
+        "startup": measure_startup(),
+        "runs": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tickers_path = Path(tmp_dir) / "tickers.json"
+        try:
+            for n_tickers in args.tickers:
+                for years in args.years:
+                    report["runs"].append(run_size(n_tickers, years, args.seed, args.latency_ms / 1000, bool(bench_dsn),
+                                                   not args.no_memory, tickers_path, Path(tmp_dir) / "price_store"))
+        finally:
+            close_pool()
+    report["meta"]["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) # KB on linux
+
+    output = args.output or RESULTS_DIR / f"bench_{datetime.now():%Y%m%d_%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"Report written to {output}")
+    if args.compare:
+        compare(args.compare, report)
+
+
+if __name__ == "__main__":
+    main()
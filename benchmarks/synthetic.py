@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+
+# Deterministic synthetic market data for the benchmarks. Every ticker gets its own random generator seeded from
+# (seed, ticker number), so the first 10 tickers of a 10,000 ticker universe are the same as a 10 ticker universe.
+# Tickers are spread over exchanges that close on different holidays, like the real universe in tickers.json.
+
+END_DATE = pd.Timestamp("2024-12-31") # fixed, so a run doesn't depend on the day it is started
+
+# exchange suffix -> fixed (month, day) holidays. On top of these each exchange closes on a few seeded random days
+# per year, standing in for moving holidays like Easter
+EXCHANGES = {
+    "": [(1, 1), (6, 19), (7, 4), (12, 25)],          # US
+    ".MI": [(1, 1), (8, 15), (12, 24), (12, 25), (12, 26), (12, 31)],
+    ".DE": [(1, 1), (5, 1), (12, 24), (12, 25), (12, 26), (12, 31)],
+    ".L": [(1, 1), (12, 25), (12, 26)],
+    ".AS": [(1, 1), (4, 27), (12, 25), (12, 26)],
+}
+MOVING_HOLIDAYS_PER_YEAR = 3
+
+
+def ticker_names(n_tickers):
+    suffixes = list(EXCHANGES)
+    return [f"SYN{i:05d}{suffixes[i % len(suffixes)]}" for i in range(n_tickers)]
+
+
+def exchange_of(ticker):
+    return ticker[ticker.index("."):] if "." in ticker else ""
+
+
+def trading_days(exchange, years, seed=0, end=END_DATE):
+    """Business days of the last `years` years up to end, without the exchange's holidays."""
+    days = pd.bdate_range(end - pd.DateOffset(years=years) + pd.Timedelta(days=1), end)
+    holidays = np.isin(days.month * 100 + days.day, [m * 100 + d for m, d in EXCHANGES[exchange]])
+    rng = np.random.default_rng([seed, list(EXCHANGES).index(exchange)])
+    for year in np.unique(days.year):
+        in_year = np.flatnonzero(days.year == year)
+        holidays[rng.choice(in_year, min(MOVING_HOLIDAYS_PER_YEAR, len(in_year)), replace=False)] = True
+    return days[~holidays]
+
+
+def ohlcv(ticker_number, dates, seed=0):
+    """A geometric random walk with intraday range and volume, rounded like the price table stores it."""
+    rng = np.random.default_rng([seed, ticker_number, 1])
+    n = len(dates)
+    start_price = rng.uniform(5, 500)
+    close = start_price * np.exp(np.cumsum(rng.normal(0.0002, 0.02, n)))
+    open_ = np.concatenate([[start_price], close[:-1]]) * (1 + rng.normal(0, 0.005, n))
+    high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.01, n)))
+    low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.01, n)))
+    volume = rng.lognormal(13, 1, n).astype(np.int64)
+    return pd.DataFrame({
+        "Open": open_.round(2), "High": high.round(2), "Low": low.round(2), "Close": close.round(2), "Volume": volume,
+    }, index=pd.DatetimeIndex(dates, name="Date"))
+
+
+def generate_universe(n_tickers, years, seed=0):
+    """Returns {ticker: OHLCV dataframe indexed by Date}, in the shape yfinance returns a single ticker."""
+    calendars = {exchange: trading_days(exchange, years, seed) for exchange in EXCHANGES}
+    return {ticker: ohlcv(i, calendars[exchange_of(ticker)], seed) for i, ticker in enumerate(ticker_names(n_tickers))}
+
+
+def price_rows(universe):
+    """The universe as one long dataframe with the price table's columns, as et_price.main returns it."""
+    frames = []
+    for ticker, raw_df in universe.items():
+        frames.append(pd.DataFrame({
+            "date": raw_df.index.date,
+            "close_price": raw_df["Close"].to_numpy(),
+            "open_price": raw_df["Open"].to_numpy(),
+            "high_price": raw_df["High"].to_numpy(),
+            "low_price": raw_df["Low"].to_numpy(),
+            "volume": raw_df["Volume"].to_numpy(),
+            "yahoo_ticker": ticker,
+        }))
+    return pd.concat(frames, ignore_index=True)
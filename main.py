@@ -1,20 +1,29 @@
-from scripts.et_indicators import main as calculate_indicators
-from scripts.email import main as send_email
-from scripts.l_indicators import main as load_indicators
-from scripts.et_price import main as extract_transform_price
-from scripts.l_price import main as load_price
+import argparse
+import sys
+from datetime import date
 from pathlib import Path
 from utils.config_loader import CONSTANTS
+from utils import metrics
 from utils.logging_config import logger
 
-logger.info("This script started running.")
+# Command line entry point. Every command imports the scripts it needs when it runs, so `python main.py --help` or
+# a single stage doesn't pay for importing yfinance, pandas or psycopg2 of the stages it doesn't use.
+#
+#   python main.py               same as `python main.py all`, the daily run
+#   python main.py fetch         download prices into data/staging      python main.py load     load them to db
+#   python main.py indicators    calculate and load the indicators      python main.py screen   print and load the signals
+#   python main.py email         send the email of the latest signals   python main.py backfill 2020-01-01
+#   python main.py transactions  import data/Transactions.csv            python main.py positions  portfolio value and P&L
+#   python main.py worker        ingest shards of tickers.json, run it from cron on as many hosts as needed
+#   python main.py migrate       create or upgrade the tables           python main.py maintain add the coming partitions
+#   python main.py momentum      rank the tickers by momentum           python main.py library  the indicator library
 
 # Dynamically determine the base directory (root of the project)
 BASE_DIR = Path(__file__).resolve().parent
 
 # Determine the directory or path of the following
 INDICATORS_CONFIG_PATH = BASE_DIR / "config" / "constants.json"
-INDICATORS_CSV_PATH = BASE_DIR / "data" / "indicators.csv"
+INDICATORS_CSV_PATH = BASE_DIR / "data" / "processed" / "indicators.csv" # where et_indicators writes it
 DB_CONFIG_PATH = BASE_DIR / "config" / "db_config.json"
 TICKERS_PATH = BASE_DIR / "config" / "tickers.json"
 LOG_CONFIG_PATH = BASE_DIR / "config" / "logging_config.json"
@@ -25,28 +34,324 @@ STAGING_FOLDER = BASE_DIR / "data" / "staging"
 
 PERIOD = '3mo'  # Options are '1d', '5d', '3mo', '6mo', '1y', '2y', '5y', '10y', 'ytd', 'max'
 
-def main():
-    logger.info("Starting InvestAssist")
 
-    # Step 1: make API call, transform data and save to staging directory
+def calculate_and_load_indicators(in_memory, write_csv):
+    if CONSTANTS.get("indicator_mode", "window") == "stateful":
+        from scripts.etl_indicator_state import main as update_indicator_states
+        # Step 3 + 4: apply the new bars to the stored indicator states and write the new rows to db
+        logger.info("Updating indicator states")
+        return update_indicator_states(TICKERS_PATH, verify_state=CONSTANTS.get("verify_indicator_state", False),
+                                       write_csv=write_csv)
+
+    from scripts.et_indicators import main as calculate_indicators
+    from scripts.l_indicators import main as load_indicators
+    # Step 3: connect with db and calculate indicators, then (unless running in memory) save it to data directory
+    logger.info("Calculating indicators")
+    indicators = calculate_indicators(TICKERS_PATH, write_csv=write_csv)
+
+    # Step 4: load indicators to db
+    logger.info("Loading indicators to db")
+    if not in_memory:
+        load_indicators(input_path=INDICATORS_CSV_PATH)
+    elif indicators is not None:
+        load_indicators(indicators=indicators)
+    return indicators
+
+
+def run_db_stages(in_memory, write_csv):
+    from scripts.et_price import main as extract_transform_price
+    from scripts.l_price import main as load_price
+    # Step 1: make API call, transform data and (unless running in memory) save to staging directory
     logger.info("Fetching prices from yahoo and light transform the data")
-    extract_transform_price(tickers_path=TICKERS_PATH, period=CONSTANTS["period"])
+    prices = extract_transform_price(tickers_path=TICKERS_PATH, period=CONSTANTS["period"],
+                                     incremental=CONSTANTS.get("incremental", False), write_csv=write_csv)
 
     # Step 2: Load transformed price data to db
     logger.info("Loading prices to db")
+    if in_memory:
+        load_price(prices=prices)
+    else:
+        load_price(STAGING_FOLDER)
+
+    return calculate_and_load_indicators(in_memory, write_csv)
+
+
+def run_pipeline(args):
+    from utils.db_connection import run_transaction
+    logger.info("Starting InvestAssist")
+    # in memory, every stage hands its dataframe to the next one and csv files are only kept as an archive
+    in_memory = CONSTANTS.get("in_memory_pipeline", True)
+    write_csv = not in_memory or CONSTANTS.get("archive_csv", False)
+    screened = None
+    try:
+        if CONSTANTS.get("pipeline_mode", "sequential") == "streaming" and in_memory \
+                and not CONSTANTS.get("db_single_transaction", False):
+            from scripts.pipeline import main as run_streaming_pipeline
+            # Step 1 - 5 overlap: every ticker moves on to the next stage as soon as it is downloaded
+            indicators, screened = run_streaming_pipeline(TICKERS_PATH, CONSTANTS["period"],
+                                                          CONSTANTS.get("incremental", False), write_csv)
+        elif CONSTANTS.get("db_single_transaction", False):
+            # every stage shares one connection and nothing is committed unless all of them succeed
+            with run_transaction():
+                indicators = run_db_stages(in_memory, write_csv)
+        else:
+            indicators = run_db_stages(in_memory, write_csv)
+    except Exception as e:
+        logger.error(f"Pipeline run failed: {e}")
+        raise # exit with an error, cron and monitoring see the failed run
+    finish_run(indicators, screened, in_memory)
+
+
+def finish_run(indicators, screened, in_memory):
+    """The stages after the indicators: positions, momentum scores, the indicator library, screening and the email."""
+    from scripts.email import main as send_email
+    if CONSTANTS.get("update_positions", False):
+        from scripts.etl_positions import main as update_positions
+        # add today's positions and P&L of the imported transactions
+        update_positions()
+    if CONSTANTS.get("momentum_scores", False):
+        from scripts.etl_momentum import main as score_momentum
+        # rank the universe by risk adjusted momentum over 1 to 12 months
+        score_momentum(TICKERS_PATH)
+    if CONSTANTS.get("indicator_library"):
+        from scripts.etl_indicator_library import main as update_indicator_library
+        # the indicators declared in constants.json, on top of RSI and the SMAs
+        update_indicator_library(TICKERS_PATH)
+
+    # Step 5: Analyse the indicators, apply filter, load the hits to db and send an email
+    if in_memory and indicators is None:
+        logger.error("No indicators were calculated, not sending the email.")
+        return
+    if screened is None:
+        from scripts.email import analyse_indicators, read_indicators
+        from scripts.l_screen_hits import main as load_screen_hits
+        if not in_memory:
+            indicators = read_indicators(INDICATORS_CSV_PATH)
+        screened = analyse_indicators(indicators=indicators)
+        load_screen_hits(screened, indicators)
+    if send_email(INDICATORS_CSV_PATH, EMAIL_CONFIG_PATH, indicators, screened):
+        logger.info("Email sent!")
+
+
+def ingest_shard(tickers):
+    from scripts.et_price import main as extract_transform_price
+    from scripts.l_price import main as load_price
+    prices = extract_transform_price(tickers, CONSTANTS["period"], CONSTANTS.get("incremental", False), write_csv=False)
+    if load_price(prices=prices) is None:
+        raise RuntimeError(f"Loading the prices of {len(tickers)} tickers failed")
+
+
+def run_worker(args):
+    """Ingests shards of the universe until every shard of the day is done, together with the workers on other
+    hosts (see scripts/shard_lease.py). The worker that passes the barrier last runs the indicators and the email."""
+    import time
+    from scripts import shard_lease
+    from utils.config_loader import load_tickers
+    from utils.db_connection import connection
+    run_date = date.today()
+    worker = args.worker_id or shard_lease.worker_id()
+    lease_seconds = CONSTANTS.get("shard_lease_seconds", 300)
+    max_attempts = CONSTANTS.get("shard_max_attempts", 3)
+    with connection() as conn, conn.cursor() as cur:
+        shard_lease.create_tables(cur)
+        shards = shard_lease.plan_shards(cur, run_date, load_tickers(TICKERS_PATH), CONSTANTS.get("shard_size", 25))
+    logger.info(f"Worker {worker} joined the run of {run_date}, {shards} shards")
+
+    while True:
+        with connection() as conn, conn.cursor() as cur:
+            claimed = shard_lease.claim_shard(cur, run_date, worker, lease_seconds, max_attempts)
+        if claimed is not None:
+            shard, tickers = claimed
+            logger.info(f"Worker {worker} ingesting shard {shard} ({len(tickers)} tickers)")
+            error = None
+            with metrics.timer("shard", worker=worker), \
+                    shard_lease.Heartbeat(run_date, shard, worker, lease_seconds) as heartbeat:
+                try:
+                    ingest_shard(tickers)
+                except Exception as e:
+                    logger.error(f"Shard {shard} failed: {e}")
+                    error = e
+            # the lease ran out and another worker claimed the shard, its result is the one that counts (the prices
+            # loaded here are upserted again by it)
+            if heartbeat.lost:
+                logger.warning(f"Worker {worker} lost shard {shard} while ingesting it, leaving it to its new worker")
+                continue
+            with connection() as conn, conn.cursor() as cur:
+                finished = shard_lease.finish_shard(cur, run_date, shard, worker, error, max_attempts)
+            if not finished:
+                logger.error(f"Worker {worker} no longer held the lease of shard {shard}, it wasn't marked "
+                             f"{'done' if error is None else 'failed'}")
+            continue
+
+        # barrier: nothing left to claim, wait for the shards other workers are still on
+        with connection() as conn, conn.cursor() as cur:
+            shard_lease.fail_abandoned_shards(cur, run_date, max_attempts)
+            unfinished = shard_lease.unfinished_shards(cur, run_date, max_attempts)
+            passed = unfinished == 0 and shard_lease.claim_barrier(cur, run_date, worker, lease_seconds)
+            summary = shard_lease.shard_summary(cur, run_date)
+        if unfinished == 0:
+            break
+        if args.no_wait:
+            logger.info(f"Worker {worker} done, {unfinished} shards still running elsewhere")
+            return
+        time.sleep(CONSTANTS.get("shard_poll_seconds", 10))
+
+    if not passed:
+        logger.info(f"Worker {worker} done, the final stages of {run_date} run on another worker")
+        return
+    if summary.get("failed"):
+        logger.warning(f"{summary['failed']} shards of {run_date} failed, their tickers keep their last prices")
+    logger.info(f"All {shards} shards of {run_date} loaded, worker {worker} runs the final stages")
+    indicators = calculate_and_load_indicators(in_memory=True, write_csv=CONSTANTS.get("archive_csv", False))
+    finish_run(indicators, None, in_memory=True)
+    with connection() as conn, conn.cursor() as cur:
+        shard_lease.finish_barrier(cur, run_date, worker)
+
+
+def run_fetch(args):
+    from scripts.et_price import main as extract_transform_price
+    incremental = CONSTANTS.get("incremental", False) and not args.full
+    extract_transform_price(TICKERS_PATH, args.period or CONSTANTS["period"], incremental, write_csv=True)
+
+
+def run_load(args):
+    from scripts.l_price import main as load_price
     load_price(STAGING_FOLDER)
 
-    # Step 3: connect with db and calculate indicators, then save it to data dirctory
-    logger.info("Calculating indicators")
-    calculate_indicators(TICKERS_PATH)
 
-    # Step 4: load indicators to db
-    logger.info("Loading indicators to db")
-    load_indicators(input_path=INDICATORS_CSV_PATH)
+def run_indicators(args):
+    # standalone, the stages hand over through indicators.csv
+    calculate_and_load_indicators(in_memory=True, write_csv=True)
+
+
+def run_screen(args):
+    from scripts.email import analyse_indicators, read_indicators, screening_rules
+    from scripts.l_screen_hits import main as load_screen_hits
+    indicators = read_indicators(INDICATORS_CSV_PATH)
+    hits = analyse_indicators(indicators=indicators)
+    for rule in screening_rules():
+        print(f"{rule.get('label', rule['name'])} ({rule['expression']}): "
+              f"{list(hits.loc[hits['rule'] == rule['name'], 'yahoo_ticker'])}")
+    if not args.no_load:
+        load_screen_hits(hits, indicators)
 
-    # Step 5: Analyse the indicators, apply filter and send an email
-    logger.info("Email sent!")
+
+def run_email(args):
+    from scripts.email import main as send_email
     send_email(INDICATORS_CSV_PATH, EMAIL_CONFIG_PATH)
 
+
+def run_backfill(args):
+    from scripts.etl_backfill_indicators import main as backfill
+    backfill(args.start_date, args.end_date, TICKERS_PATH)
+
+
+def run_transactions(args):
+    from scripts.tl_transactions import main as import_transactions
+    import_transactions(args.path)
+
+
+def run_positions(args):
+    from scripts.etl_positions import main as update_positions, portfolio_history
+    from utils.db_connection import cursor
+    update_positions()
+    with cursor() as cur:
+        history = portfolio_history(cur, args.start_date)
+    print(history.tail(args.days).to_string(index=False))
+
+
+def run_momentum(args):
+    from scripts.etl_momentum import main as score_momentum
+    scores = score_momentum(TICKERS_PATH, rebuild=args.rebuild)
+    if scores is not None:
+        columns = ["yahoo_ticker", "date", "return_1m", "return_3m", "return_6m", "return_12m", "volatility", "score", "rank"]
+        print(scores[columns].head(args.top).to_string(index=False))
+
+
+def run_library(args):
+    from scripts.etl_indicator_library import main as update_indicator_library
+    values = update_indicator_library(TICKERS_PATH)
+    if values is not None and not values.empty:
+        print(values.pivot(index="yahoo_ticker", columns="name", values="value").round(2).to_string())
+
+
+def run_store_seed(args):
+    from scripts.etl_price_store import main as seed_price_store
+    seed_price_store(TICKERS_PATH)
+
+
+def run_migrate(args):
+    from scripts.schema import migrate
+    migrate()
+
+
+def run_maintain(args):
+    from scripts.schema import maintain
+    maintain(args.years_ahead)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="InvestAssist: fetch prices, calculate indicators and email the signals.")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.add_parser("all", help="the daily run: fetch, load, indicators, screen and email (default)").set_defaults(run=run_pipeline)
+    fetch = commands.add_parser("fetch", help="download prices from yahoo into data/staging")
+    fetch.add_argument("--period", help="yahoo period, e.g. 5d or max (default: period in constants.json)")
+    fetch.add_argument("--full", action="store_true", help="request the whole period for every ticker, not only the missing days")
+    fetch.set_defaults(run=run_fetch)
+    commands.add_parser("load", help="load the staging files into the price table").set_defaults(run=run_load)
+    commands.add_parser("indicators", help="calculate the indicators, load them to db and write indicators.csv").set_defaults(run=run_indicators)
+    screen = commands.add_parser("screen", help="print the buy/sell signals of the latest indicators and load them to db")
+    screen.add_argument("--no-load", action="store_true", help="only print the signals")
+    screen.set_defaults(run=run_screen)
+    commands.add_parser("email", help="email the signals of the latest indicators").set_defaults(run=run_email)
+    backfill = commands.add_parser("backfill", help="rebuild the historical indicators for a date range")
+    backfill.add_argument("start_date", type=date.fromisoformat)
+    backfill.add_argument("end_date", type=date.fromisoformat, nargs="?", default=date.today())
+    backfill.set_defaults(run=run_backfill)
+    transactions = commands.add_parser("transactions", help="import a Degiro transaction export")
+    transactions.add_argument("path", type=Path, nargs="?", default=BASE_DIR / "data" / "Transactions.csv")
+    transactions.set_defaults(run=run_transactions)
+    positions = commands.add_parser("positions", help="update the daily positions and print the portfolio value and P&L")
+    positions.add_argument("--days", type=int, default=10, help="number of days to print")
+    positions.add_argument("--start-date", type=date.fromisoformat)
+    positions.set_defaults(run=run_positions)
+    worker = commands.add_parser("worker", help="ingest shards of the tickers together with other workers, the last "
+                                                "one runs the indicators and the email")
+    worker.add_argument("--worker-id", help="name in the shard_lease table (default: host:pid)")
+    worker.add_argument("--no-wait", action="store_true", help="exit once there is no shard left to claim, instead of "
+                                                               "waiting for the other workers' shards")
+    worker.set_defaults(run=run_worker)
+    momentum = commands.add_parser("momentum", help="score and rank the tickers by momentum, load the scores to db")
+    momentum.add_argument("--top", type=int, default=20, help="number of tickers to print, best first")
+    momentum.add_argument("--rebuild", action="store_true", help="read the whole close window of every ticker again "
+                                                                 "instead of the cached one")
+    momentum.set_defaults(run=run_momentum)
+    commands.add_parser("library", help="calculate the indicators of indicator_library in constants.json and load "
+                                        "them to db").set_defaults(run=run_library)
+    commands.add_parser("store-seed", help="copy the price history in db to the local price store").set_defaults(run=run_store_seed)
+    commands.add_parser("migrate", help="create the tables, or apply the pending migrations to them").set_defaults(run=run_migrate)
+    maintain = commands.add_parser("maintain", help="create the partitions of the coming years and analyze the "
+                                                    "partitioned tables")
+    maintain.add_argument("--years-ahead", type=int, help="default: partition_years_ahead in constants.json")
+    maintain.set_defaults(run=run_maintain)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    command = args.command or "all"
+    run = getattr(args, "run", run_pipeline)
+    logger.info(f"Running command {command}")
+    try:
+        run(args)
+    finally:
+        # only commands that talked to the database have imported it
+        if "utils.db_connection" in sys.modules:
+            from utils.db_connection import close_pool, log_pool_stats
+            log_pool_stats()
+            close_pool()
+        metrics.write_run_report(command)
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -5,12 +5,13 @@ from datetime import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import pandas as pd
+from scripts.loader import ensure_latest_table, read_latest
+from utils import metrics
+from utils.db_connection import cursor
+from utils.config_loader import CONSTANTS, load_tickers
+from utils.screening import screen
 from utils.logging_config import logger
 
-logger.info("This script started running.")
-
-#TODO instead of reading input from local file, read input from DB when DB is accessible
-
 # Dynamically determine the base directory (root of the project)
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -33,50 +34,56 @@ def load_config_as_dict(config_dir):
     with config_dir.open("r") as f:
         return json.load(f)
 
-def analyse_indicators(indicator_csv):
+def screening_rules():
+    return CONSTANTS.get("screening_rules", [])
+
+
+def read_indicators(indicator_csv=None, tickers_path=TICKERS_PATH):
+    """ The latest indicators of the tickers in tickers.json, one row per ticker. They come from the latest_indicator
+    table, which the indicator loads keep up to date, and from indicator_csv when the db can't be reached."""
+    try:
+        with cursor() as cur:
+            ensure_latest_table(cur, "indicator")
+            indicators = read_latest(cur, "indicator", load_tickers(tickers_path))
+        logger.info(f"Read the latest indicators of {len(indicators)} tickers from db")
+        return indicators
+    except Exception as e:
+        if indicator_csv is None:
+            raise
+        logger.warning(f"Failed to read the latest indicators from db, reading {indicator_csv}: {e}")
     # save indicators.csv as dataframe and enforce the data type
     df = pd.read_csv(indicator_csv)
     df["rsi"] = df["rsi"].astype(float)
     df["sma_5"] = df["sma_5"].astype(float)
     df["sma_10"] = df["sma_10"].astype(float)
+    return df
 
-    # Filter RSI-based buy/sell signals
-    overbought = df[df["rsi"] > 70]  # RSI above 70 → Overbought (Sell)
-    oversold = df[df["rsi"] < 30]  # RSI below 30 → Oversold (Buy)
-    undervalued = df[(df["rsi"] >= 30) & (df["rsi"] < 40)]  # RSI 30-40 → Undervalued
-
-    # Detect general trends using SMA comparison
-    bullish_trend = df[df["sma_5"] > df["sma_10"]]  # SMA_5 > SMA_10 → Bullish
-    bearish_trend = df[df["sma_5"] < df["sma_10"]]  # SMA_5 < SMA_10 → Bearish
 
-    # Convert to lists (for easier email formatting)
-    overbought_list = overbought[["yahoo_ticker", "rsi"]].values.tolist()
-    oversold_list = oversold[["yahoo_ticker", "rsi"]].values.tolist()
-    undervalued_list = undervalued[["yahoo_ticker", "rsi"]].values.tolist()
-    bullish_list = bullish_trend["yahoo_ticker"].tolist()
-    bearish_list = bearish_trend["yahoo_ticker"].tolist()
-    return overbought_list, oversold_list, undervalued_list, bullish_list, bearish_list
+@metrics.timed("stage", stage="screen")
+def analyse_indicators(indicator_csv=None, indicators=None):
+    """ Runs the screening rules in constants.json over the indicators and returns the hit table,
+    one row (date, yahoo_ticker, rule, value) per ticker and matching rule."""
+    # already typed when handed over in memory by the indicator stage
+    df = indicators if indicators is not None else read_indicators(indicator_csv)
+    return screen(df, screening_rules(), CONSTANTS.get("screening_parameters", {}), CONSTANTS.get("screening_overrides", {}))
 
-def email_content(overbought_list, oversold_list, undervalued_list, bullish_list, bearish_list):
+def email_content(hits):
     today_date = datetime.now().strftime("%B %d, %Y")
     subject = f"Assets to watch for {today_date}"
 
-    def format_list(lst, value_label="RSI"):
-        return "\n".join([f"- {ticker}: {value_label} {value:.1f}" for ticker, value in lst]) if lst else "None"
+    def format_hits(rule):
+        rule_hits = hits[hits["rule"] == rule["name"]]
+        if rule_hits.empty:
+            return "None"
+        if rule.get("show"): # e.g. "- NVDA: RSI 25.3"
+            return "\n".join(f"- {ticker}: {rule['show'].upper()} {value:.1f}"
+                             for ticker, value in zip(rule_hits["yahoo_ticker"], rule_hits["value"]))
+        return ", ".join(rule_hits["yahoo_ticker"])
 
+    sections = "\n\n    ".join(f"**{rule.get('label', rule['name'])}**:\n    {format_hits(rule)}" for rule in screening_rules())
     body = f"""**These assets meet the conditions for buy or sell for today({today_date})**
     
-    **Potential Buy RSI < 30 (oversold) **:
-    {format_list(oversold_list, "RSI")}  
-
-    **Potential Sell RSI > 70 (Overbought)**:
-    {format_list(overbought_list, "RSI")} 
-
-    **Bullish Trend (SMA_5 > SMA_10)**:
-    {', '.join(bullish_list) if bullish_list else 'None'}
-
-    **Bearish Trend (SMA_5 < SMA_10)**:
-    {', '.join(bearish_list) if bearish_list else 'None'}
+    {sections}
     """
     return subject, body
 
@@ -109,16 +116,21 @@ def send_email(subject, body, email_config_path):
 
         print("Email sent successfully!")
         logger.info("Email sent successfully!")
+        return True
 
     except Exception as e:
         print(f"Failed to send email: {e}")
         logger.error(f"Failed to send email: {e}")
+        return False
 
 
-def main(indicator_csv, email_config_path):
-    overbought_list, oversold_list, undervalued_list, bullish_list, bearish_list = analyse_indicators(indicator_csv)
-    subject, body = email_content(overbought_list, oversold_list, undervalued_list, bullish_list, bearish_list)
-    send_email(subject, body, email_config_path)
+@metrics.timed("stage", stage="email")
+def main(indicator_csv, email_config_path, indicators=None, screened=None):
+    # screened: the hit table of analyse_indicators, when it was already built while the pipeline was running
+    hits = screened if screened is not None else analyse_indicators(indicator_csv, indicators)
+    subject, body = email_content(hits)
+    return send_email(subject, body, email_config_path)
 
 if __name__ == "__main__":
-    main(INPUT_PATH, EMAIL_CONFIG_PATH)
\ No newline at end of file
+    main(INPUT_PATH, EMAIL_CONFIG_PATH)
+    metrics.write_run_report("email")
\ No newline at end of file
@@ -1,13 +1,13 @@
 import pandas as pd
-from datetime import timedelta
 from pathlib import Path
-import json
-from utils.db_connection import connect_db
-from utils.config_loader import CONSTANTS
-import time
+from utils.db_connection import connection, fetch_columns, in_run_transaction
+from utils.config_loader import CONSTANTS, load_tickers
+from utils.indicator_engine import build_panel, latest_indicators
+from utils.parallel_engine import compute_indicators_parallel
+from utils import metrics
 from utils.logging_config import logger
-
-logger.info("This script started running.")
+from utils.price_store import read_recent_prices
+from utils.rate_limiter import backoff_delay
 
 # Dynamically determine the base directory (root of the project)
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -21,6 +21,7 @@ LOG_CONFIG_PATH = BASE_DIR / "config" / "logging_config.json"
 LOG_DIR = BASE_DIR / "logs"
 LOG_PATH = BASE_DIR / "logs" / "etl.log"
 
+FETCH_CHUNK_SIZE = 10000  # rows per round trip from the server side cursor
 
 
 # get the windows from constants.json
@@ -28,106 +29,163 @@ def indicator_config():
     rsi_window = CONSTANTS["rsi_window"]
     short_sma_window = CONSTANTS["short_sma_window"]
     long_sma_window =  CONSTANTS["long_sma_window"]
-    max_calculation_range = max(rsi_window, short_sma_window, long_sma_window) - 1
+    # number of most recent bars needed per asset. RSI needs one extra close to get `rsi_window` price changes
+    max_calculation_range = max(rsi_window + 1, short_sma_window, long_sma_window)
     return rsi_window, short_sma_window, long_sma_window, max_calculation_range
 
 
-def fetch_price_data(cur, tickers_path):
+def compute_panel_indicators(panel):
+    """ engine.compute_indicators, on indicator_workers processes once the panel has indicator_parallel_min_tickers
+    tickers. Below that starting the workers costs more than it saves."""
+    rsi_window, short_sma_window, long_sma_window, max_calculation_range = indicator_config()
+    workers = CONSTANTS.get("indicator_workers", 1)
+    if len(panel["tickers"]) < CONSTANTS.get("indicator_parallel_min_tickers", 500):
+        workers = 1
+    return compute_indicators_parallel(panel, rsi_window, short_sma_window, long_sma_window, workers)
+
+
+def fetch_price_data(conn, tickers_path, full_history=False):
+    """ Fetches the latest max_calculation_range closes (or every close with full_history) of every ticker in a
+    single query and returns them as one long dataframe (yahoo_ticker, date, close_price).
+    Rows are streamed through a server side cursor into columns."""
+    return fetch_close_prices(conn, load_tickers(tickers_path), full_history)
+
+
+def fetch_close_prices(conn, tickers, full_history=False):
+    """ fetch_price_data for a list of tickers"""
     max_retries = 2
-    retry_delay = 60  # 1 min delay
+    retry_delay = 60  # up to 1 min delay, see rate_limiter.backoff_delay
     rsi_window, short_sma_window, long_sma_window, max_calculation_range = indicator_config()
-    latest_date_query = '''
-    SELECT MAX(p.date) FROM price p JOIN asset a ON a.asset_id = p.asset_id WHERE a.yahoo_ticker = %s;
-    ''' # we need to specify max date per asset as assets are in different stock markets with varying public holidays
-    close_price_query =  '''
-    SELECT date, close_price FROM price WHERE asset = %s AND date BETWEEN %s AND %s;
+    # the lateral join walks the (asset_id, date) index backwards per asset, so only the rows needed are read.
+    # Every asset gets its own latest date as assets are in different stock markets with varying public holidays
+    close_price_query = '''
+    SELECT a.yahoo_ticker, p.date, p.close_price
+    FROM asset a
+    CROSS JOIN LATERAL (
+        SELECT date, close_price
+        FROM price
+        WHERE price.asset_id = a.asset_id
+        ORDER BY date DESC
+        LIMIT %s
+    ) p
+    WHERE a.yahoo_ticker = ANY(%s);
     '''
-    with tickers_path.open("r") as f:
-        ticker_dict = json.load(f)["tickers"]
-    data_dict = {}
-    for ticker in ticker_dict:
-        for attempt in range(max_retries):
-            print(f"Attempting to fetch close_prices of {ticker} for calculating indicators. (Attempt {attempt + 1}/{max_retries})")
-            logger.info(f"Attempt to fetch close_prices of {ticker} for calculating indicators (Attempt {attempt + 1}/{max_retries}")
-            try:
-                cur.execute(latest_date_query, (ticker,))
-                latest_date = cur.fetchone()[0]
-                start_date = latest_date = timedelta(days=max_calculation_range)
-                cur.execute(close_price_query, (ticker, start_date, latest_date))
-                rows = cur.fetchall()
-                if rows:
-                    df = pd.DataFrame(rows, columns=["date", "close_price"])
-
-                    # doing light transformation below before appending to data_dict
-                    df.set_index("date", inplace=True) # set date as index
-                    df.sort_index(inplace=True) # ensure date is in order
-                    df['close_price'] = df['close_price'].astype(float) # ensure that it's float
-
-                    data_dict[ticker] = df
-                else:
-                    print(f"No close_prices data found for {ticker} during the {start_date} and {latest_date}.")
-                    continue
-                break #exit retry loop on success
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    print(f"Trying to fetch price data for {ticker} attempt {attempt + 1} failed with error: {e}")
-                    logger.error(f"Trying to fetch price data for {ticker} attempt {attempt + 1} failed with error: {e}")
-                    time.sleep(retry_delay)
-                else:
-                    print(f"All attempts to fetch data for {ticker} with error: {e} Skipping.")
-                    logger.error(f"All attempts to fetch data for {ticker} failed with error: {e}. Skipping.")
-    return data_dict
-
-
-
-def calculate_rsi(data, window):
+    for attempt in range(max_retries):
+        logger.info(f"Attempt to fetch close_prices of {len(tickers)} tickers for calculating indicators (Attempt {attempt + 1}/{max_retries})")
+        try:
+            columns = fetch_columns(conn, close_price_query, (None if full_history else max_calculation_range, tickers), # LIMIT NULL = no limit
+                                    ("yahoo_ticker", "date", "close_price"), "indicator_close_prices", FETCH_CHUNK_SIZE)
+            conn.commit()
+            break #exit retry loop on success
+        except Exception as e:
+            if in_run_transaction():
+                raise # a rollback would discard the run's earlier stages, the run fails as a whole instead
+            conn.rollback()
+            if attempt < max_retries - 1:
+                logger.error(f"Trying to fetch price data attempt {attempt + 1} failed with error: {e}")
+                metrics.increment("retries", stage="indicators")
+                metrics.sleep(backoff_delay(attempt, retry_delay, retry_delay * 4), reason="db_retry")
+            else:
+                logger.error(f"All attempts to fetch price data failed with error: {e}.")
+                raise
+
+    prices = pd.DataFrame({
+        "yahoo_ticker": pd.Series(columns["yahoo_ticker"], dtype=object),
+        "date": pd.to_datetime(pd.Series(columns["date"], dtype=object)),
+        "close_price": pd.Series(columns["close_price"], dtype=float), # NUMERIC arrives as Decimal
+    })
+    metrics.increment("rows_read", len(prices), table="price")
+    missing = set(tickers) - set(prices["yahoo_ticker"])
+    for ticker in sorted(missing):
+        print(f"No close_prices data found for {ticker}. Skipping.")
+        logger.info(f"No close_prices data found for {ticker}. Skipping.")
+    return prices
+
+
+
+def calculate_rsi(data, window, method="simple"):
     delta = data['close_price'].diff()
-    gain = (delta.where(delta > 0, 0)).rolling(window=window).mean()
-    loss = (-delta.where(delta < 0, 0)).rolling(window=window).mean()
+    if method == "wilder":
+        # Wilder smoothing, seeded with the plain mean of the first `window` price changes
+        gain = wilder_smoothing(delta.clip(lower=0), window)
+        loss = wilder_smoothing((-delta).clip(lower=0), window)
+    else:
+        gain = (delta.where(delta > 0, 0)).rolling(window=window).mean()
+        loss = (-delta.where(delta < 0, 0)).rolling(window=window).mean()
     rs = gain / loss
     rsi = 100 - (100 / (1 + rs))
     return rsi
 
+def wilder_smoothing(values, window):
+    seeded = values.copy()
+    seeded.iloc[:window] = float("nan")
+    if len(values) > window:
+        seeded.iloc[window] = values.iloc[1:window + 1].mean() # the first value is NaN as it has no previous close
+    return seeded.ewm(alpha=1 / window, adjust=False).mean()
+
 # Function to calculate SMA
 def calculate_sma(data, window):
     return data['close_price'].rolling(window=window).mean()
 
 
-def main(tickers_path):
-    conn, cur = connect_db()
+def fetch_price_data_from_store(tickers_path):
+    """ Same result as fetch_price_data, read from the local price store instead of the database."""
     rsi_window, short_sma_window, long_sma_window, max_calculation_range = indicator_config()
-    if conn is None:
-        print("Can't connect to database.")
-        logger.info(f"Can't connect to database.")
-        return
-    else:
-        price_data_dict = fetch_price_data(cur, tickers_path)
-        data = pd.DataFrame(columns=['date', 'sma_5', 'sma_10', 'rsi', 'yahoo_ticker']) # setting columns that aligns with the table in db
-        for ticker, close_price_df in price_data_dict.items():
-            if not close_price_df.empty:
-                ticker = ticker
-                latest_date = close_price_df.index.max().date()
-                rsi = calculate_rsi(close_price_df, rsi_window).iloc[-1]
-                short_sma = calculate_sma(close_price_df, short_sma_window).iloc[-1]
-                long_sma = calculate_sma(close_price_df, long_sma_window).iloc[-1]
-                data = pd.concat([{
-                    "date": latest_date,
-                    "sma_5": short_sma,
-                    "sma_10": long_sma,
-                    "rsi": rsi,
-                    "yahoo_ticker": ticker
-                    }])
-            else:
-                print(f"No close_prices data found for {ticker}. Skipping.")
-                logger.info(f"No close_prices data found for {ticker}. Skipping.")
+    tickers = load_tickers(tickers_path)
+    prices = read_recent_prices(tickers, max_calculation_range)
+    for ticker in sorted(set(tickers) - set(prices["yahoo_ticker"])):
+        logger.info(f"No close_prices data found in the price store for {ticker}. Skipping.")
+    bars = prices["yahoo_ticker"].value_counts()
+    short = sorted(ticker for ticker, count in bars.items() if count < max_calculation_range)
+    if short:
+        # the store only gets the prices downloaded since price_store was turned on
+        logger.warning(f"The price store has fewer than {max_calculation_range} bars of {short}, their indicators "
+                       f"are incomplete. Run `python main.py store-seed` to copy the price history from db")
+    return prices
+
+
+def load_prices(tickers_path):
+    """ Reads the closes from the source set in constants.json ('db' or 'store'). When the database can't be
+    reached and the price store is kept up to date, the store is used instead."""
+    if CONSTANTS.get("indicator_price_source", "db") == "store":
+        return fetch_price_data_from_store(tickers_path)
+    try:
+        with connection() as conn:
+            return fetch_price_data(conn, tickers_path)
+    except Exception as e:
+        if not CONSTANTS.get("price_store", False):
+            raise
+        logger.warning(f"Can't fetch price data from database, reading the local price store instead: {e}")
+        return fetch_price_data_from_store(tickers_path)
+
+
+def indicators_from_prices(prices):
+    """ The latest indicators of every ticker in a long price dataframe, all tickers computed in one pass"""
+    if prices.empty:
+        return pd.DataFrame(columns=['date', 'sma_5', 'sma_10', 'rsi', 'yahoo_ticker']) # setting columns that aligns with the table in db
+    panel = build_panel(prices)
+    return latest_indicators(panel, compute_panel_indicators(panel))
+
+
+@metrics.timed("stage", stage="indicators")
+def main(tickers_path, write_csv=True):
+    """ Returns the latest indicators of every ticker. With write_csv they are also written to indicators.csv."""
+    try:
+        prices = load_prices(tickers_path)
+    except Exception as e:
+        print(f"Can't fetch price data from database: {e}")
+        logger.error(f"Can't fetch price data from database: {e}")
+        return None
+    data = indicators_from_prices(prices)
+    if write_csv:
+        INDICATORS_OUTPUT_PATH.parent.mkdir(parents=True, exist_ok=True)
         data.to_csv(INDICATORS_OUTPUT_PATH, index=False)
         print(f"Indicators written to {INDICATORS_OUTPUT_PATH}")
         logger.info(f"Indicators written to {INDICATORS_OUTPUT_PATH}")
-
-    cur.close()
-    conn.close()
+    return data
 
 
 if __name__ == "__main__":
     main(tickers_path=TICKERS_PATH)
+    metrics.write_run_report("indicators")
 
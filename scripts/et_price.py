@@ -1,12 +1,14 @@
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 import yfinance as yf
-import json
+from yfinance.exceptions import YFPricesMissingError
+from datetime import date, timedelta
 from pathlib import Path
-from utils.config_loader import CONSTANTS
+from utils.config_loader import CONSTANTS, load_tickers
+from utils.db_connection import cursor
+from utils import metrics, rate_limiter, response_cache
 from utils.logging_config import logger
-
-logger.info("This script started running.")
+from utils.price_store import write_prices
 
 # Dynamically determine the base directory (root of the project)
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -15,46 +17,203 @@ TICKERS_PATH = BASE_DIR / "config" / "tickers.json"
 
 STAGING_DIR = BASE_DIR / "data" / "staging"
 
-# Ensure the staging directory exists
-# RAW_PATH.mkdir(parents=True, exist_ok=True)
 
-STAGING_DIR.mkdir(parents=True, exist_ok=True)
+LOG_CONFIG_PATH = BASE_DIR / "config" / "logging_config.json"
+
 
+PRICE_COLUMNS = ["Open", "High", "Low", "Close", "Volume"]  # the order clean() expects after the date column
+NO_DATA = "no data returned"
+PRICE_TABLE_COLUMNS = ['date', 'close_price', 'open_price', 'high_price', 'low_price', 'volume', 'yahoo_ticker']
 
-LOG_CONFIG_PATH = BASE_DIR / "config" / "logging_config.json"
+
+def download_batch(tickers, window, threads):
+    """ Downloads several tickers in a single request and splits the result into one dataframe per ticker.
+    Also returns the tickers yfinance reported an error for, so only those are retried"""
+    yahoo = rate_limiter.scheduler("yahoo")
+    exchanges = [rate_limiter.exchange_of(ticker) for ticker in tickers]
+    with metrics.timer("http_request", source="yahoo", kind="batch"):
+        raw_data = yahoo.request(yf.download, tickers, exchanges=exchanges, **window, group_by="ticker",
+                                 auto_adjust=True, threads=threads, progress=False)
+    metrics.increment("tickers_requested", len(tickers), source="yahoo")
+    # yf.download doesn't raise per ticker, it collects errors in yf.shared._ERRORS. The retries running meanwhile
+    # (fetch_ticker) write their own tickers' errors to the same dict, so only the batch's tickers are taken from it
+    shared_errors = dict(getattr(yf.shared, "_ERRORS", None) or {})
+    errors = {ticker: shared_errors[ticker] for ticker in tickers if ticker in shared_errors}
+    if any(rate_limiter.is_throttled(error) for error in errors.values()):
+        yahoo.throttled(exchanges)
+    data_dict = {}
+    if raw_data is None or raw_data.empty:
+        return data_dict, errors
+    downloaded = set(raw_data.columns.get_level_values(0))
+    for ticker in tickers:
+        if ticker not in downloaded:
+            continue
+        raw_df = raw_data[ticker][PRICE_COLUMNS].dropna(how="all") # yfinance pads missing tickers with NaN rows
+        if not raw_df.empty:
+            data_dict[ticker] = raw_df.reset_index()
+    return data_dict, errors
+
+
+def fetch_ticker(ticker, window, max_retries):
+    """ Fetches a single ticker with its own retries (see rate_limiter.Scheduler.call). Only the worker running it
+    waits, the rest of the batch carries on"""
+    def history():
+        with metrics.timer("http_request", source="yahoo", kind="ticker"):
+            try:
+                # without raise_errors, history() logs a failed request and returns an empty frame, which would
+                # never be retried
+                return yf.Ticker(ticker).history(**window, raise_errors=True)
+            except YFPricesMissingError:
+                return pd.DataFrame(columns=PRICE_COLUMNS) # Yahoo answered, it has no prices for the window
+    try:
+        raw_data = rate_limiter.scheduler("yahoo").call(history, exchanges=[rate_limiter.exchange_of(ticker)],
+                                                        max_retries=max_retries)
+    except Exception as e:
+        logger.error(f"Error fetching data for {ticker}: {e}")
+        return None, str(e)
+    if raw_data.empty:
+        return None, NO_DATA
+    return raw_data[PRICE_COLUMNS].reset_index(), "retried"
+
+
+def report_extraction(status):
+    """ Logs per-ticker success or failure once the whole extraction is done"""
+    failed = {ticker: reason for ticker, (ok, reason) in status.items() if not ok}
+    for ticker, (ok, reason) in status.items():
+        if ok:
+            logger.info(f"Extracted {ticker} successfully ({reason})")
+        else:
+            logger.warning(f"Failed to extract {ticker}: {reason}")
+    logger.info(f"Extracted {len(status) - len(failed)}/{len(status)} tickers. Failed: {sorted(failed) if failed else 'None'}")
+
+
+def fetch_last_loaded_dates(cur):
+    """ Looks up the latest loaded date of every asset in a single query"""
+    query = """
+    SELECT a.yahoo_ticker, MAX(p.date)
+    FROM price p
+    JOIN asset a ON a.asset_id = p.asset_id
+    GROUP BY a.asset_id, a.yahoo_ticker;
+    """
+    cur.execute(query)
+    return dict(cur.fetchall())
+
+
+def plan_windows(tickers, period, last_dates=None):
+    """ Decides what to request per ticker. Without last_dates every ticker gets the same period.
+    With last_dates, loaded tickers only request the days after their last loaded date, tickers that were never
+    loaded get their full history and tickers that are already up to date are left out"""
+    if last_dates is None:
+        return {ticker: {"period": period} for ticker in tickers}
+    today = date.today()
+    windows = {}
+    for ticker in tickers:
+        last_date = last_dates.get(ticker)
+        if last_date is None:
+            windows[ticker] = {"period": "max"} # newly added ticker
+        elif last_date < today:
+            windows[ticker] = {"start": (last_date + timedelta(days=1)).isoformat()}
+    logger.info(f"Planned {len(windows)} of {len(tickers)} tickers, "
+                f"{sum(1 for w in windows.values() if 'period' in w)} of them need a full reload")
+    return windows
+
+
+def api_call(tickers_path, period, last_dates=None):
+    """ This function fetches data from yfinance per the period defined and returns a dict of ticker -> dataframe.
+    When last_dates ({ticker: date}) is given, only the missing date range of each ticker is requested."""
+    return dict(iter_downloads(tickers_path, period, last_dates)) # a dict that has ticker as the key and dataframe as the value
 
 
-def api_call(tickers_path, period):
-    """ This function fetches data from yfinance per the period defined and save it as csv file in the raw folder"""
-    max_retries = 2
-    retry_delay = 900  # 15 minutes in seconds
-    for attempt in range(max_retries):
-        with tickers_path.open("r") as f:
-            ticker_dict = json.load(f)["tickers"]
-
-            data_dict = {}
-            for ticker in ticker_dict:
-                print(f"Attempting to fetch data for {ticker} (Attempt {attempt + 1}/{max_retries})")
-                try:
-                    ticker_obj = yf.Ticker(ticker)
-                    raw_data = ticker_obj.history(period=period)
-                    if raw_data.empty:
-                        logger.warning(f"No data found for {ticker}, skipping...")
-                        continue
-                    raw_df = pd.DataFrame(raw_data).reset_index()
-                    data_dict[ticker] = raw_df # a dict that has ticker as the key and dataframe and the value
-                    logger.info(f"Extracted {ticker} successfully")
-
-                except Exception as e:
-                    logger.error(e)
-                    print(f"Error fetching data for {ticker} on attempt {attempt + 1}: {e}")
-                    time.sleep(retry_delay)
-
-            if data_dict:
-                return data_dict # if there is any data fetched, return
-        return {} # If all retries fail, return empty dictionary
-
-def clean(ticker, raw_df):
+def iter_downloads(tickers_path, period, last_dates=None):
+    """ Yields (ticker, raw dataframe) as soon as the ticker is downloaded, so later stages can start on it while
+    the rest is still downloading. Tickers sharing the same request window are downloaded in multi-symbol batches,
+    each using a bounded number of yfinance threads. Tickers that errored in their batch are retried one by one on
+    a worker pool while the next batches keep downloading. With yahoo_cache on, responses downloaded earlier
+    (e.g. today, by a run that failed further down) are read from the on-disk cache instead."""
+    batch_size = CONSTANTS.get("download_batch_size", 50)
+    max_workers = CONSTANTS.get("download_workers", 4)
+    max_retries = CONSTANTS.get("download_max_retries", 3)
+    use_cache = CONSTANTS.get("yahoo_cache", False)
+    ttl_eod = CONSTANTS.get("yahoo_cache_ttl_eod", 21600)
+    ttl_intraday = CONSTANTS.get("yahoo_cache_ttl_intraday", 300)
+
+    tickers = load_tickers(tickers_path)
+    windows = plan_windows(tickers, period, last_dates)
+    status = {}
+
+    def cache(ticker, raw_df):
+        if use_cache:
+            response_cache.put(ticker, windows[ticker], raw_df)
+
+    # group tickers that share a window so they can go in the same request
+    groups = {}
+    for ticker, window in windows.items():
+        cached = response_cache.get(ticker, window, ttl_eod, ttl_intraday) if use_cache else None
+        if cached is not None:
+            status[ticker] = (True, "cache")
+            metrics.increment("rows_fetched", len(cached), ticker=ticker)
+            yield ticker, cached
+            continue
+        groups.setdefault(tuple(window.items()), []).append(ticker)
+    batches = [(dict(key), group[i:i + batch_size]) for key, group in groups.items() for i in range(0, len(group), batch_size)]
+
+    def retried(futures):
+        for future in futures:
+            ticker = retry_futures.pop(future)
+            raw_df, reason = future.result()
+            if raw_df is not None:
+                status[ticker] = (True, reason)
+                metrics.increment("rows_fetched", len(raw_df), ticker=ticker)
+                cache(ticker, raw_df)
+                yield ticker, raw_df
+            elif reason == NO_DATA:
+                status[ticker] = no_data_status(windows[ticker])
+            else:
+                status[ticker] = (False, reason)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        retry_futures = {}
+        for window, batch in batches:
+            # yf.download keeps its results in module level state, so batches can't run concurrently with each other
+            try:
+                batch_data, errors = download_batch(batch, window, rate_limiter.scheduler("yahoo").concurrency.limit)
+            except Exception as e:
+                logger.error(f"Batch download of {len(batch)} tickers failed: {e}")
+                batch_data, errors = {}, {ticker: str(e) for ticker in batch}
+            for ticker in batch:
+                if ticker in batch_data:
+                    status[ticker] = (True, "batch")
+                    metrics.increment("rows_fetched", len(batch_data[ticker]), ticker=ticker)
+                    cache(ticker, batch_data[ticker])
+                    yield ticker, batch_data[ticker]
+                elif ticker in errors:
+                    retry_futures[executor.submit(fetch_ticker, ticker, window, max_retries)] = ticker
+                else:
+                    status[ticker] = no_data_status(window)
+            # hand over the retries that already finished instead of holding them until the last batch
+            yield from retried([future for future in retry_futures if future.done()])
+
+        yield from retried(as_completed(list(retry_futures)))
+
+    report_extraction(status)
+    rate_limiter.scheduler("yahoo").report()
+    if use_cache:
+        response_cache.evict(CONSTANTS.get("yahoo_cache_max_mb", 512) * 2 ** 20)
+        cache_stats = response_cache.stats()
+        logger.info(f"Yahoo cache: {cache_stats['hit']} hits, {cache_stats['miss']} misses, "
+                    f"{cache_stats['expired']} expired, hit ratio {cache_stats['hit_ratio']}")
+
+
+def no_data_status(window):
+    # an incremental request coming back empty just means nothing new was published yet
+    return (True, "no new rows") if "start" in window else (False, NO_DATA)
+
+def clean(ticker, raw_df, write_csv=True):
+    with metrics.timer("clean", ticker=ticker):
+        return clean_prices(ticker, raw_df, write_csv)
+
+
+def clean_prices(ticker, raw_df, write_csv):
     logger.info(f"Cleaning data for {ticker}")
     raw_df = raw_df.iloc[:, :6] #select only the first 6 columns
     raw_df.columns = ['date', 'open_price', 'high_price', 'low_price', 'close_price', 'volume']
@@ -63,16 +222,40 @@ def clean(ticker, raw_df):
     cleaned_df = raw_df[desired_column_order].copy() # Rearrange column order to align with db's table and explicitly create a copy
     cleaned_df['yahoo_ticker'] = ticker # add the ticker as a new column
     cleaned_df = cleaned_df.sort_values('date').dropna() #sort by date and remove NaN
+    cleaned_df['volume'] = cleaned_df['volume'].astype('int64') # multi-ticker downloads pad with NaN, which turns volume into float
+
+    if write_csv:
+        logger.info(f"Save price data for {ticker} as csv")
+        STAGING_DIR.mkdir(parents=True, exist_ok=True)
+        cleaned_df.to_csv(STAGING_DIR / f"staging_{ticker}.csv", index=False)
+    return cleaned_df
+
+
+def lookup_last_dates(period):
+    """ The last loaded date of every ticker for an incremental run, None when the db can't be reached"""
+    try:
+        with cursor() as cur:
+            return fetch_last_loaded_dates(cur)
+    except Exception as e:
+        logger.warning(f"Failed to look up last loaded dates, falling back to period {period} for every ticker: {e}")
+        return None
 
-    logger.info(f"Save price data for {ticker} as csv")
-    cleaned_df.to_csv(STAGING_DIR / f"staging_{ticker}.csv", index=False)
-    
 
-def main(tickers_path, period):
-    data_dict = api_call(tickers_path, period)
-    for ticker, raw_dataframe in data_dict.items():
-        clean(ticker, raw_dataframe)
+@metrics.timed("stage", stage="extract")
+def main(tickers_path, period, incremental=False, write_csv=True):
+    """ Returns the cleaned prices of every ticker as one dataframe. With write_csv the per ticker staging files
+    that l_price reads from are written too."""
+    last_dates = lookup_last_dates(period) if incremental else None
+    data_dict = api_call(tickers_path, period, last_dates)
+    cleaned = [clean(ticker, raw_dataframe, write_csv) for ticker, raw_dataframe in data_dict.items()]
+    if not cleaned:
+        return pd.DataFrame(columns=PRICE_TABLE_COLUMNS)
+    prices = pd.concat(cleaned, ignore_index=True)
+    if CONSTANTS.get("price_store", False):
+        write_prices(prices)
+    return prices
 
 
 if __name__ == "__main__":
-    main(TICKERS_PATH, CONSTANTS["period"])
+    main(TICKERS_PATH, CONSTANTS["period"], CONSTANTS.get("incremental", False))
+    metrics.write_run_report("extract")
@@ -0,0 +1,131 @@
+import argparse
+from datetime import date, timedelta
+from pathlib import Path
+import pandas as pd
+from utils.config_loader import CONSTANTS, load_tickers
+from utils.db_connection import connection, fetch_columns, require_own_transactions
+from utils.indicator_engine import build_panel, indicator_history
+from utils.indicator_library import PRICE_COLUMNS, compute_library, library_values
+from utils import metrics
+from utils.logging_config import logger
+from scripts.et_indicators import compute_panel_indicators, indicator_config
+from scripts.etl_indicator_library import library_config
+from scripts.loader import load_table
+
+# Rebuilds the historical RSI/SMA series of every asset for a date range, and the values of the indicator library
+# (scripts/etl_indicator_library.py) from the same prices. The range is split into date chunks that
+# are computed in one vectorized pass each, COPYed in bounded batches by the loader and committed separately, so an interrupted backfill resumes at the
+# first chunk that isn't in backfill_progress yet and memory stays bounded by the chunk size.
+
+# Dynamically determine the base directory (root of the project)
+BASE_DIR = Path(__file__).resolve().parent.parent
+TICKERS_PATH = BASE_DIR / "config" / "tickers.json"
+
+def create_tables(cur):
+    query = """
+    CREATE TABLE IF NOT EXISTS backfill_progress (
+        chunk_start DATE NOT NULL,
+        chunk_end DATE NOT NULL,
+        rows_loaded INT NOT NULL,
+        completed_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (chunk_start, chunk_end)
+        );
+    """
+    cur.execute(query)
+
+
+def date_chunks(start_date, end_date, chunk_days):
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end_date)
+        yield chunk_start, chunk_end
+        chunk_start = chunk_end + timedelta(days=1)
+
+
+def completed_chunks(cur):
+    cur.execute("SELECT chunk_start, chunk_end FROM backfill_progress;")
+    return set(cur.fetchall())
+
+
+def fetch_chunk_prices(conn, tickers, chunk_start, chunk_end, warmup_bars, price_columns=("close_price",)):
+    """Fetches the closes (or the price_columns) of the chunk plus the warmup_bars bars before it, for every ticker
+    in one query."""
+    selected = ", ".join(price_columns)
+    query = f"""
+    SELECT a.yahoo_ticker, p.date, {', '.join('p.' + column for column in price_columns)}
+    FROM asset a
+    CROSS JOIN LATERAL (
+        (SELECT date, {selected} FROM price
+         WHERE price.asset_id = a.asset_id AND price.date < %(start)s
+         ORDER BY date DESC LIMIT %(warmup)s)
+        UNION ALL
+        (SELECT date, {selected} FROM price
+         WHERE price.asset_id = a.asset_id AND price.date BETWEEN %(start)s AND %(end)s)
+    ) p
+    WHERE a.yahoo_ticker = ANY(%(tickers)s);
+    """
+    params = {"start": chunk_start, "end": chunk_end, "warmup": warmup_bars, "tickers": tickers}
+    columns = fetch_columns(conn, query, params, ("yahoo_ticker", "date") + tuple(price_columns), "backfill_close_prices")
+    prices = pd.DataFrame({
+        "yahoo_ticker": pd.Series(columns["yahoo_ticker"], dtype=object),
+        "date": pd.to_datetime(pd.Series(columns["date"], dtype=object)),
+    })
+    for column in price_columns:
+        prices[column] = pd.Series(columns[column], dtype=float) # NUMERIC arrives as Decimal
+    return prices
+
+
+@metrics.timed("backfill_chunk")
+def backfill_chunk(conn, cur, tickers, chunk_start, chunk_end):
+    rsi_window, short_sma_window, long_sma_window, max_calculation_range = indicator_config()
+    specs, library_range = library_config()
+    # the library's bars come with the same read, it only adds columns and maybe warm-up bars
+    price_columns = PRICE_COLUMNS if specs else ("close_price",)
+    prices = fetch_chunk_prices(conn, tickers, chunk_start, chunk_end, max(max_calculation_range, library_range) - 1,
+                                price_columns)
+    rows_loaded = 0
+    if not prices.empty:
+        panel = build_panel(prices, price_columns)
+        indicators = compute_panel_indicators(panel)
+        data = indicator_history(panel, indicators, chunk_start, chunk_end)
+        counts = load_table(cur, "indicator", data)
+        rows_loaded = counts["inserted"] + counts["updated"]
+        if specs:
+            values = library_values(panel, compute_library(panel, specs), chunk_start, chunk_end)
+            counts = load_table(cur, "indicator_value", values)
+            rows_loaded += counts["inserted"] + counts["updated"]
+    cur.execute("INSERT INTO backfill_progress (chunk_start, chunk_end, rows_loaded) VALUES (%s, %s, %s);",
+                (chunk_start, chunk_end, rows_loaded))
+    conn.commit() # one transaction per chunk, so a restart never sees a half loaded chunk
+    return rows_loaded
+
+
+@metrics.timed("stage", stage="backfill")
+def main(start_date, end_date, tickers_path=TICKERS_PATH):
+    chunk_days = CONSTANTS.get("backfill_chunk_days", 365)
+    try:
+        require_own_transactions("backfill")
+        with connection() as conn, conn.cursor() as cur:
+            tickers = load_tickers(tickers_path)
+            create_tables(cur)
+            conn.commit()
+            done = completed_chunks(cur)
+            for chunk_start, chunk_end in date_chunks(start_date, end_date, chunk_days):
+                if (chunk_start, chunk_end) in done:
+                    logger.info(f"Backfill chunk {chunk_start} - {chunk_end} already loaded, skipping.")
+                    continue
+                rows_loaded = backfill_chunk(conn, cur, tickers, chunk_start, chunk_end)
+                print(f"Backfilled {rows_loaded} indicator rows for {chunk_start} - {chunk_end}")
+                logger.info(f"Backfilled {rows_loaded} indicator rows for {chunk_start} - {chunk_end}")
+    except Exception as e:
+        print(f"Error in main(): {e}")
+        logger.error(f"Backfill failed, rerun to resume from the first unfinished chunk: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill historical RSI/SMA indicators.")
+    parser.add_argument("start_date", type=date.fromisoformat)
+    parser.add_argument("end_date", type=date.fromisoformat, nargs="?", default=date.today())
+    args = parser.parse_args()
+    main(args.start_date, args.end_date)
+    metrics.write_run_report("backfill")
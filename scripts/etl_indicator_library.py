@@ -0,0 +1,97 @@
+from pathlib import Path
+import pandas as pd
+from scripts.loader import load_table
+from scripts.partitions import is_partitioned
+from utils.config_loader import CONSTANTS, load_tickers
+from utils.db_connection import connection, fetch_columns
+from utils.indicator_engine import build_panel
+from utils.indicator_library import PRICE_COLUMNS, VALUE_COLUMNS, check_specs, compute_library, library_bars, library_values
+from utils import metrics
+from utils.logging_config import logger
+
+# Computes the indicators declared in indicator_library (constants.json, see utils/indicator_library.py) for the
+# latest bar of every ticker and loads them into indicator_value, one row per asset, date and indicator name.
+# The OHLCV bars are read once, as many per ticker as the indicator needing the most of them, and every indicator
+# is computed from them in one pass. The history of the library is loaded by `main.py backfill`, together with the
+# RSI/SMA history.
+
+# Dynamically determine the base directory (root of the project)
+BASE_DIR = Path(__file__).resolve().parent.parent
+TICKERS_PATH = BASE_DIR / "config" / "tickers.json"
+
+FETCH_CHUNK_SIZE = 10000  # rows per round trip from the server side cursor
+
+
+def library_config():
+    """The indicators declared in constants.json and the number of bars their latest values need."""
+    specs = check_specs(CONSTANTS.get("indicator_library", []))
+    return specs, library_bars(specs)
+
+
+def price_frame(columns):
+    """A long price dataframe from the columns fetch_columns collected. NUMERIC arrives as Decimal, NULL as None."""
+    prices = pd.DataFrame({
+        "yahoo_ticker": pd.Series(columns["yahoo_ticker"], dtype=object),
+        "date": pd.to_datetime(pd.Series(columns["date"], dtype=object)),
+    })
+    for column in PRICE_COLUMNS:
+        prices[column] = pd.Series(columns[column], dtype=float)
+    return prices
+
+
+def fetch_ohlcv(conn, tickers, n_bars):
+    """The latest n_bars OHLCV bars of every ticker, in one query (see et_indicators.fetch_close_prices)."""
+    query = f"""
+    SELECT a.yahoo_ticker, p.date, {', '.join('p.' + column for column in PRICE_COLUMNS)}
+    FROM asset a
+    CROSS JOIN LATERAL (
+        SELECT date, {', '.join(PRICE_COLUMNS)}
+        FROM price
+        WHERE price.asset_id = a.asset_id
+        ORDER BY date DESC
+        LIMIT %s
+    ) p
+    WHERE a.yahoo_ticker = ANY(%s);
+    """
+    columns = fetch_columns(conn, query, (n_bars, tickers), ("yahoo_ticker", "date") + PRICE_COLUMNS,
+                            "library_prices", FETCH_CHUNK_SIZE)
+    prices = price_frame(columns)
+    metrics.increment("rows_read", len(prices), table="price")
+    return prices
+
+
+def latest_values(prices, specs):
+    """The indicator values of every ticker's latest bar, as the long dataframe indicator_value is loaded from."""
+    if prices.empty:
+        return pd.DataFrame(columns=VALUE_COLUMNS)
+    panel = build_panel(prices, PRICE_COLUMNS)
+    return library_values(panel, compute_library(panel, specs), latest=True)
+
+
+@metrics.timed("stage", stage="indicator_library")
+def main(tickers_path=TICKERS_PATH):
+    """Computes and loads the latest values of the indicator library. Returns them, or None if the run failed or
+    indicator_value doesn't exist yet."""
+    try:
+        specs, n_bars = library_config()
+        with connection() as conn:
+            with conn.cursor() as cur:
+                if not is_partitioned(cur, "indicator_value"):
+                    print("indicator_value doesn't exist, run `python main.py migrate` first")
+                    logger.warning("Skipping the indicator library, indicator_value doesn't exist. "
+                                   "Run `python main.py migrate` first")
+                    return None
+            values = latest_values(fetch_ohlcv(conn, load_tickers(tickers_path), n_bars), specs)
+            with conn.cursor() as cur:
+                counts = load_table(cur, "indicator_value", values)
+        print(f"Loaded {len(specs)} library indicators: {counts['inserted']} values inserted, {counts['updated']} updated")
+        return values
+    except Exception as e:
+        print(f"Error in main(): {e}")
+        logger.error(f"Failed to compute the indicator library: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    main()
+    metrics.write_run_report("indicator_library")
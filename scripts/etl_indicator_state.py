@@ -0,0 +1,201 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from psycopg2.extras import execute_values
+from utils.config_loader import CONSTANTS, load_tickers
+from utils.db_connection import connection
+from utils.indicator_state import new_state, state_indicators, update_state
+from utils import metrics
+from utils.logging_config import logger
+from scripts.et_indicators import calculate_rsi, calculate_sma, fetch_price_data, indicator_config
+from scripts.loader import load_table
+
+# Stateful alternative to et_indicators + l_indicators: every asset keeps its rolling sums and RSI averages in the
+# indicator_state table, so the daily run only applies the new bars instead of recomputing from a window of closes.
+
+# Dynamically determine the base directory (root of the project)
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+# Determine the directory or path of the following
+INDICATORS_OUTPUT_PATH = BASE_DIR / "data" / "processed" / "indicators.csv"
+TICKERS_PATH = BASE_DIR / "config" / "tickers.json"
+
+
+def create_state_table(cur):
+    query = """
+    CREATE TABLE IF NOT EXISTS indicator_state (
+        asset_id INT PRIMARY KEY,
+        date DATE NOT NULL,
+        closes DOUBLE PRECISION[] NOT NULL,
+        short_sum DOUBLE PRECISION NOT NULL,
+        long_sum DOUBLE PRECISION NOT NULL,
+        avg_gain DOUBLE PRECISION,
+        avg_loss DOUBLE PRECISION,
+        n_changes INT NOT NULL,
+        rsi_method VARCHAR(10) NOT NULL
+        );
+    """
+    cur.execute(query)
+
+
+def fetch_states(cur, tickers, rsi_method):
+    """Returns {asset_id: state} for the requested tickers. States computed with another rsi_method are dropped,
+    so those assets are rebuilt from their price history."""
+    query = """
+    SELECT s.asset_id, s.date, s.closes, s.short_sum, s.long_sum, s.avg_gain, s.avg_loss, s.n_changes, s.rsi_method,
+        a.yahoo_ticker
+    FROM indicator_state s
+    JOIN asset a ON a.asset_id = s.asset_id
+    WHERE a.yahoo_ticker = ANY(%s) AND s.rsi_method = %s;
+    """
+    cur.execute(query, (tickers, rsi_method))
+    keys = ("date", "closes", "short_sum", "long_sum", "avg_gain", "avg_loss", "n_changes", "rsi_method", "yahoo_ticker")
+    return {row[0]: dict(zip(keys, row[1:])) for row in cur.fetchall()}
+
+
+def fetch_new_bars(cur, tickers, rsi_method, warmup_bars):
+    """Fetches the bars every asset hasn't seen yet, in one query. Assets without a state get their warm-up
+    history instead: the last warmup_bars closes for the simple RSI, the full history for Wilder smoothing
+    which depends on every bar since the start."""
+    query = """
+    SELECT a.asset_id, a.yahoo_ticker, p.date, p.close_price
+    FROM asset a
+    LEFT JOIN indicator_state s ON s.asset_id = a.asset_id AND s.rsi_method = %s
+    CROSS JOIN LATERAL (
+        SELECT date, close_price
+        FROM price
+        WHERE price.asset_id = a.asset_id
+        AND (s.date IS NULL OR price.date > s.date)
+        ORDER BY date DESC
+        LIMIT CASE WHEN s.date IS NULL THEN %s::BIGINT END
+    ) p
+    WHERE a.yahoo_ticker = ANY(%s)
+    ORDER BY a.asset_id, p.date;
+    """
+    cur.execute(query, (rsi_method, None if rsi_method == "wilder" else warmup_bars, tickers))
+    return cur.fetchall()
+
+
+def apply_new_bars(states, bars, rsi_method):
+    """Applies the new bars to the states (O(1) per bar) and returns the indicator rows they produce.
+    Existing states get a row per new bar, so days missed by earlier runs are filled in. New states only
+    get a row for their latest bar, like the window based calculation."""
+    rsi_window, short_sma_window, long_sma_window, max_calculation_range = indicator_config()
+    rows = []
+    new_assets = set()
+    for asset_id, ticker, bar_date, close_price in bars:
+        if asset_id not in states:
+            states[asset_id] = new_state(rsi_method)
+            states[asset_id]["yahoo_ticker"] = ticker
+            new_assets.add(asset_id)
+        values = update_state(states[asset_id], bar_date, close_price, rsi_window, short_sma_window, long_sma_window)
+        rows.append({"asset_id": asset_id, "date": bar_date, **values, "yahoo_ticker": ticker})
+    data = pd.DataFrame(rows, columns=["asset_id", "date", "sma_5", "sma_10", "rsi", "yahoo_ticker"])
+    is_new = data["asset_id"].isin(new_assets)
+    latest_of_new = data[is_new].groupby("asset_id").tail(1)
+    return pd.concat([data[~is_new], latest_of_new]).sort_values(["asset_id", "date"])
+
+
+def save(cur, states, updated_assets, data):
+    """Writes back the updated states and the new indicator rows. Both happen in the caller's transaction."""
+    state_query = """
+    INSERT INTO indicator_state (asset_id, date, closes, short_sum, long_sum, avg_gain, avg_loss, n_changes, rsi_method)
+    VALUES %s
+    ON CONFLICT (asset_id) DO UPDATE SET
+        date = EXCLUDED.date, closes = EXCLUDED.closes, short_sum = EXCLUDED.short_sum,
+        long_sum = EXCLUDED.long_sum, avg_gain = EXCLUDED.avg_gain, avg_loss = EXCLUDED.avg_loss,
+        n_changes = EXCLUDED.n_changes, rsi_method = EXCLUDED.rsi_method;
+    """
+    execute_values(cur, state_query, [
+        (asset_id, s["date"], s["closes"], s["short_sum"], s["long_sum"], s["avg_gain"], s["avg_loss"],
+         s["n_changes"], s["rsi_method"])
+        for asset_id, s in states.items() if asset_id in updated_assets
+    ])
+
+    load_table(cur, "indicator", data)
+
+
+def latest_indicators(states):
+    """Current values of every state, including assets that got no new bar today."""
+    rsi_window, short_sma_window, long_sma_window, max_calculation_range = indicator_config()
+    return pd.DataFrame(
+        [{"date": s["date"], **state_indicators(s, short_sma_window, long_sma_window), "yahoo_ticker": s["yahoo_ticker"]}
+         for s in states.values()],
+        columns=["date", "sma_5", "sma_10", "rsi", "yahoo_ticker"])
+
+
+def verify(conn, tickers_path, states, rsi_method, tolerance=1e-6):
+    """Cross-checks the latest incremental values of every ticker against a full recompute with calculate_rsi and
+    calculate_sma. Returns the mismatching rows."""
+    rsi_window, short_sma_window, long_sma_window, max_calculation_range = indicator_config()
+    prices = fetch_price_data(conn, tickers_path, full_history=(rsi_method == "wilder"))
+    latest = latest_indicators(states).set_index("yahoo_ticker")
+    mismatches = []
+    for ticker, close_price_df in prices.groupby("yahoo_ticker"):
+        if ticker not in latest.index:
+            continue
+        close_price_df = close_price_df.set_index("date").sort_index()
+        expected = {
+            "sma_5": calculate_sma(close_price_df, short_sma_window).iloc[-1],
+            "sma_10": calculate_sma(close_price_df, long_sma_window).iloc[-1],
+            "rsi": calculate_rsi(close_price_df, rsi_window, rsi_method).iloc[-1],
+        }
+        if len(close_price_df) <= rsi_window:
+            # calculate_rsi already returns a value from rsi_window closes, the state waits for rsi_window changes
+            # (see indicator_engine.rsi)
+            expected["rsi"] = np.nan
+        for column, value in expected.items():
+            actual = latest.at[ticker, column]
+            if not (np.isnan(value) and np.isnan(actual)) and not np.isclose(value, actual, rtol=tolerance, atol=tolerance):
+                mismatches.append({"yahoo_ticker": ticker, "indicator": column, "incremental": actual, "recomputed": value})
+    if mismatches:
+        logger.error(f"Indicator state verification found {len(mismatches)} mismatches: {mismatches}")
+    else:
+        logger.info(f"Indicator state verification passed for {len(latest)} tickers.")
+    return mismatches
+
+
+def update_ticker_states(conn, cur, tickers, rsi_method, max_calculation_range):
+    """Applies the new bars of the given tickers to their states and commits. Returns the states."""
+    states = fetch_states(cur, tickers, rsi_method)
+    bars = fetch_new_bars(cur, tickers, rsi_method, max_calculation_range)
+    data = apply_new_bars(states, bars, rsi_method)
+    save(cur, states, set(asset_id for asset_id, *_ in bars), data)
+    conn.commit() # deferred to the end of the run inside run_transaction() (PipelineConnection)
+    logger.info(f"Applied {len(bars)} new bars to {len(set(a for a, *_ in bars))} indicator states.")
+    return states
+
+
+def update_states(conn, cur, tickers_path, rsi_method, max_calculation_range, verify_state, write_csv):
+    create_state_table(cur)
+    states = update_ticker_states(conn, cur, load_tickers(tickers_path), rsi_method, max_calculation_range)
+
+    latest = latest_indicators(states)
+    if write_csv:
+        INDICATORS_OUTPUT_PATH.parent.mkdir(parents=True, exist_ok=True)
+        latest.to_csv(INDICATORS_OUTPUT_PATH, index=False)
+        logger.info(f"Indicators written to {INDICATORS_OUTPUT_PATH}")
+
+    if verify_state:
+        verify(conn, tickers_path, states, rsi_method)
+    return latest
+
+
+@metrics.timed("stage", stage="indicator_state")
+def main(tickers_path, verify_state=False, write_csv=True):
+    """ Returns the latest indicators of every ticker for the email stage. With write_csv they are also written
+    to indicators.csv."""
+    rsi_method = CONSTANTS.get("rsi_method", "simple")
+    rsi_window, short_sma_window, long_sma_window, max_calculation_range = indicator_config()
+    try:
+        with connection() as conn, conn.cursor() as cur:
+            return update_states(conn, cur, tickers_path, rsi_method, max_calculation_range, verify_state, write_csv)
+    except Exception as e:
+        print(f"Error in main(): {e}")
+        logger.error(f"Failed to update indicator states: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    main(TICKERS_PATH, CONSTANTS.get("verify_indicator_state", False))
+    metrics.write_run_report("indicator_state")
@@ -0,0 +1,186 @@
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scripts.loader import load_table
+from utils.config_loader import CONSTANTS, load_tickers
+from utils.db_connection import connection
+from utils.indicator_engine import build_panel
+from utils.momentum_engine import append_bars, momentum_scores, window_bars
+from utils import metrics
+from utils.logging_config import logger
+
+# Scores the universe with the cross-sectional momentum model (utils/momentum_engine.py) and loads the scores into
+# momentum_score, one row per asset and day.
+#
+# The close window the scores are computed from is cached in data/cache/momentum.npz: tickers, their last date
+# and their last window_bars closes. A run only reads the bars after each ticker's cached date (and that date
+# itself, in case the last bar was revised) and appends them, so a warm run reads one row per ticker instead of a
+# year of history. Tickers not in the cache yet read their whole window. The cache only follows the end of the
+# price history, after prices were backfilled or corrected further back run `main.py momentum --rebuild`.
+
+# Dynamically determine the base directory (root of the project)
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+# Determine the directory or path of the following
+CACHE_PATH = BASE_DIR / "data" / "cache" / "momentum.npz"
+TICKERS_PATH = BASE_DIR / "config" / "tickers.json"
+
+
+def create_table(cur):
+    query = """
+    CREATE TABLE IF NOT EXISTS momentum_score (
+        momentum_score_id SERIAL PRIMARY KEY,
+        date DATE NOT NULL,
+        return_1m DOUBLE PRECISION,
+        return_3m DOUBLE PRECISION,
+        return_6m DOUBLE PRECISION,
+        return_12m DOUBLE PRECISION,
+        volatility DOUBLE PRECISION,
+        momentum DOUBLE PRECISION,
+        score DOUBLE PRECISION,
+        rank INT,
+        asset_id INT NOT NULL REFERENCES asset(asset_id)
+        );
+    """
+    cur.execute(query)
+
+
+def momentum_config():
+    vol_window = CONSTANTS.get("momentum_vol_window", 63)
+    skip_bars = CONSTANTS.get("momentum_skip_bars", 0)
+    return vol_window, skip_bars, CONSTANTS.get("momentum_weights"), window_bars(vol_window, skip_bars)
+
+
+def empty_cache(n_bars):
+    return {
+        "tickers": np.array([], dtype=str),
+        "dates": np.array([], dtype="datetime64[D]"),
+        "closes": np.empty((0, n_bars)),
+    }
+
+
+def load_cache(n_bars, cache_path=CACHE_PATH):
+    """The cached close window, or an empty one if there's no cache or it was built for another window size."""
+    try:
+        with np.load(cache_path) as cached:
+            cache = {name: cached[name] for name in ("tickers", "dates", "closes")}
+    except FileNotFoundError:
+        return empty_cache(n_bars)
+    except Exception as e:
+        logger.warning(f"Unreadable momentum cache {cache_path}, rebuilding it: {e}")
+        return empty_cache(n_bars)
+    if cache["closes"].shape[1] != n_bars:
+        logger.info(f"Momentum cache has {cache['closes'].shape[1]} bars instead of {n_bars}, rebuilding it")
+        return empty_cache(n_bars)
+    return cache
+
+
+def save_cache(cache, cache_path=CACHE_PATH):
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # write next to the cache and swap it in, a concurrent reader never sees half a file
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **cache)
+    os.replace(tmp_path, cache_path)
+
+
+def align_cache(cache, tickers):
+    """The cache with one row per ticker, in the given order. Tickers that aren't cached get an empty row."""
+    n_bars = cache["closes"].shape[1]
+    rows = pd.Index(cache["tickers"]).get_indexer(tickers)
+    cached = rows >= 0
+    closes = np.full((len(tickers), n_bars), np.nan)
+    closes[cached] = cache["closes"][rows[cached]]
+    dates = np.full(len(tickers), np.datetime64("NaT"), dtype="datetime64[D]")
+    dates[cached] = cache["dates"][rows[cached]]
+    return {"tickers": np.array(tickers, dtype=str), "dates": dates, "closes": closes}
+
+
+def fetch_new_bars(cur, cache):
+    """The closes of every ticker from its cached date on, at most a window plus one per ticker."""
+    query = """
+    SELECT t.yahoo_ticker, p.date, p.close_price::float8
+    FROM unnest(%s::text[], %s::date[]) AS t(yahoo_ticker, cached_date)
+    JOIN asset a ON a.yahoo_ticker = t.yahoo_ticker
+    CROSS JOIN LATERAL (
+        SELECT date, close_price
+        FROM price
+        WHERE price.asset_id = a.asset_id AND (t.cached_date IS NULL OR price.date >= t.cached_date)
+        ORDER BY date DESC
+        LIMIT %s
+    ) p;
+    """
+    dates = [None if np.isnat(d) else d.item() for d in cache["dates"]]
+    cur.execute(query, (list(cache["tickers"]), dates, cache["closes"].shape[1] + 1))
+    bars = pd.DataFrame(cur.fetchall(), columns=["yahoo_ticker", "date", "close_price"])
+    metrics.increment("rows_read", len(bars), table="price")
+    return bars.assign(date=pd.to_datetime(bars["date"]))
+
+
+def apply_new_bars(cache, bars):
+    """Updates the cached close window in place with the bars from fetch_new_bars."""
+    if bars.empty:
+        return cache
+    rows = pd.Index(cache["tickers"]).get_indexer(bars["yahoo_ticker"])
+    bar_dates = bars["date"].to_numpy().astype("datetime64[D]")
+    cached_dates = cache["dates"][rows]
+
+    # the cached last bar again: take its close, it may have been revised
+    revised = bar_dates == cached_dates
+    cache["closes"][rows[revised], -1] = bars["close_price"].to_numpy()[revised]
+
+    new = bars[~revised]
+    if new.empty:
+        return cache
+    panel = build_panel(new)
+    new_rows = pd.Index(cache["tickers"]).get_indexer(panel["tickers"])
+    new_closes = np.full((len(cache["tickers"]), panel["close_price"].shape[1]), np.nan)
+    new_closes[new_rows] = panel["close_price"]
+    counts = np.zeros(len(cache["tickers"]), dtype=np.int64)
+    counts[new_rows] = (~np.isnat(panel["dates"])).sum(axis=1)
+    cache["closes"] = append_bars(cache["closes"], new_closes, counts)
+    cache["dates"][new_rows] = panel["dates"][:, -1]
+    return cache
+
+
+def score_frame(cache, vol_window, skip_bars, weights):
+    """The scores of every ticker with at least one horizon, one row per ticker dated at its last bar."""
+    scores = momentum_scores(cache["closes"], vol_window, skip_bars, weights)
+    frame = pd.DataFrame({"date": cache["dates"], **scores, "yahoo_ticker": cache["tickers"]})
+    return frame[~np.isnan(scores["momentum"])].sort_values("rank", ignore_index=True)
+
+
+def update_scores(cur, tickers, rebuild=False, cache_path=CACHE_PATH):
+    """Brings the close window up to date and loads the day's scores. Returns (scores, cache)."""
+    vol_window, skip_bars, weights, n_bars = momentum_config()
+    cache = empty_cache(n_bars) if rebuild else load_cache(n_bars, cache_path)
+    cache = align_cache(cache, tickers)
+    bars = fetch_new_bars(cur, cache)
+    cache = apply_new_bars(cache, bars)
+    scores = score_frame(cache, vol_window, skip_bars, weights)
+    create_table(cur)
+    load_table(cur, "momentum_score", scores)
+    logger.info(f"Scored the momentum of {len(scores)} of {len(tickers)} tickers from {len(bars)} new bars")
+    return scores, cache
+
+
+@metrics.timed("stage", stage="momentum")
+def main(tickers_path=TICKERS_PATH, rebuild=False):
+    """Scores the tickers in tickers_path and loads the scores. Returns the scores, best first, or None if the
+    run failed."""
+    try:
+        with connection() as conn, conn.cursor() as cur:
+            scores, cache = update_scores(cur, load_tickers(tickers_path), rebuild)
+        save_cache(cache) # only once the scores are committed
+        print(f"Scored the momentum of {len(scores)} tickers")
+        return scores
+    except Exception as e:
+        print(f"Error in main(): {e}")
+        logger.error(f"Failed to score momentum: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    main()
+    metrics.write_run_report("momentum")
@@ -0,0 +1,137 @@
+from datetime import timedelta
+import pandas as pd
+from utils.db_connection import connection, fetch_columns
+from utils.portfolio_engine import daily_positions, transaction_states
+from utils import metrics
+from utils.logging_config import logger
+from scripts.loader import load_table
+
+# Materializes the daily positions of the transaction table in the position table: quantity held, cost basis,
+# realized and unrealized P&L per asset and trading day. Every run only adds the days after the last computed one.
+# An asset is recomputed from its first transaction when a transaction on or before its last computed day was added
+# or removed since (e.g. an older export imported later), which is noticed by the number of transactions applied.
+#
+# The portfolio over time is then a lookup on the date index, see portfolio_history().
+
+
+def create_table(cur):
+    query = """
+    CREATE TABLE IF NOT EXISTS position (
+        position_id SERIAL PRIMARY KEY,
+        date DATE NOT NULL,
+        quantity INT NOT NULL,
+        cost_basis NUMERIC(14,2) NOT NULL,
+        close_price NUMERIC(10,2),
+        market_value NUMERIC(14,2),
+        realized_pnl NUMERIC(14,2) NOT NULL,
+        unrealized_pnl NUMERIC(14,2),
+        transactions INT NOT NULL,
+        asset_id INT NOT NULL REFERENCES asset(asset_id)
+        );
+    CREATE INDEX IF NOT EXISTS position_date_idx ON position (date)
+        INCLUDE (market_value, cost_basis, realized_pnl, unrealized_pnl);
+    """
+    cur.execute(query)
+
+
+def fetch_transactions(cur):
+    cur.execute("""
+    SELECT asset_id, date, quantity, price, fee
+    FROM transaction
+    WHERE asset_id IS NOT NULL
+    ORDER BY asset_id, date, time, transaction_id;
+    """)
+    return pd.DataFrame(cur.fetchall(), columns=["asset_id", "date", "quantity", "price", "fee"])
+
+
+def fetch_last_positions(cur):
+    """Returns {asset_id: (last computed date, transactions applied on that date)}."""
+    cur.execute("""
+    SELECT DISTINCT ON (asset_id) asset_id, date, transactions
+    FROM position
+    ORDER BY asset_id, date DESC;
+    """)
+    return {asset_id: (day, applied) for asset_id, day, applied in cur.fetchall()}
+
+
+def start_dates(cur, states):
+    """The first day to compute per asset. Assets whose stored positions are stale are deleted and start over."""
+    last_positions = fetch_last_positions(cur)
+    starts, stale = {}, []
+    for asset_id, asset_states in states.groupby("asset_id"):
+        first_day = asset_states["date"].min().date()
+        if asset_id not in last_positions:
+            starts[asset_id] = first_day
+            continue
+        last_day, applied = last_positions[asset_id]
+        if (asset_states["date"].dt.date <= last_day).sum() != applied or first_day > last_day:
+            stale.append(asset_id)
+            starts[asset_id] = first_day
+        else:
+            starts[asset_id] = last_day + timedelta(days=1)
+    # assets whose transactions are all gone
+    stale.extend(asset_id for asset_id in last_positions if asset_id not in starts)
+    if stale:
+        cur.execute("DELETE FROM position WHERE asset_id = ANY(%s);", (stale,))
+        logger.info(f"Recomputing the positions of {len(stale)} assets with changed transactions")
+    return starts
+
+
+def fetch_closes(conn, starts):
+    query = """
+    SELECT p.asset_id, a.yahoo_ticker, p.date, p.close_price
+    FROM unnest(%s::int[], %s::date[]) AS s(asset_id, start_date)
+    JOIN price p ON p.asset_id = s.asset_id AND p.date >= s.start_date
+    JOIN asset a ON a.asset_id = p.asset_id;
+    """
+    columns = fetch_columns(conn, query, (list(starts), list(starts.values())),
+                            ("asset_id", "yahoo_ticker", "date", "close_price"), "position_closes")
+    return pd.DataFrame({
+        "asset_id": pd.Series(columns["asset_id"], dtype="int64"),
+        "yahoo_ticker": pd.Series(columns["yahoo_ticker"], dtype=object),
+        "date": pd.to_datetime(pd.Series(columns["date"], dtype=object)),
+        "close_price": pd.Series(columns["close_price"], dtype=float), # NUMERIC arrives as Decimal
+    })
+
+
+def portfolio_history(cur, start_date=None, end_date=None):
+    """Value, cost basis and P&L of the whole portfolio per day."""
+    cur.execute("""
+    SELECT date, SUM(market_value), SUM(cost_basis), SUM(realized_pnl), SUM(unrealized_pnl)
+    FROM position
+    WHERE date BETWEEN COALESCE(%s, '-infinity'::date) AND COALESCE(%s, 'infinity'::date)
+    GROUP BY date
+    ORDER BY date;
+    """, (start_date, end_date))
+    return pd.DataFrame(cur.fetchall(), columns=["date", "market_value", "cost_basis", "realized_pnl", "unrealized_pnl"])
+
+
+@metrics.timed("stage", stage="positions")
+def main():
+    """Adds the positions of the days since the last run. Returns the load counts, or None on error."""
+    try:
+        with connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('transaction') IS NOT NULL;")
+            if not cur.fetchone()[0]:
+                logger.info("No transaction table, skipping the positions.")
+                return None
+            create_table(cur)
+            transactions = fetch_transactions(cur)
+            states = transaction_states(transactions)
+            if states.empty:
+                logger.info("No transactions, skipping the positions.")
+                return None
+            closes = fetch_closes(conn, start_dates(cur, states))
+            positions = daily_positions(states, closes)
+            counts = load_table(cur, "position", positions)
+        print(f"Loaded {counts['inserted']} position rows")
+        return counts
+    except Exception as e:
+        print(f"Error in main(): {e}")
+        logger.error(f"Failed to update the positions: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    main()
+    metrics.write_run_report("positions")
@@ -0,0 +1,61 @@
+from pathlib import Path
+import pandas as pd
+from utils.config_loader import load_tickers
+from utils.db_connection import connection, fetch_columns
+from utils import metrics
+from utils.logging_config import logger
+from utils.price_store import PRICE_COLUMNS, write_prices
+
+# Seeds the local price store (utils/price_store.py) with the whole price history in the database. The daily run
+# only adds the prices it downloads to the store, so a store started after the database has just the days since.
+# Run `main.py store-seed` once when turning price_store on, or when the prices were backfilled or corrected in db.
+
+# Dynamically determine the base directory (root of the project)
+BASE_DIR = Path(__file__).resolve().parent.parent
+TICKERS_PATH = BASE_DIR / "config" / "tickers.json"
+
+TICKERS_PER_QUERY = 100 # the history of this many tickers is held in memory at a time
+FETCH_CHUNK_SIZE = 10000  # rows per round trip from the server side cursor
+
+
+def fetch_history(conn, tickers):
+    """The whole price history of the tickers, as the long dataframe write_prices takes."""
+    query = f"""
+    SELECT a.yahoo_ticker, {', '.join('p.' + column for column in PRICE_COLUMNS)}
+    FROM asset a
+    JOIN price p ON p.asset_id = a.asset_id
+    WHERE a.yahoo_ticker = ANY(%s) AND p.date IS NOT NULL;
+    """
+    columns = fetch_columns(conn, query, (tickers,), ["yahoo_ticker"] + PRICE_COLUMNS, "store_seed_prices", FETCH_CHUNK_SIZE)
+    prices = pd.DataFrame({
+        "yahoo_ticker": pd.Series(columns["yahoo_ticker"], dtype=object),
+        "date": pd.to_datetime(pd.Series(columns["date"], dtype=object)),
+    })
+    # NUMERIC arrives as Decimal, NULL as None
+    for column in PRICE_COLUMNS[1:-1]:
+        prices[column] = pd.Series(columns[column], dtype=float)
+    prices["volume"] = pd.array(columns["volume"], dtype="Int64")
+    metrics.increment("rows_read", len(prices), table="price")
+    return prices
+
+
+@metrics.timed("stage", stage="store_seed")
+def main(tickers_path=TICKERS_PATH):
+    """Writes the price history of the tickers in db to the price store. Returns the number of rows written."""
+    tickers = load_tickers(tickers_path)
+    written = 0
+    try:
+        with connection() as conn:
+            for start in range(0, len(tickers), TICKERS_PER_QUERY):
+                written += write_prices(fetch_history(conn, tickers[start:start + TICKERS_PER_QUERY]))
+        print(f"Seeded the price store with {written} price rows of {len(tickers)} tickers")
+        return written
+    except Exception as e:
+        print(f"Error in main(): {e}")
+        logger.error(f"Failed to seed the price store: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    main()
+    metrics.write_run_report("store_seed")
@@ -0,0 +1,53 @@
+from pathlib import Path
+import pandas as pd
+from scripts.loader import load_table
+from utils import metrics
+from utils.db_connection import connection
+from utils.logging_config import logger
+
+# Loads the hit table of the screening rules (see email.analyse_indicators) into screen_hit, one row per asset,
+# day and matching rule, so past signals can be queried next to the prices and indicators.
+
+# Dynamically determine the base directory (root of the project)
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+def create_table(cur):
+    query = """
+    CREATE TABLE IF NOT EXISTS screen_hit (
+        screen_hit_id SERIAL PRIMARY KEY,
+        date DATE NOT NULL,
+        rule VARCHAR(50) NOT NULL,
+        value DOUBLE PRECISION,
+        asset_id INT NOT NULL REFERENCES asset(asset_id)
+        );
+    """
+    cur.execute(query)
+
+
+def delete_previous_hits(cur, indicators):
+    """A rerun of the same day replaces that day's hits, so rules that stopped matching don't leave a row behind."""
+    query = """
+    DELETE FROM screen_hit h
+    USING asset a, unnest(%s::text[], %s::date[]) AS screened(yahoo_ticker, date)
+    WHERE h.asset_id = a.asset_id AND a.yahoo_ticker = screened.yahoo_ticker AND h.date = screened.date;
+    """
+    screened = indicators.dropna(subset=["date"])
+    cur.execute(query, (list(screened["yahoo_ticker"]), list(pd.to_datetime(screened["date"]).dt.date)))
+    return cur.rowcount
+
+
+@metrics.timed("stage", stage="load_screen_hits")
+def main(hits, indicators):
+    """ Replaces the hits of the screened (ticker, date) pairs in indicators with hits. Returns the row counts."""
+    try:
+        with connection() as conn, conn.cursor() as cur:
+            create_table(cur)
+            delete_previous_hits(cur, indicators)
+            counts = load_table(cur, "screen_hit", hits)
+        print(f"Loaded {counts['inserted']} screening hits")
+        return counts
+    except Exception as e:
+        print(f"Error in main(): {e}")
+        logger.error(f"Failed to load screening hits to db: {e}")
+        return None
@@ -0,0 +1,297 @@
+from io import StringIO
+import pandas as pd
+from scripts.partitions import ensure_partitions, forget_partitions
+from utils import metrics
+from utils.logging_config import logger
+
+# One parameterized loader for the tables keyed by asset and date. Rows come in as a dataframe with a
+# yahoo_ticker column, are COPYed from an in-memory buffer into a temporary staging table and then upserted with
+# INSERT ... ON CONFLICT (asset_id, date, ...), which is backed by a unique index instead of an anti-join against the
+# whole target table, so the load time doesn't grow with the table.
+#
+# A table with a "latest" entry also keeps the newest row of every asset in that table (latest_indicator), refreshed
+# from the staged rows of every load. Readers that want today's snapshot of the whole universe (screening, the email)
+# read one row per asset from it, however long the history grows.
+#
+# A "partitioned" table has a partition per year once `main.py migrate` ran (see scripts/schema.py). The loader
+# creates the partitions of the years it stages before the upsert.
+#
+# The indexes and the latest table are created by the first load that needs them. Concurrent loads (the workers of
+# the streaming pipeline) serialize that DDL on an advisory lock and look again once they hold it.
+
+TABLES = {
+    "price": {
+        "columns": {
+            "date": "DATE",
+            "close_price": "NUMERIC(10,2)",
+            "open_price": "NUMERIC(10,2)",
+            "high_price": "NUMERIC(10,2)",
+            "low_price": "NUMERIC(10,2)",
+            "volume": "BIGINT",
+        },
+        "partitioned": True,
+    },
+    "indicator": {
+        "columns": {
+            "date": "DATE",
+            "sma_5": "NUMERIC(10,2)",
+            "sma_10": "NUMERIC(10,2)",
+            "rsi": "NUMERIC(5,2)",
+        },
+        "latest": "latest_indicator",
+        "partitioned": True,
+    },
+    "indicator_value": {
+        "columns": {
+            "date": "DATE",
+            "name": "VARCHAR(50)",
+            "value": "DOUBLE PRECISION",
+        },
+        "key": ("asset_id", "date", "name"),
+        "partitioned": True,
+    },
+    "screen_hit": {
+        "columns": {
+            "date": "DATE",
+            "rule": "VARCHAR(50)",
+            "value": "DOUBLE PRECISION",
+        },
+        "key": ("asset_id", "date", "rule"),
+    },
+    "position": {
+        "columns": {
+            "date": "DATE",
+            "quantity": "INT",
+            "cost_basis": "NUMERIC(14,2)",
+            "close_price": "NUMERIC(10,2)",
+            "market_value": "NUMERIC(14,2)",
+            "realized_pnl": "NUMERIC(14,2)",
+            "unrealized_pnl": "NUMERIC(14,2)",
+            "transactions": "INT",
+        },
+    },
+    "momentum_score": {
+        "columns": {
+            "date": "DATE",
+            "return_1m": "DOUBLE PRECISION",
+            "return_3m": "DOUBLE PRECISION",
+            "return_6m": "DOUBLE PRECISION",
+            "return_12m": "DOUBLE PRECISION",
+            "volatility": "DOUBLE PRECISION",
+            "momentum": "DOUBLE PRECISION",
+            "score": "DOUBLE PRECISION",
+            "rank": "INT",
+        },
+    },
+}
+
+KEY_COLUMNS = ("asset_id", "date") # unless the table sets its own key
+COPY_CHUNK_ROWS = 100000  # rows per COPY call, so the in-memory buffer stays bounded
+
+DDL_LOCK = 4208 # pg_advisory_xact_lock key, with the table's hash as the second key
+
+
+def key_columns(table):
+    return TABLES[table].get("key", KEY_COLUMNS)
+
+
+def index_exists(cur, table, index_name):
+    cur.execute("SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexname = %s;", (table, index_name))
+    return cur.fetchone() is not None
+
+
+def lock_ddl(cur, table, index_name):
+    """Waits until no other load creates the table's indexes or latest table, until the end of the transaction.
+    Returns whether the index was created meanwhile."""
+    cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s));", (DDL_LOCK, table))
+    return index_exists(cur, table, index_name)
+
+
+def ensure_unique_key(cur, table):
+    """The upsert needs a unique index on the key. A table loaded before the index existed can hold the same key
+    more than once, of which the last written row (the highest ctid) is kept before the index is created."""
+    key = key_columns(table)
+    index_name = f"{table}_{'_'.join(key)}_key"
+    # look in the catalog first: CREATE INDEX IF NOT EXISTS takes a share lock on the table even when the index
+    # exists, which deadlocks with a concurrent load inserting into it
+    if not index_exists(cur, table, index_name) and not lock_ddl(cur, table, index_name):
+        # rows with a NULL in the key don't conflict in a unique index and are left alone
+        cur.execute(f"""
+        DELETE FROM {table} older
+        USING {table} newer
+        WHERE {' AND '.join(f'older.{column} = newer.{column}' for column in key)}
+        AND older.ctid < newer.ctid;
+        """)
+        if cur.rowcount:
+            logger.warning(f"Deleted {cur.rowcount} {table} rows duplicating the key ({', '.join(key)}) of a newer row")
+        cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {table} ({', '.join(key)});")
+
+
+def ensure_latest_table(cur, table):
+    """Creates the table of the newest row per asset, seeded from the history the first time. The history gets a
+    covering index on (asset_id, date DESC), so the seed (and any query for an asset's latest rows) is an index
+    only scan instead of a sort of the whole table."""
+    latest = TABLES[table]["latest"]
+    columns = TABLES[table]["columns"]
+    value_columns = [column for column in columns if column != "date"]
+    index_name = f"{table}_asset_id_date_desc_idx"
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (latest,))
+    if cur.fetchone()[0] and index_exists(cur, table, index_name):
+        return
+    if not lock_ddl(cur, table, index_name):
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} (asset_id, date DESC) INCLUDE ({', '.join(value_columns)});")
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (latest,))
+    if cur.fetchone()[0]:
+        return
+    column_definitions = ", ".join(f"{column} {type_}" for column, type_ in columns.items())
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {latest} (asset_id INT PRIMARY KEY REFERENCES asset(asset_id), {column_definitions});")
+    upsert_latest(cur, table, f"""
+        SELECT DISTINCT ON (asset_id) asset_id, {', '.join(columns)}
+        FROM {table}
+        ORDER BY asset_id, date DESC
+    """)
+    logger.info(f"Created {latest} with the newest {table} row of {cur.rowcount} assets")
+
+
+def upsert_latest(cur, table, rows_query):
+    """Upserts the rows of rows_query (asset_id and the table's columns, one row per asset) into the latest table,
+    unless the stored row is newer: a backfill of old dates never replaces the current row."""
+    latest = TABLES[table]["latest"]
+    columns = list(TABLES[table]["columns"])
+    cur.execute(f"""
+    INSERT INTO {latest} (asset_id, {', '.join(columns)})
+    {rows_query}
+    ON CONFLICT (asset_id) DO UPDATE SET
+        {', '.join(f'{column} = EXCLUDED.{column}' for column in columns)}
+    WHERE {latest}.date <= EXCLUDED.date
+        AND ({', '.join(f'{latest}.{column}' for column in columns)})
+            IS DISTINCT FROM ({', '.join(f'EXCLUDED.{column}' for column in columns)});
+    """)
+
+
+def refresh_latest(cur, table):
+    """Moves the newest staged row of every asset into the latest table."""
+    columns = list(TABLES[table]["columns"])
+    upsert_latest(cur, table, f"""
+        SELECT DISTINCT ON (a.asset_id) a.asset_id, {', '.join('s.' + column for column in columns)}
+        FROM staging_load_{table} s
+        JOIN asset a ON a.yahoo_ticker = s.yahoo_ticker
+        ORDER BY a.asset_id, s.date DESC
+    """)
+    return cur.rowcount
+
+
+def read_latest(cur, table, tickers=None):
+    """The newest row of every asset (of the given tickers) as a dataframe with the table's columns and
+    yahoo_ticker, numeric columns as floats."""
+    columns = TABLES[table]["columns"]
+    select = [f"l.{column}::float8 AS {column}" if type_.startswith("NUMERIC") else f"l.{column}"
+              for column, type_ in columns.items()]
+    query = f"""
+    SELECT {', '.join(select)}, a.yahoo_ticker
+    FROM {TABLES[table]['latest']} l
+    JOIN asset a ON a.asset_id = l.asset_id
+    """
+    if tickers is not None:
+        query += " WHERE a.yahoo_ticker = ANY(%s)"
+    cur.execute(query + " ORDER BY a.yahoo_ticker;", (list(tickers),) if tickers is not None else None)
+    return pd.DataFrame(cur.fetchall(), columns=list(columns) + ["yahoo_ticker"])
+
+
+def copy_to_staging(cur, table, data):
+    """COPYs the rows into a temporary staging table. Temporary tables are never WAL logged and disappear with
+    the session, so there's nothing to clean up afterwards."""
+    columns = list(TABLES[table]["columns"])
+    column_definitions = ", ".join(f"{column} {type_}" for column, type_ in TABLES[table]["columns"].items())
+    cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS staging_load_{table} ({column_definitions}, yahoo_ticker VARCHAR(50)) ON COMMIT DELETE ROWS;")
+    cur.execute(f"TRUNCATE staging_load_{table};")
+    for offset in range(0, len(data), COPY_CHUNK_ROWS):
+        buffer = StringIO()
+        data[columns + ["yahoo_ticker"]].iloc[offset:offset + COPY_CHUNK_ROWS].to_csv(buffer, index=False, header=False, date_format="%Y-%m-%d")
+        buffer.seek(0)
+        cur.copy_expert(f"COPY staging_load_{table} ({', '.join(columns)}, yahoo_ticker) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def unmatched_tickers(cur, table):
+    cur.execute(f"""
+    SELECT DISTINCT s.yahoo_ticker
+    FROM staging_load_{table} s
+    LEFT JOIN asset a ON a.yahoo_ticker = s.yahoo_ticker
+    WHERE a.asset_id IS NULL;
+    """)
+    return sorted(row[0] for row in cur.fetchall())
+
+
+def upsert_from_staging(cur, table):
+    """Inserts new rows and updates rows whose values changed (e.g. a revised last bar). Returns (inserted, updated)."""
+    columns = list(TABLES[table]["columns"])
+    key = key_columns(table)
+    value_columns = [column for column in columns if column not in key]
+    # the rows that exist already are counted in the same statement, so from the same snapshot as the upsert
+    # (RETURNING xmax can't tell inserts from updates on a partitioned table)
+    cur.execute(f"""
+    WITH matched AS (
+        SELECT COUNT(*) AS staged, COUNT(t.asset_id) AS existing
+        FROM staging_load_{table} s
+        JOIN asset a ON a.yahoo_ticker = s.yahoo_ticker
+        LEFT JOIN {table} t ON t.asset_id = a.asset_id
+            {''.join(f' AND t.{column} = s.{column}' for column in key if column != 'asset_id')}
+    ), upserted AS (
+        INSERT INTO {table} ({', '.join(columns)}, asset_id)
+        SELECT {', '.join('s.' + column for column in columns)}, a.asset_id
+        FROM staging_load_{table} s
+        JOIN asset a ON a.yahoo_ticker = s.yahoo_ticker
+        ON CONFLICT ({', '.join(key)}) DO UPDATE SET
+            {', '.join(f'{column} = EXCLUDED.{column}' for column in value_columns)}
+        WHERE ({', '.join(f'{table}.{column}' for column in value_columns)})
+            IS DISTINCT FROM ({', '.join(f'EXCLUDED.{column}' for column in value_columns)})
+        RETURNING 1
+    )
+    SELECT staged - existing, (SELECT COUNT(*) FROM upserted) - (staged - existing) FROM matched;
+    """)
+    return cur.fetchone()
+
+
+def load_table(cur, table, data):
+    """Loads a dataframe with the table's columns plus yahoo_ticker. Returns the row counts of the load:
+    staged, inserted, updated, skipped (already loaded with the same values) and the unmatched tickers
+    (not in the asset table, their rows are not loaded)."""
+    if table not in TABLES:
+        raise ValueError(f"Unknown table {table}, expected one of {list(TABLES)}")
+    # the same key twice in one statement would make ON CONFLICT fail, keep the latest
+    data = data.drop_duplicates(["yahoo_ticker"] + [column for column in key_columns(table) if column != "asset_id"], keep="last")
+
+    ensure_unique_key(cur, table)
+    if "latest" in TABLES[table]:
+        ensure_latest_table(cur, table)
+    copy_to_staging(cur, table, data)
+    if TABLES[table].get("partitioned"):
+        cur.execute(f"SELECT DISTINCT EXTRACT(YEAR FROM date)::int FROM staging_load_{table} WHERE date IS NOT NULL;")
+        created = ensure_partitions(cur, table, [row[0] for row in cur.fetchall()])
+    else:
+        created = []
+    try:
+        unmatched = unmatched_tickers(cur, table)
+        inserted, updated = upsert_from_staging(cur, table)
+        if "latest" in TABLES[table]:
+            refresh_latest(cur, table)
+    except Exception:
+        if created:
+            forget_partitions(table) # the rollback of this load drops them again
+        raise
+    unmatched_rows = int(data["yahoo_ticker"].isin(unmatched).sum())
+    counts = {
+        "staged": len(data),
+        "inserted": inserted,
+        "updated": updated,
+        "skipped": len(data) - unmatched_rows - inserted - updated,
+        "unmatched_tickers": unmatched,
+    }
+    for action in ("inserted", "updated", "skipped"):
+        metrics.increment("rows_loaded", counts[action], table=table, action=action)
+    metrics.increment("rows_unmatched", unmatched_rows, table=table)
+    logger.info(f"Loaded {table}: {counts['staged']} rows staged, {inserted} inserted, {updated} updated, "
+                f"{counts['skipped']} unchanged")
+    if unmatched:
+        logger.warning(f"{unmatched_rows} {table} rows skipped, tickers not in the asset table: {unmatched}")
+    return counts
@@ -0,0 +1,78 @@
+from datetime import date
+from utils.logging_config import logger
+
+# Yearly range partitions of the history tables (price_y2024 holds the prices of 2024, see scripts/schema.py).
+# There is no default partition: with one, Postgres can't read the partitions in date order, and the "last n
+# closes of an asset" queries would probe every year instead of stopping in the newest partition. Instead the
+# loader creates the partition of every year it stages rows for, before they are upserted.
+
+PARTITION_LOCK = 4207 # pg_advisory_xact_lock key, with the table's hash as the second key
+
+_years = {} # table -> years known to have a partition in this process
+
+
+def partition_name(table, year):
+    return f"{table}_y{year}"
+
+
+def is_partitioned(cur, table):
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s);", (table,))
+    row = cur.fetchone()
+    return row is not None and row[0]
+
+
+def partition_years(cur, table):
+    cur.execute("""
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = to_regclass(%s);
+    """, (table,))
+    prefix = partition_name(table, "")
+    return {int(name[len(prefix):]) for (name,) in cur.fetchall() if name[len(prefix):].isdigit()}
+
+
+def ensure_partitions(cur, table, years):
+    """Creates the missing partitions of the given years. Does nothing for a table that isn't partitioned (migrate
+    wasn't run). Returns the names of the partitions created."""
+    missing = set(years) - _years.get(table, set())
+    if not missing or not is_partitioned(cur, table):
+        return []
+    # a concurrent load of the same new year waits here until the partition is committed, then finds it
+    cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s));", (PARTITION_LOCK, table))
+    existing = partition_years(cur, table)
+    created_years = sorted(missing - existing)
+    created = [attach_partition(cur, table, year) for year in created_years]
+    # remembered before they are committed, a load that fails after this forgets them (forget_partitions) so its
+    # rolled back partitions are created again
+    _years[table] = existing | set(created_years)
+    if created:
+        logger.info(f"Created the {table} partitions {created}")
+    return created
+
+
+def forget_partitions(table):
+    """Drops the partitions of a table from the cache, the next ensure_partitions looks them up again."""
+    _years.pop(table, None)
+
+
+def attach_partition(cur, table, year):
+    """Creates a table and attaches it as the partition of a year. Attaching, unlike CREATE TABLE ... PARTITION OF,
+    doesn't lock out the loads writing to the other partitions."""
+    name = partition_name(table, year)
+    cur.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);")
+    cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s);",
+                (date(year, 1, 1), date(year + 1, 1, 1)))
+    return name
+
+
+def partitions(cur, table):
+    """(partition, bound, estimated rows, bytes) of every partition of a table."""
+    cur.execute("""
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint, pg_total_relation_size(c.oid)
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = to_regclass(%s)
+    ORDER BY c.relname;
+    """, (table,))
+    return cur.fetchall()
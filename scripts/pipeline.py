@@ -0,0 +1,277 @@
+import queue
+import threading
+import time
+import pandas as pd
+from pathlib import Path
+from utils.config_loader import CONSTANTS, load_tickers
+from utils.db_connection import connection
+from utils import metrics
+from utils.logging_config import logger
+from utils.price_store import write_prices
+from scripts.email import analyse_indicators
+from scripts.et_indicators import fetch_close_prices, indicator_config, indicators_from_prices
+from scripts.et_price import clean, iter_downloads, lookup_last_dates
+from scripts.etl_indicator_state import create_state_table, latest_indicators, update_ticker_states
+from scripts.l_screen_hits import main as load_screen_hits
+from scripts.loader import load_table
+from utils.screening import HIT_COLUMNS
+
+# Streaming version of the daily run. Instead of finishing every stage for all tickers before the next one starts,
+# tickers flow through bounded queues as soon as they are downloaded:
+#   fetch -> clean -> load prices -> indicators (calculate + load) -> screen
+# Each stage runs its own worker threads and takes up to a batch of items at once, so the database stages still
+# work in bulk. A full queue blocks the stage feeding it (backpressure), which keeps memory bounded when a
+# downstream stage is slower. The run takes about as long as its slowest stage instead of the sum of all stages.
+
+# Dynamically determine the base directory (root of the project)
+BASE_DIR = Path(__file__).resolve().parent.parent
+TICKERS_PATH = BASE_DIR / "config" / "tickers.json"
+INDICATORS_OUTPUT_PATH = BASE_DIR / "data" / "processed" / "indicators.csv"
+
+DONE = object() # end of stream marker, passed on from stage to stage
+POLL_SECONDS = 0.5 # how often a blocked worker checks whether the run was aborted
+
+
+def put(outbox, item, abort):
+    """Blocks while the queue is full, returns False if the run is aborted meanwhile."""
+    while not abort.is_set():
+        try:
+            outbox.put(item, timeout=POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def get_batch(inbox, batch_size, abort):
+    """Waits for one item, then takes whatever else is already queued up to batch_size. Returns (items, done)."""
+    items = []
+    while not items:
+        if abort.is_set():
+            return items, True
+        try:
+            item = inbox.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            continue
+        if item is DONE:
+            inbox.put(DONE) # leave the marker for the other workers of the stage
+            return items, True
+        items.append(item)
+    while len(items) < batch_size:
+        try:
+            item = inbox.get_nowait()
+        except queue.Empty:
+            break
+        if item is DONE:
+            inbox.put(DONE)
+            return items, True
+        items.append(item)
+    return items, False
+
+
+def new_stage_stats():
+    return {"items_in": 0, "items_out": 0, "batches": 0, "failed_batches": 0, "busy_seconds": 0.0, "blocked_seconds": 0.0}
+
+
+def stage_worker(name, work, inbox, outbox, batch_size, abort, stats, lock):
+    """Runs work(items) -> output items on batches from inbox until the stream ends. A failing batch is logged
+    and skipped, the rest of the stream carries on and the run fails at its end (see main)."""
+    done = False
+    while not done:
+        items, done = get_batch(inbox, batch_size, abort)
+        if not items:
+            continue
+        start = time.perf_counter()
+        try:
+            output = work(items)
+        except Exception as e:
+            logger.error(f"Stage {name} failed on a batch of {len(items)} items: {e}")
+            output = []
+            with lock:
+                stats["failed_batches"] += 1
+        busy = time.perf_counter() - start
+        metrics.observe("stream_stage_busy", busy, stage=name)
+
+        start = time.perf_counter()
+        for item in output:
+            if outbox is not None and not put(outbox, item, abort):
+                return
+        metrics.observe("stream_stage_blocked", time.perf_counter() - start, stage=name)
+        with lock:
+            stats["items_in"] += len(items)
+            stats["items_out"] += len(output)
+            stats["batches"] += 1
+            stats["busy_seconds"] += busy
+            stats["blocked_seconds"] += time.perf_counter() - start
+
+
+def start_stage(name, work, inbox, outbox, workers, batch_size, abort, stats):
+    """Starts the workers of a stage plus a closer that passes DONE on once all of them have finished."""
+    stats[name] = new_stage_stats()
+    lock = threading.Lock()
+    threads = [threading.Thread(target=stage_worker, name=f"{name}-{i}", daemon=True,
+                                args=(name, work, inbox, outbox, batch_size, abort, stats[name], lock))
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    def close():
+        for thread in threads:
+            thread.join()
+        if outbox is not None:
+            put(outbox, DONE, abort)
+
+    closer = threading.Thread(target=close, name=f"{name}-closer", daemon=True)
+    closer.start()
+    return closer
+
+
+def fetch_stage(tickers_path, period, incremental, outbox, abort, stats):
+    """Producer: puts (ticker, raw dataframe) on the queue as the downloads come in. Tickers that got no new rows
+    are passed on with None so their indicators are still refreshed."""
+    stats["fetch"] = new_stage_stats()
+    last_dates = lookup_last_dates(period) if incremental else None
+    fetched = set()
+    try:
+        for ticker, raw_df in iter_downloads(tickers_path, period, last_dates):
+            fetched.add(ticker)
+            stats["fetch"]["items_out"] += 1
+            if not put(outbox, (ticker, raw_df), abort):
+                return
+        for ticker in dict.fromkeys(load_tickers(tickers_path)):
+            if ticker not in fetched and not put(outbox, (ticker, None), abort):
+                return
+    except Exception as e:
+        # the tickers after the failure were never downloaded, the run is aborted instead of screening and
+        # emailing part of the universe
+        logger.error(f"Stage fetch failed after {len(fetched)} tickers: {e}")
+        stats["fetch"]["failed_batches"] += 1
+        stats["fetch"]["error"] = e
+        abort.set()
+    finally:
+        put(outbox, DONE, abort)
+
+
+def clean_stage(write_csv):
+    def work(items):
+        return [(ticker, None if raw_df is None else clean(ticker, raw_df, write_csv)) for ticker, raw_df in items]
+    return work
+
+
+def load_stage():
+    def work(items):
+        # one COPY + upsert for the whole batch
+        prices = [cleaned_df for ticker, cleaned_df in items if cleaned_df is not None and not cleaned_df.empty]
+        if prices:
+            prices = pd.concat(prices, ignore_index=True)
+            with connection() as conn, conn.cursor() as cur:
+                load_table(cur, "price", prices)
+            if CONSTANTS.get("price_store", False):
+                write_prices(prices)
+        return [ticker for ticker, cleaned_df in items]
+    return work
+
+
+def indicator_stage():
+    rsi_method = CONSTANTS.get("rsi_method", "simple")
+    stateful = CONSTANTS.get("indicator_mode", "window") == "stateful"
+    rsi_window, short_sma_window, long_sma_window, max_calculation_range = indicator_config()
+
+    def work(tickers):
+        with connection() as conn, conn.cursor() as cur:
+            if stateful:
+                indicators = latest_indicators(update_ticker_states(conn, cur, tickers, rsi_method, max_calculation_range))
+            else:
+                indicators = indicators_from_prices(fetch_close_prices(conn, tickers))
+                load_table(cur, "indicator", indicators)
+        return [indicators]
+    return work
+
+
+def screen_stage(indicator_frames, hit_frames):
+    def work(frames):
+        indicators = pd.concat([frame for frame in frames if not frame.empty] or frames, ignore_index=True)
+        hits = analyse_indicators(indicators=indicators)
+        load_screen_hits(hits, indicators)
+        indicator_frames.append(indicators)
+        hit_frames.append(hits)
+        return []
+    return work
+
+
+def log_stats(stats, seconds):
+    for name, s in stats.items():
+        logger.info(f"Stage {name}: {s['items_in']} items in, {s['items_out']} out in {s['batches']} batches, "
+                    f"{s['busy_seconds']:.2f}s busy, {s['blocked_seconds']:.2f}s blocked by the next stage, "
+                    f"{s['failed_batches']} failed batches")
+    print(f"Streaming pipeline finished in {seconds:.2f}s")
+    logger.info(f"Streaming pipeline finished in {seconds:.2f}s")
+
+
+@metrics.timed("stage", stage="streaming_pipeline")
+def main(tickers_path=TICKERS_PATH, period=None, incremental=None, write_csv=False):
+    """Runs fetch -> clean -> load -> indicators -> screen as a stream. Returns the latest indicators and the
+    screening hit table (see email.analyse_indicators), or (None, None) if the run was interrupted. Raises
+    RuntimeError if the fetch stage or a batch of any stage failed, the screen would miss part of the universe. What
+    the other batches loaded is kept."""
+    period = period or CONSTANTS["period"]
+    incremental = CONSTANTS.get("incremental", False) if incremental is None else incremental
+    queue_size = CONSTANTS.get("stream_queue_size", 64)
+
+    if CONSTANTS.get("indicator_mode", "window") == "stateful":
+        with connection() as conn, conn.cursor() as cur:
+            create_state_table(cur) # once here, not concurrently from the indicator workers
+
+    start = time.perf_counter()
+    abort = threading.Event()
+    stats = {}
+    downloaded, cleaned, loaded, calculated = (queue.Queue(maxsize=queue_size) for _ in range(4))
+    indicator_frames, hit_frames = [], []
+
+    producer = threading.Thread(target=fetch_stage, name="fetch", daemon=True,
+                                args=(tickers_path, period, incremental, downloaded, abort, stats))
+    producer.start()
+    closers = [
+        start_stage("clean", clean_stage(write_csv), downloaded, cleaned,
+                    CONSTANTS.get("stream_clean_workers", 2), 1, abort, stats),
+        start_stage("load", load_stage(), cleaned, loaded,
+                    CONSTANTS.get("stream_load_workers", 2), CONSTANTS.get("stream_load_batch", 25), abort, stats),
+        start_stage("indicators", indicator_stage(), loaded, calculated,
+                    CONSTANTS.get("stream_indicator_workers", 2), CONSTANTS.get("stream_indicator_batch", 50), abort, stats),
+        start_stage("screen", screen_stage(indicator_frames, hit_frames), calculated, None, 1, queue_size, abort, stats),
+    ]
+
+    try:
+        # drain: the stream ends when DONE has travelled through every stage
+        producer.join()
+        for closer in closers:
+            closer.join()
+    except KeyboardInterrupt:
+        logger.warning("Streaming pipeline interrupted, stopping the stages.")
+        abort.set()
+        for closer in closers:
+            closer.join()
+        return None, None
+    log_stats(stats, time.perf_counter() - start)
+    if "error" in stats["fetch"]:
+        raise RuntimeError(f"Stage fetch failed, the prices loaded so far are kept: {stats['fetch']['error']}")
+    failed = {name: s["failed_batches"] for name, s in stats.items() if s["failed_batches"]}
+    if failed:
+        raise RuntimeError("Failed batches per stage " + ", ".join(f"{name} {count}" for name, count in failed.items())
+                           + ", not screening an incomplete universe")
+
+    indicator_frames = [indicators for indicators in indicator_frames if not indicators.empty]
+    indicators = pd.concat(indicator_frames, ignore_index=True) if indicator_frames else \
+        pd.DataFrame(columns=['date', 'sma_5', 'sma_10', 'rsi', 'yahoo_ticker'])
+    if write_csv:
+        INDICATORS_OUTPUT_PATH.parent.mkdir(parents=True, exist_ok=True)
+        indicators.to_csv(INDICATORS_OUTPUT_PATH, index=False)
+        logger.info(f"Indicators written to {INDICATORS_OUTPUT_PATH}")
+    hit_frames = [hits for hits in hit_frames if not hits.empty]
+    hits = pd.concat(hit_frames, ignore_index=True) if hit_frames else pd.DataFrame(columns=HIT_COLUMNS)
+    return indicators, hits
+
+
+if __name__ == "__main__":
+    main()
+    metrics.write_run_report("streaming_pipeline")
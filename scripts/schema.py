@@ -0,0 +1,210 @@
+from datetime import date
+from scripts.loader import TABLES, ensure_latest_table, key_columns
+from scripts.partitions import ensure_partitions, is_partitioned, partitions
+from utils import metrics
+from utils.config_loader import CONSTANTS
+from utils.db_connection import connection, require_own_transactions
+from utils.logging_config import logger
+
+# Creates and upgrades the tables the pipeline can't do without: asset, transaction, and the history tables that
+# grow with every run, price, indicator and indicator_value. Migrations are numbered and applied once, in order,
+# each in its own transaction; schema_migration records the ones applied. `python main.py migrate` applies the
+# pending ones, on a fresh database as well as on one whose tables were created by hand.
+#
+# The history tables are partitioned by range of date, one partition per year (price_y2024, ...). Every partition
+# has its own unique (asset_id, date, ...) index, so an upsert or a lookup of an asset's last dates only walks the
+# index of the years it touches, and a BRIN index on date, a few pages per partition, for the scans of a date range over
+# all assets. The loader creates the partition of a new year when it first loads a row of it (scripts/partitions.py),
+# `python main.py maintain` creates the partitions of the coming years ahead of time and analyzes the partitioned
+# tables, which autovacuum never does.
+
+PARTITIONED_TABLES = [table for table in TABLES if TABLES[table].get("partitioned")]
+MIGRATION_LOCK = 4206 # pg_advisory_lock key, two workers starting together don't both migrate
+
+
+def create_migration_table(cur):
+    query = """
+    CREATE TABLE IF NOT EXISTS schema_migration (
+        version INT PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    """
+    cur.execute(query)
+
+
+def create_base_tables(cur):
+    query = """
+    CREATE TABLE IF NOT EXISTS asset (
+        asset_id SERIAL PRIMARY KEY,
+        yahoo_ticker VARCHAR(20),
+        isin VARCHAR(12),
+        name TEXT
+        );
+    CREATE TABLE IF NOT EXISTS transaction (
+        transaction_id SERIAL PRIMARY KEY,
+        date DATE,
+        time TIME WITHOUT TIME ZONE,
+        quantity INT,
+        price NUMERIC(10,2),
+        value NUMERIC(12,2),
+        fee NUMERIC(6,2),
+        asset_id INT REFERENCES asset(asset_id)
+        );
+    """
+    cur.execute(query)
+
+
+def index_asset_tickers(cur):
+    """Every load joins its rows to asset by yahoo_ticker. The index is unique unless the table already lists a
+    ticker twice, those are logged and get a plain index."""
+    cur.execute("SELECT yahoo_ticker FROM asset WHERE yahoo_ticker IS NOT NULL GROUP BY yahoo_ticker HAVING COUNT(*) > 1;")
+    duplicates = [row[0] for row in cur.fetchall()]
+    if duplicates:
+        logger.warning(f"asset lists {duplicates} more than once, their rows are loaded once per asset_id")
+        cur.execute("CREATE INDEX IF NOT EXISTS asset_yahoo_ticker_idx ON asset (yahoo_ticker);")
+    else:
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS asset_yahoo_ticker_key ON asset (yahoo_ticker);")
+    cur.execute("CREATE INDEX IF NOT EXISTS asset_isin_idx ON asset (isin);") # the transaction import joins on it
+
+
+def create_partitioned_table(cur, table):
+    key = key_columns(table)
+    column_definitions = ", ".join(f"{column} {type_}{' NOT NULL' if column in key else ''}"
+                                   for column, type_ in TABLES[table]["columns"].items())
+    cur.execute(f"""
+    CREATE TABLE {table} (
+        {column_definitions},
+        asset_id INT NOT NULL REFERENCES asset(asset_id),
+        CONSTRAINT {table}_{'_'.join(key)}_key PRIMARY KEY ({', '.join(key)})
+        ) PARTITION BY RANGE (date);
+    """)
+
+
+def partition_tables(cur):
+    """Creates the partitioned tables (price, indicator and indicator_value). An existing plain table is copied into
+    the partitioned one (rows without an asset or a date are dropped, and of duplicate keys one row is kept) and
+    replaced by it."""
+    this_year = date.today().year
+    years_ahead = CONSTANTS.get("partition_years_ahead", 1)
+    for table in PARTITIONED_TABLES:
+        if is_partitioned(cur, table):
+            continue
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (table,))
+        if not cur.fetchone()[0]:
+            create_partitioned_table(cur, table)
+            ensure_partitions(cur, table, range(this_year, this_year + years_ahead + 1))
+            logger.info(f"Created {table} partitioned by date")
+            continue
+
+        # move the plain table and its indexes out of the way of the names of the partitioned one
+        old = f"{table}_unpartitioned"
+        cur.execute(f"ALTER TABLE {table} RENAME TO {old};")
+        cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s;", (old,))
+        for (index,) in cur.fetchall():
+            cur.execute(f"ALTER INDEX {index} RENAME TO {index[:50]}_unpartitioned;")
+        create_partitioned_table(cur, table)
+        cur.execute(f"SELECT EXTRACT(YEAR FROM MIN(date))::int, EXTRACT(YEAR FROM MAX(date))::int, COUNT(*) FROM {old};")
+        first_year, last_year, rows = cur.fetchone()
+        ensure_partitions(cur, table, range(min(first_year or this_year, this_year),
+                                            max(last_year or this_year, this_year) + years_ahead + 1))
+        columns = ", ".join(TABLES[table]["columns"])
+        key = key_columns(table)
+        cur.execute(f"""
+        INSERT INTO {table} ({columns}, asset_id)
+        SELECT {columns}, asset_id FROM {old}
+        WHERE {' AND '.join(f'{column} IS NOT NULL' for column in key)}
+        ON CONFLICT ({', '.join(key)}) DO NOTHING;
+        """)
+        copied = cur.rowcount
+        cur.execute(f"DROP TABLE {old};")
+        logger.info(f"Partitioned {table} by date: {copied} of {rows} rows copied")
+        if copied < rows:
+            logger.warning(f"{rows - copied} {table} rows without asset, without date or duplicated were dropped")
+
+
+def create_date_indexes(cur):
+    """BRIN indexes on date, and the covering index the latest tables are seeded from."""
+    for table in PARTITIONED_TABLES:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_date_brin ON {table} USING brin (date);")
+        if "latest" in TABLES[table]:
+            ensure_latest_table(cur, table)
+
+
+def create_value_tables(cur):
+    """indicator_value, the long table of the indicator library (utils/indicator_library.py). A fresh database
+    got it from partition_tables already."""
+    partition_tables(cur)
+    create_date_indexes(cur)
+
+
+MIGRATIONS = [
+    (1, "create asset and transaction", create_base_tables),
+    (2, "index asset.yahoo_ticker and asset.isin", index_asset_tickers),
+    (3, "partition price and indicator by date", partition_tables),
+    (4, "BRIN indexes on the dates", create_date_indexes),
+    (5, "create indicator_value partitioned by date", create_value_tables),
+]
+
+
+def applied_migrations(cur):
+    cur.execute("SELECT version FROM schema_migration;")
+    return {row[0] for row in cur.fetchall()}
+
+
+@metrics.timed("stage", stage="migrate")
+def migrate():
+    """Applies the pending migrations. Returns the versions applied."""
+    applied = []
+    require_own_transactions("migrate")
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("SET statement_timeout = 0;") # copying a large table into partitions takes a while
+        cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK,))
+        try:
+            create_migration_table(cur)
+            conn.commit()
+            done = applied_migrations(cur)
+            for version, name, migration in MIGRATIONS:
+                if version in done:
+                    continue
+                logger.info(f"Applying migration {version}: {name}")
+                migration(cur)
+                cur.execute("INSERT INTO schema_migration (version, name) VALUES (%s, %s);", (version, name))
+                conn.commit()
+                applied.append(version)
+                print(f"Applied migration {version}: {name}")
+        except Exception:
+            conn.rollback() # the unlock below can't run in a failed transaction
+            raise
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK,))
+            cur.execute("RESET statement_timeout;")
+    if not applied:
+        print("Schema is up to date")
+    return applied
+
+
+@metrics.timed("stage", stage="maintain")
+def maintain(years_ahead=None):
+    """Creates the partitions up to years_ahead years from now, then analyzes the partitioned tables and prints
+    their partitions."""
+    years_ahead = CONSTANTS.get("partition_years_ahead", 1) if years_ahead is None else years_ahead
+    this_year = date.today().year
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("SET statement_timeout = 0;")
+        try:
+            for table in PARTITIONED_TABLES:
+                if not is_partitioned(cur, table):
+                    print(f"{table} is not partitioned, run `python main.py migrate` first")
+                    continue
+                ensure_partitions(cur, table, range(this_year, this_year + years_ahead + 1))
+                conn.commit()
+                cur.execute(f"ANALYZE {table};")
+                print(f"{table}:")
+                for name, bound, rows, size in partitions(cur, table):
+                    print(f"  {name:<20} {bound:<50} {max(rows, 0):>12} rows {size / 2 ** 20:>10.1f} MB")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.execute("RESET statement_timeout;")
@@ -0,0 +1,184 @@
+import os
+import socket
+import threading
+from utils.db_connection import connection
+from utils import metrics
+from utils.logging_config import logger
+
+# Splits the daily ingest into shards of tickers that several workers (cron jobs on one or more hosts, all running
+# `python main.py worker`) claim through the shard_lease table:
+#   - the first worker of the day plans the shards, the others find them planned already,
+#   - a worker claims a pending shard with SELECT ... FOR UPDATE SKIP LOCKED, so two workers never get the same one
+#     and neither waits for the other,
+#   - while it works on the shard, a heartbeat thread keeps extending the lease. A shard whose lease ran out (its
+#     worker died) is claimed again by the next worker asking, up to max_attempts times, after that it's failed,
+#   - the worker that finds every shard finished passes the barrier: it claims the run in shard_run and runs the
+#     stages that need the whole universe (indicators, screening, email) exactly once per day.
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def create_tables(cur):
+    query = """
+    CREATE TABLE IF NOT EXISTS shard_lease (
+        run_date DATE NOT NULL,
+        shard INT NOT NULL,
+        tickers TEXT[] NOT NULL,
+        status VARCHAR(10) NOT NULL DEFAULT 'pending',
+        worker TEXT,
+        attempts INT NOT NULL DEFAULT 0,
+        leased_until TIMESTAMP,
+        heartbeat_at TIMESTAMP,
+        completed_at TIMESTAMP,
+        error TEXT,
+        PRIMARY KEY (run_date, shard)
+        );
+    CREATE TABLE IF NOT EXISTS shard_run (
+        run_date DATE PRIMARY KEY,
+        worker TEXT NOT NULL,
+        started_at TIMESTAMP NOT NULL DEFAULT now(),
+        finished_at TIMESTAMP
+        );
+    """
+    cur.execute(query)
+
+
+def plan_shards(cur, run_date, tickers, shard_size):
+    """Inserts the day's shards unless another worker planned them already. Tickers are sorted first, so every
+    worker plans the same shards. Returns the number of shards of the day."""
+    tickers = sorted(set(tickers))
+    shards = [tickers[i:i + shard_size] for i in range(0, len(tickers), shard_size)]
+    for shard, shard_tickers in enumerate(shards):
+        cur.execute("""
+        INSERT INTO shard_lease (run_date, shard, tickers) VALUES (%s, %s, %s)
+        ON CONFLICT (run_date, shard) DO NOTHING;
+        """, (run_date, shard, shard_tickers))
+    cur.execute("SELECT COUNT(*) FROM shard_lease WHERE run_date = %s;", (run_date,))
+    return cur.fetchone()[0]
+
+
+def claim_shard(cur, run_date, worker, lease_seconds, max_attempts):
+    """Leases the next pending or abandoned shard. Returns (shard, tickers), or None if there's nothing to claim."""
+    cur.execute("""
+    UPDATE shard_lease l
+    SET status = 'leased', worker = %(worker)s, attempts = l.attempts + 1, error = NULL,
+        leased_until = now() + make_interval(secs => %(lease)s), heartbeat_at = now()
+    FROM (
+        SELECT run_date, shard
+        FROM shard_lease
+        WHERE run_date = %(run_date)s AND attempts < %(max_attempts)s
+            AND (status = 'pending' OR (status = 'leased' AND leased_until < now()))
+        ORDER BY shard
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ) next_shard
+    WHERE l.run_date = next_shard.run_date AND l.shard = next_shard.shard
+    RETURNING l.shard, l.tickers, l.attempts;
+    """, {"worker": worker, "lease": lease_seconds, "run_date": run_date, "max_attempts": max_attempts})
+    row = cur.fetchone()
+    if row is None:
+        return None
+    shard, tickers, attempts = row
+    if attempts > 1:
+        logger.warning(f"Re-leased shard {shard} of {run_date}, attempt {attempts}")
+        metrics.increment("shards_released")
+    return shard, tickers
+
+
+def extend_lease(cur, run_date, shard, worker, lease_seconds):
+    """Returns False if the lease was lost, i.e. it ran out and another worker claimed the shard."""
+    cur.execute("""
+    UPDATE shard_lease SET leased_until = now() + make_interval(secs => %s), heartbeat_at = now()
+    WHERE run_date = %s AND shard = %s AND worker = %s AND status = 'leased';
+    """, (lease_seconds, run_date, shard, worker))
+    return cur.rowcount == 1
+
+
+def finish_shard(cur, run_date, shard, worker, error=None, max_attempts=3):
+    """Marks the shard done, or after an error pending again (failed once it used up its attempts)."""
+    if error is None:
+        cur.execute("""
+        UPDATE shard_lease SET status = 'done', completed_at = now(), leased_until = NULL
+        WHERE run_date = %s AND shard = %s AND worker = %s;
+        """, (run_date, shard, worker))
+    else:
+        cur.execute("""
+        UPDATE shard_lease SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+            error = %s, leased_until = NULL
+        WHERE run_date = %s AND shard = %s AND worker = %s;
+        """, (max_attempts, str(error)[:1000], run_date, shard, worker))
+    return cur.rowcount == 1
+
+
+def fail_abandoned_shards(cur, run_date, max_attempts):
+    """Marks the shards failed whose worker died on their last attempt: their lease ran out and claim_shard doesn't
+    lease them again. Returns their number."""
+    cur.execute("""
+    UPDATE shard_lease SET status = 'failed', error = 'lease ran out on the last attempt', leased_until = NULL
+    WHERE run_date = %s AND status = 'leased' AND leased_until < now() AND attempts >= %s;
+    """, (run_date, max_attempts))
+    if cur.rowcount:
+        logger.warning(f"{cur.rowcount} shards of {run_date} were abandoned on their last attempt, marked failed")
+    return cur.rowcount
+
+
+def unfinished_shards(cur, run_date, max_attempts):
+    """Shards that are pending, or leased and either alive or still to be re-leased."""
+    cur.execute("""
+    SELECT COUNT(*) FROM shard_lease
+    WHERE run_date = %s AND status IN ('pending', 'leased') AND attempts < %s
+        OR run_date = %s AND status = 'leased' AND leased_until >= now();
+    """, (run_date, max_attempts, run_date))
+    return cur.fetchone()[0]
+
+
+def claim_barrier(cur, run_date, worker, lease_seconds):
+    """Returns True for exactly one worker once every shard of the day is finished: the one that runs the final
+    stages. A final run that didn't finish within lease_seconds (its worker died) can be claimed again."""
+    cur.execute("""
+    INSERT INTO shard_run (run_date, worker) VALUES (%(run_date)s, %(worker)s)
+    ON CONFLICT (run_date) DO UPDATE SET worker = EXCLUDED.worker, started_at = now()
+    WHERE shard_run.finished_at IS NULL AND shard_run.started_at < now() - make_interval(secs => %(lease)s)
+    RETURNING worker;
+    """, {"run_date": run_date, "worker": worker, "lease": lease_seconds})
+    return cur.fetchone() is not None
+
+
+def finish_barrier(cur, run_date, worker):
+    cur.execute("UPDATE shard_run SET finished_at = now() WHERE run_date = %s AND worker = %s;", (run_date, worker))
+
+
+def shard_summary(cur, run_date):
+    cur.execute("SELECT status, COUNT(*) FROM shard_lease WHERE run_date = %s GROUP BY status;", (run_date,))
+    return dict(cur.fetchall())
+
+
+class Heartbeat:
+    """Extends a shard's lease every lease_seconds / 3 from a background thread, on its own connection."""
+
+    def __init__(self, run_date, shard, worker, lease_seconds):
+        self.run_date, self.shard, self.worker, self.lease_seconds = run_date, shard, worker, lease_seconds
+        self.stopped = threading.Event()
+        self.lost = False
+        self.thread = threading.Thread(target=self.run, name=f"heartbeat-{shard}", daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            try:
+                with connection() as conn, conn.cursor() as cur:
+                    if not extend_lease(cur, self.run_date, self.shard, self.worker, self.lease_seconds):
+                        self.lost = True
+                        logger.error(f"Lost the lease of shard {self.shard}, another worker has claimed it")
+                        return
+            except Exception as e:
+                logger.warning(f"Heartbeat of shard {self.shard} failed, retrying: {e}")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
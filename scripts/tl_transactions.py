@@ -1,10 +1,22 @@
-import pandas as pd
+import argparse
+import hashlib
 from io import StringIO
 from pathlib import Path
-from utils.db_connection import connect_db
+import pandas as pd
+from utils.config_loader import CONSTANTS
+from utils.db_connection import connection, require_own_transactions
+from utils import metrics
 from utils.logging_config import logger
 
-logger.info("This script started running.")
+# Imports a Degiro transaction export. The file is read in chunks of transaction_chunk_rows rows, every chunk is
+# COPYed into a temporary staging table and inserted with ON CONFLICT (fingerprint) DO NOTHING, then committed, so
+# memory stays bounded by the chunk size whatever the length of the export. The fingerprint is an md5 over the
+# stored columns of a transaction, backed by a unique index: a transaction that is already in the table (an export
+# imported twice, or overlapping exports of several years) is skipped by an index lookup. A file that was imported
+# completely before is recognised by its checksum in transaction_import and not read at all.
+#
+# The stored columns include Degiro's order ID where the export has one, which tells apart two fills with the same
+# date, time, quantity and price. Without an order ID such fills have the same fingerprint and are loaded once.
 
 # Dynamically determine the base directory (root of the project)
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -21,118 +33,185 @@ LOG_PATH = BASE_DIR / "logs" / "etl.log"
 LOG_DIR = BASE_DIR / "logs"
 DB_CONFIG_PATH = BASE_DIR / "config" / "db_config.json"
 
-
-def clean_transaction(transaction_file_path):
-    df = pd.read_csv(transaction_file_path)
-
-    # Rename columns. Rename unnecceasry columns as 'extracol'
-    df.columns = ['date', 'time', 'extracol1', 'isin', 'extracol2', 'extracol3', 'quantity', 'price', 'extracol4', 'extracol5', 'extracol6', 'value', 'extracol7', 'extracol8', 'fee', 'extracol9', 'extracol10', 'extracol11', 'extracol12']
-    df.drop(columns=[col for col in df.columns if "extracol" in col], inplace=True)
-
-    # Make value in fee absolute number
-    df['fee'] = df['fee'].apply(lambda x: abs(x))
-
+# The columns of the export by position, the header is localised. Unneccessary columns are named 'extracol'
+EXPORT_COLUMNS = ['date', 'time', 'extracol1', 'isin', 'extracol2', 'extracol3', 'quantity', 'price', 'extracol4', 'extracol5', 'extracol6', 'value', 'extracol7', 'extracol8', 'fee', 'extracol9', 'extracol10', 'extracol11', 'order_id']
+EXPORT_DTYPES = {"date": str, "time": str, "isin": str, "quantity": "Int64", "price": float, "value": float, "fee": float,
+                 "order_id": str}
+STAGING_COLUMNS = {
+    "date": "DATE",
+    "time": "TIME WITHOUT TIME ZONE",
+    "isin": "VARCHAR(12)",
+    "quantity": "INT",
+    "price": "NUMERIC(10,2)",
+    "value": "NUMERIC(12,2)",
+    "fee": "NUMERIC(6,2)",
+    "order_id": "VARCHAR(36)", # empty in older exports
+}
+
+
+def fingerprint(alias, isin, columns=STAGING_COLUMNS):
+    """SQL for the fingerprint of a transaction row. The staging table has the types of the transaction table, so
+    a staged row and the stored row hash the same text. concat_ws skips NULLs, a row without an order ID hashes as
+    it did before the order ID was stored."""
+    values = [f"{alias}.{column}" if column != "isin" else isin for column in columns]
+    return f"md5(concat_ws('|', {', '.join(values)}))::uuid"
+
+
+def clean_transaction(df):
     # Drop rows with missing values
-    df.dropna(inplace=True)
-
-    print('Rename and drop columns successfully')
-    logger.info(f"Rename and drop columns successfully")
-
-    df['date'] = pd.to_datetime(df['date'], format='%d-%m-%Y').dt.strftime('%Y-%m-%d')
-    print('convert date successfully')
-    logger.info(f"Convert date successfully")
-    return df
-
-def load_to_staging_transaction_table(conn, cur, dataframe):
-    if conn is None:
-        raise Exception("Failed to connect to database")
-
-    create_staging_table_query = """
-        CREATE TABLE IF NOT EXISTS staging_transaction (
-            id SERIAL PRIMARY KEY, 
-            date DATE NOT NULL, 
-            time TIME WITHOUT TIME ZONE NOT NULL,
-            isin VARCHAR(12), 
-            quantity INT NOT NULL, 
-            price NUMERIC(10,2) NOT NULL, 
-            value numeric(12,2) NOT NULL, 
-            fee numeric(6,2)
-            );
-        """
-    logger.info(f"Loading transactions into staging table")
-    print(f"Loading transactions into staging table.")
-    try:
-        cur.execute(create_staging_table_query)
-        print("The staging_transaction table is created or already created")
-        output = StringIO()
-        dataframe.to_csv(output, sep='\t', index=False, header=False)
-        output.seek(0)
-        cur.copy_from(output, "staging_transaction", null="NULL", columns=('date', 'time', 'isin', 'quantity', 'price', 'value', 'fee'))
-        print('Insert csv data to staging table successfully')
-        conn.commit()
-    except Exception as e:
-        print(f"Error {e}")
-        conn.rollback()
-
-def load_to_transaction_table(conn, cur):
-    if conn is None:
-        print("failed to connect to database")
-        logger.info(f"failed to connect to database")
-        return
-    query = """
-            INSERT INTO transaction (date, time, quantity, price, value, fee, asset_id)
-            SELECT s.date, s.time, s.quantity, s.price, s.value, s.fee, a.asset_id
-            FROM staging_transaction s 
-            JOIN asset a ON s.isin = a.isin
-            WHERE NOT EXISTS ( 
-                SELECT 1 
-                FROM transaction t
-                WHERE t.date = s.date
-                AND t.time = s.time
-                AND t.quantity = s.quantity 
-                AND t.price = s.price 
-                AND t.value = s.value 
-                AND t.fee = s.fee 
-            )
-            And a.asset_id IS NOT NULL;
-            """
-
-    try:
-        cur.execute(query)
-        conn.commit()
-        print("Inserted new records into transaction table successfully.")
-    except Exception as e:
-        print(f"Error {e}")
-        conn.rollback()
-
-def delete_rows_staging(conn, cur):
-    if conn is None:
-        return
+    df = df.dropna(subset=[column for column in df.columns if column != "order_id"])
 
+    # Make value in fee absolute number
+    return df.assign(fee=df['fee'].abs(),
+                     date=pd.to_datetime(df['date'], format='%d-%m-%Y').dt.strftime('%Y-%m-%d'))
+
+
+def read_transactions(transaction_file_path, chunk_rows):
+    """Yields the cleaned export chunk by chunk."""
+    chunks = pd.read_csv(transaction_file_path, header=0, names=EXPORT_COLUMNS, usecols=list(EXPORT_DTYPES),
+                         dtype=EXPORT_DTYPES, chunksize=chunk_rows)
+    for chunk in chunks:
+        yield clean_transaction(chunk[list(STAGING_COLUMNS)])
+
+
+def prepare_transaction_table(cur):
+    """Adds the order_id and fingerprint columns and the fingerprint's unique index to the transaction table,
+    fingerprinting the rows that were loaded before. Of the rows that were loaded twice, the first is kept."""
+    cur.execute("ALTER TABLE transaction ADD COLUMN IF NOT EXISTS order_id VARCHAR(36);")
+    cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'transaction' AND column_name = 'fingerprint';")
+    if cur.fetchone() is None:
+        cur.execute("ALTER TABLE transaction ADD COLUMN fingerprint UUID;")
+        cur.execute(f"""
+        UPDATE transaction t SET fingerprint = {fingerprint('t', 'a.isin')}
+        FROM asset a
+        WHERE a.asset_id = t.asset_id;
+        """)
+        logger.info(f"Fingerprinted {cur.rowcount} existing transactions")
+    # see loader.ensure_unique_key, CREATE INDEX IF NOT EXISTS locks the table even when the index exists
+    cur.execute("SELECT 1 FROM pg_indexes WHERE tablename = 'transaction' AND indexname = 'transaction_fingerprint_key';")
+    if cur.fetchone() is None:
+        # an export imported twice before the fingerprint existed, or fills that can't be told apart without their
+        # order ID. Deleted in the transaction creating the index, which would fail on them
+        cur.execute("""
+        DELETE FROM transaction t
+        USING transaction first
+        WHERE t.fingerprint = first.fingerprint AND t.transaction_id > first.transaction_id;
+        """)
+        if cur.rowcount:
+            logger.warning(f"Deleted {cur.rowcount} transactions with the same fingerprint as an earlier one")
+        cur.execute("CREATE UNIQUE INDEX transaction_fingerprint_key ON transaction (fingerprint);")
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def create_import_table(cur):
     query = """
-        DELETE FROM staging_transaction;
-        """
-    try:
-        cur.execute(query)
-        conn.commit()
-        print("Cleared staging table successfully.")
-    except Exception as e:
-        print(f"Error {e}")
-        conn.rollback()
-
-def main(raw_transaction_file_path):
-    conn, cur = connect_db()
-    if conn is None:
-        print("Failed to connect to database. Exiting.")
-        logger.error("Failed to connect to database. Exiting.")
-        return
+    CREATE TABLE IF NOT EXISTS transaction_import (
+        checksum CHAR(64) PRIMARY KEY,
+        file_name TEXT NOT NULL,
+        rows_read INT NOT NULL,
+        rows_inserted INT NOT NULL,
+        imported_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    """
+    cur.execute(query)
+
+
+def copy_to_staging(cur, chunk):
+    column_definitions = ", ".join(f"{column} {type_}" for column, type_ in STAGING_COLUMNS.items())
+    cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS staging_transaction ({column_definitions}) ON COMMIT DELETE ROWS;")
+    cur.execute("TRUNCATE staging_transaction;")
+    buffer = StringIO()
+    chunk.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cur.copy_expert(f"COPY staging_transaction ({', '.join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def insert_new_transactions(cur):
+    """Inserts the staged transactions that aren't loaded yet. Returns (inserted, unmatched), unmatched being the
+    staged rows whose ISIN is not in the asset table."""
+    # rows loaded before their order ID was stored get it from the staged row, instead of a second row
+    without_order_id = [column for column in STAGING_COLUMNS if column != "order_id"]
+    cur.execute(f"""
+    UPDATE transaction t SET order_id = s.order_id, fingerprint = {fingerprint('s', 's.isin')}
+    FROM staging_transaction s
+    JOIN asset a ON s.isin = a.isin
+    WHERE t.order_id IS NULL AND s.order_id IS NOT NULL
+    AND t.fingerprint = {fingerprint('s', 's.isin', without_order_id)}
+    AND NOT EXISTS (SELECT 1 FROM transaction o WHERE o.fingerprint = {fingerprint('s', 's.isin')});
+    """)
+    cur.execute(f"""
+    WITH inserted AS (
+        INSERT INTO transaction (date, time, quantity, price, value, fee, order_id, asset_id, fingerprint)
+        SELECT s.date, s.time, s.quantity, s.price, s.value, s.fee, s.order_id, a.asset_id, {fingerprint('s', 's.isin')}
+        FROM staging_transaction s
+        JOIN asset a ON s.isin = a.isin
+        ON CONFLICT (fingerprint) DO NOTHING
+        RETURNING 1
+    )
+    SELECT (SELECT COUNT(*) FROM inserted),
+           (SELECT COUNT(*) FROM staging_transaction s WHERE NOT EXISTS (SELECT 1 FROM asset a WHERE a.isin = s.isin));
+    """)
+    return cur.fetchone()
+
+
+@metrics.timed("stage", stage="transactions")
+def main(raw_transaction_file_path=INPUT_PATH):
+    """Imports the export, one committed chunk at a time. Returns the row counts, or None if the import failed
+    (the chunks committed before the error stay loaded, rerunning skips them)."""
+    chunk_rows = CONSTANTS.get("transaction_chunk_rows", 50000)
+    counts = {"read": 0, "inserted": 0, "skipped": 0, "unmatched": 0}
+    checksum = file_checksum(raw_transaction_file_path)
     try:
-        df = clean_transaction(raw_transaction_file_path)
-        load_to_staging_transaction_table(conn, cur, df)
-        load_to_transaction_table(conn, cur)
-        delete_rows_staging(conn, cur)
+        require_own_transactions("transactions")
+        with connection() as conn, conn.cursor() as cur:
+            prepare_transaction_table(cur)
+            create_import_table(cur)
+            conn.commit()
+            cur.execute("SELECT imported_at FROM transaction_import WHERE checksum = %s;", (checksum,))
+            imported = cur.fetchone()
+            if imported is not None:
+                print(f"{raw_transaction_file_path} was already imported on {imported[0]:%Y-%m-%d %H:%M}")
+                logger.info(f"Skipping {raw_transaction_file_path}, already imported on {imported[0]}")
+                return counts
+            for chunk in read_transactions(raw_transaction_file_path, chunk_rows):
+                copy_to_staging(cur, chunk)
+                inserted, unmatched = insert_new_transactions(cur)
+                conn.commit()
+                counts["read"] += len(chunk)
+                counts["inserted"] += inserted
+                counts["unmatched"] += unmatched
+                counts["skipped"] += len(chunk) - inserted - unmatched
+            # with unmatched rows the file is imported again next time, they load once their asset is added
+            if not counts["unmatched"]:
+                cur.execute("""
+                INSERT INTO transaction_import (checksum, file_name, rows_read, rows_inserted) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (checksum) DO NOTHING;
+                """, (checksum, Path(raw_transaction_file_path).name, counts["read"], counts["inserted"]))
     except Exception as e:
         print(f"Error failed to load transactions to db: {e}")
         logger.error(f"Error failed to load transactions to db: {e}")
-        conn.rollback()
-
+        return None
+
+    for action in ("inserted", "skipped"):
+        metrics.increment("rows_loaded", counts[action], table="transaction", action=action)
+    metrics.increment("rows_unmatched", counts["unmatched"], table="transaction")
+    print(f"Inserted {counts['inserted']} of {counts['read']} transactions, {counts['skipped']} already loaded")
+    logger.info(f"Loaded transactions: {counts['read']} read, {counts['inserted']} inserted, "
+                f"{counts['skipped']} already loaded")
+    if counts["unmatched"]:
+        logger.warning(f"{counts['unmatched']} transactions skipped, ISIN not in the asset table")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import a Degiro transaction export.")
+    parser.add_argument("path", type=Path, nargs="?", default=INPUT_PATH)
+    main(parser.parse_args().path)
+    metrics.write_run_report("transactions")
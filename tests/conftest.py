@@ -0,0 +1,30 @@
+import os
+import psycopg2
+import pytest
+from tests.helpers import random_prices
+
+# Fixtures shared by the tests. The tests of the database scripts run in a schema of their own on the database of
+# INVESTASSIST_TEST_DSN and are skipped when it isn't set, the engine tests need no database.
+
+
+@pytest.fixture
+def prices():
+    return random_prices(12, 300)
+
+
+@pytest.fixture
+def db_cursor():
+    """An autocommit cursor whose search_path is a new schema, dropped again after the test."""
+    dsn = os.environ.get("INVESTASSIST_TEST_DSN")
+    if not dsn:
+        pytest.skip("INVESTASSIST_TEST_DSN is not set")
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    schema = f"test_{os.getpid()}"
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA {schema}; SET search_path TO {schema};")
+        try:
+            yield cur
+        finally:
+            cur.execute(f"DROP SCHEMA {schema} CASCADE;")
+    conn.close()
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+
+# Test data shared by the engine tests: random prices of tickers with histories of different lengths and start
+# dates, which the engines' results are compared on with straightforward pandas or loop versions.
+
+
+def random_prices(n_tickers, max_bars, seed=0):
+    """A long OHLCV dataframe (yahoo_ticker, date, close_price, open_price, high_price, low_price, volume)."""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i in range(n_tickers):
+        n_bars = int(rng.integers(max_bars // 2, max_bars + 1))
+        dates = pd.bdate_range(end="2024-06-28", periods=n_bars)
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, n_bars)))
+        spread = close * rng.uniform(0.001, 0.03, n_bars)
+        frames.append(pd.DataFrame({
+            "yahoo_ticker": f"T{i:02d}",
+            "date": dates,
+            "close_price": close,
+            "open_price": close + rng.normal(0, 0.5, n_bars),
+            "high_price": close + spread,
+            "low_price": close - spread,
+            "volume": rng.integers(1000, 100000, n_bars),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def ticker_history(prices, ticker):
+    return prices[prices["yahoo_ticker"] == ticker].sort_values("date").reset_index(drop=True)
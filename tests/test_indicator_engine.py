@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+from tests.helpers import ticker_history
+from scripts.et_indicators import calculate_rsi, calculate_sma, indicators_from_prices
+from utils.indicator_engine import build_panel, compute_indicators, latest_indicators, rolling_mean
+
+
+def ticker_row(panel, ticker, n_bars):
+    """The bars of one ticker in the panel, without the NaN padding on the left."""
+    return list(panel["tickers"]).index(ticker), slice(panel["close_price"].shape[1] - n_bars, None)
+
+
+def test_build_panel_right_aligns_every_ticker(prices):
+    panel = build_panel(prices)
+    for ticker in panel["tickers"]:
+        history = ticker_history(prices, ticker)
+        row, bars = ticker_row(panel, ticker, len(history))
+        np.testing.assert_array_equal(panel["close_price"][row, bars], history["close_price"])
+        assert np.isnan(panel["close_price"][row, :bars.start]).all()
+        assert panel["dates"][row, -1] == np.datetime64(history["date"].iloc[-1], "D")
+
+
+def test_rolling_mean_matches_pandas(prices):
+    panel = build_panel(prices)
+    means = rolling_mean(panel["close_price"], 10)
+    for ticker in panel["tickers"]:
+        history = ticker_history(prices, ticker)
+        row, bars = ticker_row(panel, ticker, len(history))
+        np.testing.assert_allclose(means[row, bars], calculate_sma(history, 10), rtol=1e-10, equal_nan=True)
+
+
+def test_rsi_matches_calculate_rsi_after_the_warm_up(prices):
+    window = 14
+    panel = build_panel(prices)
+    rsi = compute_indicators(panel, window, 5, 10)["rsi"]
+    for ticker in panel["tickers"]:
+        history = ticker_history(prices, ticker)
+        row, bars = ticker_row(panel, ticker, len(history))
+        expected = calculate_rsi(history, window).to_numpy()
+        # the engine needs window price changes, calculate_rsi has its first value one bar earlier
+        assert np.isnan(rsi[row, bars][:window]).all()
+        np.testing.assert_allclose(rsi[row, bars][window:], expected[window:], rtol=1e-10)
+
+
+def test_latest_indicators_from_the_last_window(prices):
+    """The daily run reads only max_calculation_range closes per ticker, which must give the full history's values."""
+    rsi_window, short_window, long_window = 14, 5, 10
+    recent = prices.sort_values("date").groupby("yahoo_ticker").tail(max(rsi_window + 1, long_window))
+    panel = build_panel(recent)
+    latest = latest_indicators(panel, compute_indicators(panel, rsi_window, short_window, long_window))
+    for _, row in latest.iterrows():
+        history = ticker_history(prices, row["yahoo_ticker"])
+        assert np.isclose(row["sma_5"], calculate_sma(history, short_window).iloc[-1])
+        assert np.isclose(row["sma_10"], calculate_sma(history, long_window).iloc[-1])
+        assert np.isclose(row["rsi"], calculate_rsi(history, rsi_window).iloc[-1])
+
+
+def test_empty_universe():
+    panel = build_panel(pd.DataFrame({"yahoo_ticker": [], "date": [], "close_price": []}))
+    assert panel["close_price"].shape == (0, 0)
+    assert indicators_from_prices(pd.DataFrame(columns=["yahoo_ticker", "date", "close_price"])).empty
+
+
+def test_single_bar_has_no_indicators():
+    prices = pd.DataFrame({"yahoo_ticker": ["A"], "date": [pd.Timestamp("2024-06-28")], "close_price": [10.0]})
+    panel = build_panel(prices)
+    latest = latest_indicators(panel, compute_indicators(panel, 14, 5, 10))
+    assert list(latest["yahoo_ticker"]) == ["A"]
+    assert latest[["sma_5", "sma_10", "rsi"]].isna().all(axis=None)
+
+
+def test_missing_close_blanks_the_windows_it_falls_in():
+    close = np.array([[1.0, 2.0, np.nan, 4.0, 5.0, 6.0, 7.0]])
+    np.testing.assert_array_equal(rolling_mean(close, 3), [[np.nan, np.nan, np.nan, np.nan, np.nan, 5.0, 6.0]])
+    assert np.isnan(rolling_mean(close, 8)).all() # longer than the history
+
+
+def test_rsi_of_a_rising_or_flat_close():
+    close = np.array([np.arange(1.0, 17.0), np.full(16, 5.0)])
+    rsi = compute_indicators({"close_price": close}, 14, 5, 10)["rsi"]
+    assert rsi[0, -1] == 100 # no losses
+    assert np.isnan(rsi[1, -1]) # no gains and no losses
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import pytest
+from tests.helpers import random_prices, ticker_history
+from scripts.et_indicators import calculate_rsi
+from utils.indicator_engine import build_panel
+from utils.indicator_library import (PRICE_COLUMNS, VALUE_COLUMNS, check_specs, compute_library, library_bars,
+                                     library_values)
+
+SPECS = [
+    {"name": "sma_20", "kind": "sma", "window": 20},
+    {"name": "ema_12", "kind": "ema", "window": 12},
+    {"name": "macd", "kind": "macd", "fast": 12, "slow": 26, "signal": 9},
+    {"name": "bb_20", "kind": "bollinger", "window": 20, "stddev": 2},
+    {"name": "atr_14", "kind": "atr", "window": 14},
+    {"name": "obv_20", "kind": "obv", "window": 20},
+    {"name": "rsi_7", "kind": "rsi", "window": 7},
+    {"name": "rsi_14", "kind": "rsi", "window": 14, "method": "wilder"},
+]
+
+
+def seeded_ewm(values, window, alpha):
+    """Exponential smoothing seeded with the mean of the first full window, NaN before it."""
+    values = values.reset_index(drop=True)
+    seed_at = values.first_valid_index() + window - 1
+    seeded = values.copy()
+    seeded.iloc[:seed_at] = np.nan
+    seeded.iloc[seed_at] = values.iloc[seed_at - window + 1:seed_at + 1].mean()
+    return seeded.ewm(alpha=alpha, adjust=False).mean()
+
+
+def reference_values(history):
+    """Every output of SPECS for one ticker, with pandas."""
+    close, high, low = history["close_price"], history["high_price"], history["low_price"]
+    line = seeded_ewm(close, 12, 2 / 13) - seeded_ewm(close, 26, 2 / 27)
+    signal = seeded_ewm(line, 9, 2 / 10)
+    middle, width = close.rolling(20).mean(), 2 * close.rolling(20).std(ddof=0)
+    true_range = pd.concat([high - low, (high - close.shift()).abs(), (low - close.shift()).abs()], axis=1).max(axis=1)
+    # the simple RSI starts one bar later than calculate_rsi, see indicator_engine.rsi
+    simple_rsi = calculate_rsi(history, 7)
+    return {
+        "sma_20": close.rolling(20).mean(),
+        "ema_12": seeded_ewm(close, 12, 2 / 13),
+        "macd": line, "macd_signal": signal, "macd_hist": line - signal,
+        "bb_20_upper": middle + width, "bb_20_middle": middle, "bb_20_lower": middle - width,
+        "atr_14": seeded_ewm(true_range, 14, 1 / 14),
+        "obv_20": (np.sign(close.diff()) * history["volume"]).rolling(20).sum(),
+        "rsi_7": simple_rsi.mask(simple_rsi.index < 7),
+        "rsi_14": calculate_rsi(history, 14, "wilder"),
+    }
+
+
+def test_library_matches_pandas(prices):
+    panel = build_panel(prices, PRICE_COLUMNS)
+    values = compute_library(panel, check_specs(SPECS))
+    for ticker in panel["tickers"]:
+        history = ticker_history(prices, ticker)
+        row = list(panel["tickers"]).index(ticker)
+        for name, expected in reference_values(history).items():
+            np.testing.assert_allclose(values[name][row, -len(history):], expected, rtol=1e-9, atol=1e-9,
+                                       equal_nan=True, err_msg=f"{name} of {ticker}")
+
+
+def test_latest_values_from_library_bars_match_the_full_history(prices):
+    """The daily run reads library_bars bars per ticker, the recursive indicators then differ from the full history
+    by less than the weight the older bars would still have."""
+    panel = build_panel(prices, PRICE_COLUMNS)
+    full = library_values(panel, compute_library(panel, SPECS), latest=True).set_index(["yahoo_ticker", "name"])["value"]
+    recent = prices.sort_values("date").groupby("yahoo_ticker").tail(library_bars(SPECS))
+    recent_panel = build_panel(recent, PRICE_COLUMNS)
+    latest = library_values(recent_panel, compute_library(recent_panel, SPECS), latest=True)
+    latest = latest.set_index(["yahoo_ticker", "name"])["value"]
+
+    assert set(latest.index) == set(full.index)
+    relative = ((latest - full.reindex(latest.index)).abs() / full.reindex(latest.index).abs().clip(lower=1)).max()
+    assert relative < 1e-3
+
+
+@pytest.mark.parametrize("specs", [
+    [{"name": "x", "kind": "nope"}],
+    [{"name": "x", "kind": "ema"}],
+    [{"name": "x", "kind": "ema", "window": 3, "span": 1}],
+    [{"name": "x", "kind": "obv"}, {"name": "x", "kind": "obv"}],
+])
+def test_check_specs_rejects_wrong_specs(specs):
+    with pytest.raises(ValueError):
+        check_specs(specs)
+
+
+def test_no_specs(prices):
+    panel = build_panel(prices, PRICE_COLUMNS)
+    assert compute_library(panel, []) == {}
+    assert library_bars([]) == 0
+    assert list(library_values(panel, {}).columns) == VALUE_COLUMNS
+
+
+def test_single_bar_has_no_values(prices):
+    panel = build_panel(prices.groupby("yahoo_ticker").tail(1), PRICE_COLUMNS)
+    assert library_values(panel, compute_library(panel, SPECS)).empty
+
+
+def test_missing_close_leaves_out_the_windowed_values_it_falls_in():
+    history = ticker_history(random_prices(1, 240, seed=7), "T00").tail(120).reset_index(drop=True)
+    history.loc[80, "close_price"] = np.nan
+    panel = build_panel(history, PRICE_COLUMNS)
+    values = compute_library(panel, [{"name": "sma_20", "kind": "sma", "window": 20}])["sma_20"][0]
+    assert np.isnan(values[80:100]).all()
+    assert np.isfinite(values[19:80]).all() and np.isfinite(values[100:]).all()
+
+
+def test_library_values_between_start_and_end(prices):
+    panel = build_panel(prices, PRICE_COLUMNS)
+    values = library_values(panel, compute_library(panel, SPECS), start="2024-03-01", end="2024-03-31")
+    assert not values.empty
+    assert values["date"].between(pd.Timestamp("2024-03-01"), pd.Timestamp("2024-03-31")).all()
+    assert values["value"].notna().all()
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils.indicator_engine import build_panel
+from utils.momentum_engine import HORIZONS, Z_LIMIT, append_bars, momentum_scores, window_bars
+
+
+def close_window(prices, n_bars, tickers=None):
+    """The last n_bars closes of every ticker, padded with NaN on the left like the cached window. With tickers,
+    one row per ticker in that order, NaN for tickers without prices."""
+    panel = build_panel(prices)
+    closes = panel["close_price"][:, -n_bars:]
+    closes = np.pad(closes, ((0, 0), (n_bars - closes.shape[1], 0)), constant_values=np.nan)
+    if tickers is None:
+        return closes
+    rows = {ticker: row for row, ticker in enumerate(panel["tickers"])}
+    return np.array([closes[rows[ticker]] if ticker in rows else np.full(n_bars, np.nan) for ticker in tickers])
+
+
+def test_append_bars_matches_the_window_read_again(prices):
+    n_bars = 40
+    rng = np.random.default_rng(4)
+    tickers = sorted(prices["yahoo_ticker"].unique())
+    counts = rng.integers(0, 6, len(tickers)) # new bars per ticker, some without any
+    counts[0] = 45 # more new bars than the window holds
+
+    prices = prices.sort_values(["yahoo_ticker", "date"])
+    position = prices.groupby("yahoo_ticker").cumcount(ascending=False) # 0 = latest bar
+    new_bars = position < prices["yahoo_ticker"].map(dict(zip(tickers, counts)))
+    cached = close_window(prices[~new_bars], n_bars)
+    new_closes = close_window(prices[new_bars], counts.max(), tickers)
+
+    np.testing.assert_array_equal(append_bars(cached, new_closes, counts), close_window(prices, n_bars))
+
+
+def reference_scores(prices, vol_window, skip_bars, weights):
+    """The momentum model with pandas, ticker by ticker for the returns and volatility."""
+    rows = {}
+    for ticker, history in prices.sort_values("date").groupby("yahoo_ticker"):
+        close = history["close_price"].reset_index(drop=True)
+        end = len(close) - 1 - skip_bars
+        log_returns = np.log(close).diff().iloc[-vol_window:]
+        volatility = log_returns.std() if len(close) > vol_window else np.nan
+        row = {"volatility": volatility}
+        for name, bars in HORIZONS.items():
+            row[f"log_{name}"] = np.log(close[end] / close[end - bars]) if end - bars >= 0 else np.nan
+        rows[ticker] = row
+    frame = pd.DataFrame.from_dict(rows, orient="index")
+
+    weighted = pd.Series(0.0, index=frame.index)
+    total_weight = pd.Series(0.0, index=frame.index)
+    for name, bars in HORIZONS.items():
+        momentum = frame[f"log_{name}"] / (frame["volatility"] * np.sqrt(bars))
+        z = ((momentum - momentum.mean()) / momentum.std(ddof=0)).clip(-Z_LIMIT, Z_LIMIT)
+        weighted += (z * weights[name]).fillna(0)
+        total_weight += z.notna() * weights[name]
+        frame[f"return_{name}"] = np.expm1(frame[f"log_{name}"])
+    frame["momentum"] = (weighted / total_weight).where(total_weight > 0)
+    frame["volatility"] *= np.sqrt(252)
+    frame["score"] = frame["momentum"].rank(pct=True) * 100
+    frame["rank"] = frame["momentum"].rank(ascending=False, method="min")
+    return frame
+
+
+@pytest.mark.parametrize("skip_bars", [0, 5])
+def test_momentum_scores_match_pandas(prices, skip_bars):
+    vol_window = 63
+    weights = {"1m": 1.0, "3m": 2.0, "6m": 1.0, "12m": 0.5}
+    panel = build_panel(prices)
+    closes = close_window(prices, window_bars(vol_window, skip_bars))
+    scores = pd.DataFrame(momentum_scores(closes, vol_window, skip_bars, weights), index=panel["tickers"])
+    expected = reference_scores(prices, vol_window, skip_bars, weights)
+
+    assert scores["return_12m"].isna().any() and scores["return_12m"].notna().any() # some tickers are too short
+    columns = ["return_1m", "return_3m", "return_6m", "return_12m", "volatility", "momentum", "score", "rank"]
+    pd.testing.assert_frame_equal(scores[columns].astype(float), expected[columns].astype(float), rtol=1e-9)
+
+
+def test_append_bars_without_new_bars_keeps_the_window(prices):
+    closes = close_window(prices, 40)
+    new_closes = np.full((len(closes), 3), np.nan)
+    np.testing.assert_array_equal(append_bars(closes, new_closes, np.zeros(len(closes), dtype=int)), closes)
+
+
+def test_momentum_scores_of_an_empty_universe():
+    scores = momentum_scores(np.empty((0, window_bars(63, 0))), 63)
+    assert all(len(values) == 0 for values in scores.values())
+
+
+def test_single_ticker_is_ranked_first():
+    closes = np.exp(np.cumsum(np.random.default_rng(5).normal(0.001, 0.02, window_bars(63, 0))))[None, :]
+    scores = momentum_scores(closes, 63)
+    assert scores["momentum"][0] == 0 # no cross section to compare with
+    assert scores["score"][0] == 100 and scores["rank"][0] == 1
+
+
+def test_flat_or_gapped_closes_have_no_volatility_and_no_momentum():
+    n_bars = window_bars(63, 0)
+    rising = np.exp(np.cumsum(np.random.default_rng(6).normal(0.001, 0.02, n_bars)))
+    gapped = rising.copy()
+    gapped[-10] = np.nan # a missing close in the volatility window
+    scores = momentum_scores(np.array([rising, np.full(n_bars, 50.0), gapped]), 63)
+    assert np.isfinite(scores["volatility"][0]) and np.isfinite(scores["momentum"][0])
+    assert np.isnan(scores["volatility"][1:]).all() and np.isnan(scores["momentum"][1:]).all()
+    assert scores["return_1m"][1] == 0 # the returns don't need the volatility
+    assert list(scores["rank"][1:]) == [pd.NA, pd.NA]
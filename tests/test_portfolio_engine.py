@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils.portfolio_engine import STATE_COLUMNS, daily_positions, transaction_states
+
+
+@pytest.fixture
+def transactions():
+    """Buys and sells of three assets, with positions that are closed and opened again."""
+    rng = np.random.default_rng(2)
+    rows = []
+    for asset_id in (1, 2, 3):
+        held = 0
+        dates = pd.bdate_range("2024-01-02", periods=60)
+        for day in sorted(rng.choice(len(dates), 25)): # some days twice
+            if held and rng.random() < 0.15:
+                quantity = -held # close the position
+            elif held and rng.random() < 0.5:
+                quantity = -int(rng.integers(1, held + 1))
+            else:
+                quantity = int(rng.integers(1, 50))
+            held += quantity
+            rows.append((asset_id, dates[day], quantity, round(rng.uniform(20, 200), 2), round(rng.uniform(0, 3), 2)))
+    return pd.DataFrame(rows, columns=["asset_id", "date", "quantity", "price", "fee"])
+
+
+def reference_states(transactions):
+    """The average cost method, one transaction at a time."""
+    states = []
+    for asset_id, group in transactions.groupby("asset_id", sort=False):
+        held, cost, realized = 0, 0.0, 0.0
+        for count, tx in enumerate(group.itertuples(), start=1):
+            if tx.quantity > 0:
+                cost += tx.quantity * tx.price + tx.fee
+            else:
+                released = cost * -tx.quantity / held
+                realized += -tx.quantity * tx.price - tx.fee - released
+                cost -= released
+            held += tx.quantity
+            if held == 0:
+                cost = 0.0
+            states.append((asset_id, tx.date, held, cost, realized, count))
+    return pd.DataFrame(states, columns=["asset_id", "date", "quantity", "cost_basis", "realized_pnl", "transactions"])
+
+
+def test_transaction_states_match_the_loop(transactions):
+    states = transaction_states(transactions)
+    expected = reference_states(transactions)
+    assert (expected["quantity"] == 0).any() # the fixture closes positions
+    pd.testing.assert_frame_equal(states, expected, check_dtype=False, rtol=1e-9)
+
+
+def test_daily_positions_value_the_position_at_the_end_of_the_day(transactions):
+    states = transaction_states(transactions)
+    rng = np.random.default_rng(3)
+    closes = pd.DataFrame([(asset_id, date, rng.uniform(20, 200)) for asset_id in (1, 2, 3)
+                           for date in pd.bdate_range("2023-12-20", "2024-04-30")],
+                          columns=["asset_id", "date", "close_price"])
+    positions = daily_positions(states, closes)
+
+    expected = []
+    for close in closes.itertuples():
+        held = states[(states["asset_id"] == close.asset_id) & (states["date"] <= close.date)]
+        if held.empty:
+            continue # before the first transaction
+        state = held.iloc[-1]
+        market_value = state["quantity"] * close.close_price
+        expected.append((close.asset_id, close.date, state["quantity"], state["cost_basis"], market_value,
+                         market_value - state["cost_basis"], state["realized_pnl"]))
+    expected = pd.DataFrame(expected, columns=["asset_id", "date", "quantity", "cost_basis", "market_value",
+                                               "unrealized_pnl", "realized_pnl"])
+    pd.testing.assert_frame_equal(positions[expected.columns], expected, check_dtype=False, rtol=1e-9)
+
+
+def test_no_transactions():
+    states = transaction_states(pd.DataFrame(columns=["asset_id", "date", "quantity", "price", "fee"]))
+    assert states.empty and list(states.columns) == STATE_COLUMNS
+
+
+def test_rebuy_after_selling_everything_starts_a_new_cost_basis():
+    transactions = pd.DataFrame({
+        "asset_id": 1,
+        "date": pd.to_datetime(["2024-01-02", "2024-01-03", "2024-01-04", "2024-01-05"]),
+        "quantity": [10, -4, -6, 5],
+        "price": [10.0, 15.0, 20.0, 30.0],
+        "fee": [1.0, 1.0, np.nan, 0.0], # a missing fee is no fee
+    })
+    states = transaction_states(transactions)
+    assert list(states["quantity"]) == [10, 6, 0, 5]
+    np.testing.assert_allclose(states["cost_basis"], [101.0, 60.6, 0.0, 150.0])
+    np.testing.assert_allclose(states["realized_pnl"], [0.0, 18.6, 78.0, 78.0])
+    assert list(states["transactions"]) == [1, 2, 3, 4]
+
+
+def test_daily_positions_take_the_last_transaction_of_the_day():
+    transactions = pd.DataFrame({
+        "asset_id": 1,
+        "date": pd.to_datetime(["2024-01-03", "2024-01-03", "2024-01-03"]),
+        "quantity": [10, 5, -15],
+        "price": [10.0, 12.0, 11.0],
+        "fee": 0.0,
+    })
+    closes = pd.DataFrame({"asset_id": 1, "date": pd.bdate_range("2024-01-02", periods=3), "close_price": [9.0, 11.0, 12.0]})
+    positions = daily_positions(transaction_states(transactions), closes)
+    assert list(positions["date"]) == list(closes["date"][1:]) # nothing held before the first transaction
+    assert list(positions["quantity"]) == [0, 0]
+    assert list(positions["market_value"]) == [0.0, 0.0]
+    np.testing.assert_allclose(positions["realized_pnl"], [5.0, 5.0])
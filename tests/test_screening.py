@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils.screening import HIT_COLUMNS, screen
+
+PARAMETERS = {"rsi_overbought": 70, "rsi_oversold": 30, "rsi_undervalued": 40}
+OVERRIDES = {"T03": {"rsi_oversold": 45}, "T07": {"rsi_overbought": 55, "rsi_oversold": 20}}
+RULES = [
+    {"name": "oversold", "expression": "rsi < rsi_oversold", "show": "rsi"},
+    {"name": "overbought", "expression": "rsi > rsi_overbought", "show": "rsi"},
+    {"name": "undervalued", "expression": "rsi_oversold <= rsi < rsi_undervalued", "show": "rsi"},
+    {"name": "bullish", "expression": "sma_5 > sma_10"},
+    {"name": "dip", "expression": "sma_5 < sma_10 and not rsi > rsi_oversold or abs(sma_5 - sma_10) / sma_10 > 0.02"},
+    {"name": "spread", "expression": "-(sma_5 - sma_10) >= 1.5", "show": "sma_5"},
+]
+
+
+@pytest.fixture
+def indicators():
+    rng = np.random.default_rng(1)
+    n_tickers = 40
+    sma_10 = rng.uniform(50, 150, n_tickers)
+    frame = pd.DataFrame({
+        "date": pd.Timestamp("2024-06-28"),
+        "sma_5": sma_10 * rng.uniform(0.95, 1.05, n_tickers),
+        "sma_10": sma_10,
+        "rsi": rng.uniform(5, 95, n_tickers),
+        "yahoo_ticker": [f"T{i:02d}" for i in range(n_tickers)],
+    })
+    frame.loc[[2, 11], "rsi"] = np.nan # tickers still in their warm-up
+    return frame
+
+
+def reference_hits(indicators, rules, parameters, overrides):
+    """Evaluates every rule with Python's own eval, one ticker at a time."""
+    hits = []
+    for _, row in indicators.iterrows():
+        names = {**row.drop(["date", "yahoo_ticker"]).astype(float).to_dict(), **parameters,
+                 **overrides.get(row["yahoo_ticker"], {})}
+        for rule in rules:
+            if eval(rule["expression"], {"__builtins__": {}, "abs": abs}, names):
+                hits.append((row["yahoo_ticker"], rule["name"], names[rule["show"]] if rule.get("show") else np.nan))
+    return pd.DataFrame(hits, columns=["yahoo_ticker", "rule", "value"])
+
+
+def sorted_hits(hits):
+    return hits[["yahoo_ticker", "rule", "value"]].sort_values(["yahoo_ticker", "rule"], ignore_index=True)
+
+
+@pytest.mark.parametrize("overrides", [{}, OVERRIDES])
+def test_screen_matches_a_row_by_row_eval(indicators, overrides):
+    hits = screen(indicators, RULES, PARAMETERS, overrides)
+    expected = reference_hits(indicators, RULES, PARAMETERS, overrides)
+    assert len(hits) > 0
+    pd.testing.assert_frame_equal(sorted_hits(hits), sorted_hits(expected), check_dtype=False)
+    assert (hits["date"] == pd.Timestamp("2024-06-28")).all()
+
+
+def test_screen_rejects_unsupported_rules(indicators):
+    with pytest.raises(ValueError):
+        screen(indicators, [{"name": "call", "expression": "__import__('os')"}], PARAMETERS)
+    with pytest.raises(ValueError):
+        screen(indicators, [{"name": "unknown", "expression": "rsi < rsi_unknown"}], PARAMETERS)
+    with pytest.raises(ValueError):
+        screen(indicators, RULES, PARAMETERS, {"T01": {"rsi_unknown": 1}})
+
+
+def test_empty_universe_or_no_rules(indicators):
+    assert list(screen(indicators.iloc[:0], RULES, PARAMETERS).columns) == HIT_COLUMNS
+    assert screen(indicators, [], PARAMETERS).empty
+
+
+def test_override_applies_to_its_ticker_only(indicators):
+    indicators["rsi"] = 35.0
+    rules = [{"name": "oversold", "expression": "rsi < rsi_oversold", "show": "rsi"}]
+    hits = screen(indicators, rules, PARAMETERS, {"T05": {"rsi_oversold": 40}, "NOT_IN_UNIVERSE": {"rsi_oversold": 50}})
+    assert list(hits["yahoo_ticker"]) == ["T05"]
+    assert list(hits["value"]) == [35.0]
+
+
+def test_missing_indicator_matches_no_comparison(indicators):
+    indicators["rsi"] = np.nan
+    rules = [{"name": "low", "expression": "rsi < 50"}, {"name": "high", "expression": "rsi >= 50"},
+             {"name": "not_low", "expression": "not rsi < 50"}]
+    hits = screen(indicators, rules, PARAMETERS)
+    assert set(hits["rule"]) == {"not_low"} # like Python, `not` of a failed comparison is True
+    assert hits["value"].isna().all()
@@ -0,0 +1,42 @@
+from datetime import date
+from scripts import shard_lease
+
+RUN_DATE = date(2024, 6, 28)
+MAX_ATTEMPTS = 2
+
+
+def expire_lease(cur, shard):
+    """What the heartbeat stopping looks like: the lease runs out."""
+    cur.execute("UPDATE shard_lease SET leased_until = now() - interval '1 second' WHERE run_date = %s AND shard = %s;",
+                (RUN_DATE, shard))
+
+
+def plan(cur):
+    shard_lease.create_tables(cur)
+    return shard_lease.plan_shards(cur, RUN_DATE, ["A", "B", "C", "D"], 2)
+
+
+def test_shard_abandoned_on_its_last_attempt_is_failed(db_cursor):
+    cur = db_cursor
+    assert plan(cur) == 2
+    for attempt in range(MAX_ATTEMPTS): # the worker dies on every attempt of shard 0
+        assert shard_lease.claim_shard(cur, RUN_DATE, f"w{attempt}", 60, MAX_ATTEMPTS) == (0, ["A", "B"])
+        expire_lease(cur, 0)
+    assert shard_lease.claim_shard(cur, RUN_DATE, "w2", 60, MAX_ATTEMPTS) == (1, ["C", "D"])
+    assert shard_lease.finish_shard(cur, RUN_DATE, 1, "w2", max_attempts=MAX_ATTEMPTS)
+    assert shard_lease.claim_shard(cur, RUN_DATE, "w2", 60, MAX_ATTEMPTS) is None
+
+    assert shard_lease.fail_abandoned_shards(cur, RUN_DATE, MAX_ATTEMPTS) == 1
+    assert shard_lease.unfinished_shards(cur, RUN_DATE, MAX_ATTEMPTS) == 0
+    assert shard_lease.shard_summary(cur, RUN_DATE) == {"done": 1, "failed": 1}
+
+
+def test_live_lease_on_the_last_attempt_is_not_failed(db_cursor):
+    cur = db_cursor
+    plan(cur)
+    shard_lease.claim_shard(cur, RUN_DATE, "w0", 60, MAX_ATTEMPTS)
+    expire_lease(cur, 0)
+    shard_lease.claim_shard(cur, RUN_DATE, "w1", 60, MAX_ATTEMPTS) # last attempt, still running
+
+    assert shard_lease.fail_abandoned_shards(cur, RUN_DATE, MAX_ATTEMPTS) == 0
+    assert shard_lease.unfinished_shards(cur, RUN_DATE, MAX_ATTEMPTS) == 2 # shard 0 leased, shard 1 pending
@@ -14,5 +14,54 @@ def load_constants():
         return json.load(f)
 
 
-# Load constants once to use across scripts
-CONSTANTS = load_constants()
\ No newline at end of file
+def load_tickers(tickers_path):
+    """Loads the list of tracked tickers, without duplicates. tickers_path can also be a list of tickers already,
+    e.g. the shard a worker claimed."""
+    if isinstance(tickers_path, (list, tuple)):
+        tickers = tickers_path
+    else:
+        with tickers_path.open("r") as f:
+            tickers = json.load(f)["tickers"]
+    return list(dict.fromkeys(tickers))
+
+
+class Constants(dict):
+    """constants.json as a dict that is only read on first use, so importing a module doesn't read config files."""
+    loaded = False
+
+    def load(self):
+        if not self.loaded:
+            self.loaded = True
+            # values set before the first read (e.g. by the benchmarks) win over the file
+            overrides = dict(super().items())
+            super().update(load_constants())
+            super().update(overrides)
+        return self
+
+    def __getitem__(self, key):
+        return super(Constants, self.load()).__getitem__(key)
+
+    def __contains__(self, key):
+        return super(Constants, self.load()).__contains__(key)
+
+    def __iter__(self):
+        return super(Constants, self.load()).__iter__()
+
+    def __len__(self):
+        return super(Constants, self.load()).__len__()
+
+    def get(self, key, default=None):
+        return super(Constants, self.load()).get(key, default)
+
+    def keys(self):
+        return super(Constants, self.load()).keys()
+
+    def items(self):
+        return super(Constants, self.load()).items()
+
+    def values(self):
+        return super(Constants, self.load()).values()
+
+
+# Shared by all scripts, read from constants.json on first use
+CONSTANTS = Constants()
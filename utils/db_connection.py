@@ -1,10 +1,19 @@
 import json
+import os
+import threading
+import time
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 from pathlib import Path
+from utils import metrics
+from utils.config_loader import CONSTANTS
 from utils.logging_config import logger  # Import logger from centralized logging
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 DB_CONFIG_PATH = BASE_DIR / "config" / "db_config.json"
+DB_DSN_ENV = "INVESTASSIST_DB_DSN" # when set, the pool connects to this DSN instead of db_config.json
 
 def load_config_as_dict(config_path):
     """Loads database config from a JSON file."""
@@ -14,11 +23,36 @@ def load_config_as_dict(config_path):
     with config_path.open("r") as f:
         return json.load(f)
 
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Counts and times every round trip to the server as the db_query metric."""
+    def execute(self, query, vars=None):
+        with metrics.timer("db_query", kind="execute"):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with metrics.timer("db_query", kind="executemany"):
+            return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        with metrics.timer("db_query", kind="copy"):
+            return super().copy_expert(sql, file, size)
+
+    def copy_from(self, file, table, *args, **kwargs):
+        with metrics.timer("db_query", kind="copy"):
+            return super().copy_from(file, table, *args, **kwargs)
+
+    def fetchmany(self, size=None):
+        if self.name is None: # client side cursors already hold all rows
+            return super().fetchmany(size) if size is not None else super().fetchmany()
+        with metrics.timer("db_query", kind="fetch"):
+            return super().fetchmany(size) if size is not None else super().fetchmany()
+
+
 def connect_db(config_path=DB_CONFIG_PATH):
     """Establishes a database connection using credentials from a JSON config."""
     params = load_config_as_dict(config_path)
     try:
-        conn = psycopg2.connect(**params)
+        conn = psycopg2.connect(**params, cursor_factory=InstrumentedCursor)
         cur = conn.cursor()
         logger.info("Connected to the database successfully.")
         return conn, cur
@@ -26,3 +60,219 @@ def connect_db(config_path=DB_CONFIG_PATH):
         logger.error(f"Database connection failed: {e}")
         return None, None
 
+
+# Connection pool shared by all pipeline stages. Use connection() / cursor() instead of connect_db() so a run
+# reuses the same few connections instead of opening one per stage.
+_pool = None
+_pool_slots = None # bounds the checkouts, so callers wait for a free connection instead of getting a PoolError
+_pool_lock = threading.Lock()
+_run_conn = None # the connection pinned by run_transaction()
+
+POOL_STATS = {
+    "connections_opened": 0,
+    "connect_seconds": 0.0,
+    "checkouts": 0,
+    "wait_seconds": 0.0,
+    "health_check_failures": 0,
+}
+_stats_lock = threading.Lock() # the streaming stages and the lease heartbeats check out connections concurrently
+
+
+def count(stat, value=1):
+    with _stats_lock:
+        POOL_STATS[stat] += value
+
+
+class PipelineConnection(psycopg2.extensions.connection):
+    """A connection whose commit() can be deferred to the end of the run by run_transaction()."""
+    deferred = False
+    run_failed = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = InstrumentedCursor
+
+    def commit(self):
+        if not self.deferred:
+            super().commit()
+
+    def rollback(self):
+        if self.deferred:
+            self.run_failed = True # a stage gave up, the whole run has to be rolled back
+        super().rollback()
+
+
+class TimedConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    def _connect(self, key=None):
+        start = time.perf_counter()
+        conn = super()._connect(key)
+        count("connections_opened")
+        count("connect_seconds", time.perf_counter() - start)
+        return conn
+
+
+def get_pool(config_path=DB_CONFIG_PATH):
+    """Creates the pool on first use. Raises if the database can't be reached."""
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is None:
+            dsn = os.environ.get(DB_DSN_ENV)
+            params = {"dsn": dsn} if dsn else load_config_as_dict(config_path)
+            statement_timeout_ms = CONSTANTS.get("db_statement_timeout_ms", 0)
+            if statement_timeout_ms:
+                params["options"] = f"{params.get('options', '')} -c statement_timeout={statement_timeout_ms}".strip()
+            max_connections = CONSTANTS.get("db_pool_max_connections", 4)
+            _pool = TimedConnectionPool(CONSTANTS.get("db_pool_min_connections", 1), max_connections,
+                                        connection_factory=PipelineConnection, **params)
+            _pool_slots = threading.BoundedSemaphore(max_connections)
+            logger.info(f"Created database connection pool with up to {max_connections} connections.")
+    return _pool
+
+
+def is_healthy(conn):
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        conn.rollback() # don't leave the health check's transaction open
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def checkout():
+    """Takes a healthy connection from the pool, waiting for one to be returned if all are in use."""
+    pool = get_pool()
+    start = time.perf_counter()
+    _pool_slots.acquire()
+    count("wait_seconds", time.perf_counter() - start)
+    count("checkouts")
+    try:
+        conn = pool.getconn()
+        if not is_healthy(conn):
+            count("health_check_failures")
+            logger.warning("Discarding a broken pooled connection.")
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        return conn
+    except Exception:
+        _pool_slots.release()
+        raise
+
+
+def release(conn):
+    try:
+        get_pool().putconn(conn, close=conn.closed != 0)
+    finally:
+        _pool_slots.release()
+
+
+@contextmanager
+def connection():
+    """Checks out a pooled connection, commits when the block succeeds and rolls back when it raises.
+    Inside run_transaction() the run's connection is handed out instead and committing is left to the run."""
+    if _run_conn is not None:
+        try:
+            yield _run_conn
+        except Exception:
+            _run_conn.run_failed = True
+            raise
+        return
+    conn = checkout()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        release(conn)
+
+
+@contextmanager
+def cursor():
+    """A cursor on a pooled connection, see connection()."""
+    with connection() as conn:
+        with conn.cursor() as cur:
+            yield cur
+
+
+def in_run_transaction():
+    """True inside run_transaction(): commit() is deferred to the end of the run and rollback() discards every stage
+    of the run so far."""
+    return _run_conn is not None
+
+
+def require_own_transactions(stage):
+    """For stages that commit as they go (a chunk at a time, to be restartable), which run_transaction() would turn
+    into one transaction."""
+    if in_run_transaction():
+        raise RuntimeError(f"{stage} commits chunk by chunk and can't run inside run_transaction()")
+
+
+@contextmanager
+def run_transaction():
+    """One transaction per run: every connection() inside the block shares one connection whose commits are
+    deferred until the block ends. If any stage rolled back, the whole run is rolled back."""
+    global _run_conn
+    conn = checkout()
+    conn.deferred, conn.run_failed = True, False
+    _run_conn = conn
+    try:
+        yield conn
+        if conn.run_failed:
+            raise RuntimeError("A stage rolled back, rolling back the whole run.")
+        conn.deferred = False
+        conn.commit()
+        logger.info("Committed the run transaction.")
+    except Exception:
+        conn.deferred = False
+        if not conn.closed:
+            conn.rollback()
+        logger.error("Rolled back the run transaction.")
+        raise
+    finally:
+        _run_conn = None
+        conn.deferred = False
+        release(conn)
+
+
+def pool_stats():
+    with _stats_lock:
+        return dict(POOL_STATS)
+
+
+def log_pool_stats():
+    stats = pool_stats()
+    for name, value in stats.items():
+        metrics.set_gauge(f"db_pool_{name}", value)
+    logger.info(f"Database pool: {stats['connections_opened']} connections opened in {stats['connect_seconds']:.2f}s, "
+                f"{stats['checkouts']} checkouts, {stats['wait_seconds']:.2f}s waiting for a free connection, "
+                f"{stats['health_check_failures']} broken connections replaced.")
+    return stats
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def fetch_columns(conn, query, params, columns, cursor_name="stream", chunk_size=10000):
+    """Runs a query through a server side cursor and collects the rows into one list per column.
+    Rows arrive from the server in chunks of chunk_size, so a large result is never held twice in memory."""
+    data = {column: [] for column in columns}
+    with conn.cursor(name=cursor_name) as cur: # named cursor = server side cursor
+        cur.itersize = chunk_size
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            for column, values in zip(columns, zip(*rows)):
+                data[column].extend(values)
+    return data
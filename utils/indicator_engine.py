@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+
+# The engine works on a ticker x bar panel: one row per ticker, one column per trading bar.
+# Rows are right aligned so the last column always holds each ticker's latest bar, and shorter histories are
+# padded with NaN on the left. Aligning on bars instead of calendar dates keeps the windows correct for assets
+# trading on exchanges with different public holidays.
+
+
+def build_panel(prices, columns=("close_price",)):
+    """Turns a long dataframe (yahoo_ticker, date, <columns>) into a right aligned ticker x bar panel."""
+    prices = prices.sort_values(["yahoo_ticker", "date"], kind="stable")
+    codes, tickers = pd.factorize(prices["yahoo_ticker"], sort=True)
+    counts = np.bincount(codes, minlength=len(tickers))
+    n_tickers, n_bars = len(tickers), (int(counts.max()) if len(counts) else 0)
+
+    # position of every row inside its ticker, shifted so each ticker ends in the last column
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+    bar = n_bars - counts[codes] + (np.arange(len(codes)) - starts[codes])
+
+    panel = {
+        "tickers": np.asarray(tickers, dtype=object),
+        "dates": np.full((n_tickers, n_bars), np.datetime64("NaT"), dtype="datetime64[D]"),
+    }
+    panel["dates"][codes, bar] = pd.to_datetime(prices["date"]).to_numpy().astype("datetime64[D]")
+    for column in columns:
+        panel[column] = np.full((n_tickers, n_bars), np.nan)
+        panel[column][codes, bar] = prices[column].to_numpy(dtype=float)
+    return panel
+
+
+def rolling_mean(values, window):
+    """Rolling mean along the bar axis for every ticker at once. NaN until a full window of values is available."""
+    out = np.full(values.shape, np.nan)
+    if window > values.shape[1]:
+        return out
+    valid = ~np.isnan(values)
+    value_sums = np.cumsum(np.where(valid, values, 0.0), axis=1)
+    valid_counts = np.cumsum(valid, axis=1)
+
+    # sum over the window = cumulative sum at the end minus cumulative sum just before the start
+    window_sums = value_sums[:, window - 1:].copy()
+    window_sums[:, 1:] -= value_sums[:, :-window]
+    window_counts = valid_counts[:, window - 1:].copy()
+    window_counts[:, 1:] -= valid_counts[:, :-window]
+
+    out[:, window - 1:] = np.where(window_counts == window, window_sums / window, np.nan)
+    return out
+
+
+def price_changes(close):
+    """Bar to bar change of the close, NaN for the first bar of every ticker."""
+    delta = np.full(close.shape, np.nan)
+    delta[:, 1:] = close[:, 1:] - close[:, :-1]
+    return delta
+
+
+def rsi(close, window):
+    """The formula of et_indicators.calculate_rsi over the whole panel, but with a different warm-up: the first
+    value needs `window` real price changes, i.e. window + 1 closes. calculate_rsi counts the missing change before
+    the first close as 0 and so returns a value one bar earlier, from `window` closes. With a full window of changes
+    both agree, which is why indicator_config reads rsi_window + 1 closes per ticker."""
+    delta = price_changes(close)
+    avg_gain = rolling_mean(np.clip(delta, 0, None), window)
+    avg_loss = rolling_mean(np.clip(-delta, 0, None), window)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rs = avg_gain / avg_loss
+        return 100 - (100 / (1 + rs))
+
+
+def compute_indicators(panel, rsi_window, short_sma_window, long_sma_window):
+    """Computes RSI and both SMAs for every ticker and bar of the panel in one pass."""
+    close = panel["close_price"]
+    return {
+        "sma_5": rolling_mean(close, short_sma_window),
+        "sma_10": rolling_mean(close, long_sma_window),
+        "rsi": rsi(close, rsi_window),
+    }
+
+
+def latest_indicators(panel, indicators):
+    """Builds the indicators frame (one row per ticker, its latest bar) that is written to indicators.csv."""
+    return pd.DataFrame({
+        "date": panel["dates"][:, -1],
+        "sma_5": indicators["sma_5"][:, -1],
+        "sma_10": indicators["sma_10"][:, -1],
+        "rsi": indicators["rsi"][:, -1],
+        "yahoo_ticker": panel["tickers"],
+    })
+
+
+def indicator_history(panel, indicators, start=None, end=None):
+    """Builds the full indicators time series (one row per ticker and bar) for the bars between start and end.
+    Bars without any indicator value, e.g. the warm-up at the start of a history, are left out."""
+    dates = panel["dates"]
+    keep = ~np.isnat(dates)
+    if start is not None:
+        keep &= dates >= np.datetime64(start, "D")
+    if end is not None:
+        keep &= dates <= np.datetime64(end, "D")
+    keep &= ~(np.isnan(indicators["sma_5"]) & np.isnan(indicators["sma_10"]) & np.isnan(indicators["rsi"]))
+
+    rows, bars = np.nonzero(keep)
+    return pd.DataFrame({
+        "date": dates[rows, bars],
+        "sma_5": indicators["sma_5"][rows, bars],
+        "sma_10": indicators["sma_10"][rows, bars],
+        "rsi": indicators["rsi"][rows, bars],
+        "yahoo_ticker": panel["tickers"][rows],
+    })
@@ -0,0 +1,216 @@
+import inspect
+import math
+import numpy as np
+import pandas as pd
+from utils.indicator_engine import price_changes, rolling_mean
+
+# The indicators declared in constants.json (indicator_library), e.g.
+#   {"name": "macd", "kind": "macd", "fast": 12, "slow": 26, "signal": 9}
+# computed over the OHLCV panel of utils/indicator_engine.py in one pass. Every kind is a function registered in
+# INDICATORS that takes the pass's inputs and its parameters and returns its output arrays. Intermediate results
+# (the price changes, the true range, a rolling mean, an EMA of the close, ...) are computed through shared() and
+# memoized by key for the pass, so macd and an ema_12 share the EMA of the close, bollinger and an sma_20 the
+# rolling mean, and every indicator the price changes.
+#
+# An indicator with several outputs stores them as <name>_<output> (bb_20_upper, macd_signal), the main output as
+# <name>. The values are stored one row per asset, date and name (indicator_value), so declaring another indicator
+# needs neither a new column nor another read of the prices.
+
+PRICE_COLUMNS = ("close_price", "high_price", "low_price", "volume")
+VALUE_COLUMNS = ["date", "name", "value", "yahoo_ticker"]
+WARMUP_WEIGHT = 1e-3 # recursive indicators read bars until the bars before them weigh less than this
+
+INDICATORS = {} # kind -> {"compute", "bars", "outputs"}
+
+
+def register(kind, bars, outputs=("",)):
+    """Registers the function computing an indicator kind. bars(**params) is the number of bars its latest value
+    needs, outputs the suffixes of its output arrays ("" is the main one)."""
+    def decorator(compute):
+        INDICATORS[kind] = {"compute": compute, "bars": bars, "outputs": outputs}
+        return compute
+    return decorator
+
+
+def shared(inputs, key, compute):
+    """An intermediate result shared by the indicators of a pass, computed the first time it's asked for."""
+    if key not in inputs:
+        inputs[key] = compute()
+    return inputs[key]
+
+
+def smooth(values, window, alpha):
+    """Exponential smoothing seeded with the mean of the first window values, NaN before. EMA and Wilder smoothing
+    differ only in alpha."""
+    seed = rolling_mean(values, window)
+    out = np.full(values.shape, np.nan)
+    state = np.full(len(values), np.nan)
+    for bar in range(values.shape[1]):
+        state = np.where(np.isnan(state), seed[:, bar], state + alpha * (values[:, bar] - state))
+        out[:, bar] = state
+    return out
+
+
+def smooth_bars(window, alpha):
+    return window + math.ceil(math.log(WARMUP_WEIGHT) / math.log(1 - alpha))
+
+
+def ema_alpha(window):
+    return 2 / (window + 1)
+
+
+def close_mean(inputs, window):
+    return shared(inputs, ("mean", "close", window), lambda: rolling_mean(inputs["close_price"], window))
+
+
+def close_ema(inputs, window):
+    return shared(inputs, ("ema", "close", window), lambda: smooth(inputs["close_price"], window, ema_alpha(window)))
+
+
+def changes(inputs):
+    return shared(inputs, ("changes",), lambda: price_changes(inputs["close_price"]))
+
+
+def true_range(inputs):
+    def compute():
+        high, low = inputs["high_price"], inputs["low_price"]
+        previous_close = inputs["close_price"] - changes(inputs)
+        # fmax skips the NaN previous close of the first bar, whose true range is its high - low
+        return np.fmax(high - low, np.fmax(np.abs(high - previous_close), np.abs(low - previous_close)))
+    return shared(inputs, ("true_range",), compute)
+
+
+@register("sma", bars=lambda window: window)
+def sma(inputs, window):
+    return {"": close_mean(inputs, window)}
+
+
+@register("ema", bars=lambda window: smooth_bars(window, ema_alpha(window)))
+def ema(inputs, window):
+    return {"": close_ema(inputs, window)}
+
+
+def rsi_bars(window, method="simple"):
+    return window + 1 if method == "simple" else smooth_bars(window, 1 / window) + 1
+
+
+@register("rsi", bars=rsi_bars)
+def rsi(inputs, window, method="simple"):
+    """Same formulas as et_indicators.calculate_rsi. The simple method has the warm-up of indicator_engine.rsi,
+    its first value one bar after calculate_rsi's, the wilder method starts on the same bar."""
+    delta = changes(inputs)
+    gain = shared(inputs, ("gain",), lambda: np.clip(delta, 0, None))
+    loss = shared(inputs, ("loss",), lambda: np.clip(-delta, 0, None))
+    if method == "wilder":
+        # the first change is NaN, seeding at the first full window skips it like wilder_smoothing does
+        avg_gain = shared(inputs, ("wilder", "gain", window), lambda: smooth(gain, window, 1 / window))
+        avg_loss = shared(inputs, ("wilder", "loss", window), lambda: smooth(loss, window, 1 / window))
+    else:
+        avg_gain = shared(inputs, ("mean", "gain", window), lambda: rolling_mean(gain, window))
+        avg_loss = shared(inputs, ("mean", "loss", window), lambda: rolling_mean(loss, window))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {"": 100 - (100 / (1 + avg_gain / avg_loss))}
+
+
+def macd_bars(fast=12, slow=26, signal=9):
+    # the signal line smooths the macd line, which starts once the slower EMA does
+    line_bars = max(smooth_bars(fast, ema_alpha(fast)), smooth_bars(slow, ema_alpha(slow)))
+    return line_bars + smooth_bars(signal, ema_alpha(signal))
+
+
+@register("macd", bars=macd_bars, outputs=("", "signal", "hist"))
+def macd(inputs, fast=12, slow=26, signal=9):
+    line = close_ema(inputs, fast) - close_ema(inputs, slow)
+    signal_line = smooth(line, signal, ema_alpha(signal))
+    return {"": line, "signal": signal_line, "hist": line - signal_line}
+
+
+@register("bollinger", bars=lambda window=20, stddev=2: window, outputs=("upper", "middle", "lower"))
+def bollinger(inputs, window=20, stddev=2):
+    middle = close_mean(inputs, window)
+    squares = shared(inputs, ("mean", "close_squared", window),
+                     lambda: rolling_mean(inputs["close_price"] ** 2, window))
+    # population standard deviation of the window, clipped at 0 against rounding
+    width = stddev * np.sqrt(np.clip(squares - middle ** 2, 0, None))
+    return {"upper": middle + width, "middle": middle, "lower": middle - width}
+
+
+@register("atr", bars=lambda window=14: smooth_bars(window, 1 / window) + 1)
+def atr(inputs, window=14):
+    average = shared(inputs, ("wilder", "true_range", window), lambda: smooth(true_range(inputs), window, 1 / window))
+    return {"": average}
+
+
+@register("obv", bars=lambda window=20: window + 1)
+def obv(inputs, window=20):
+    """On balance volume over the last window bars: the volume of the up bars minus the volume of the down bars.
+    The classic OBV sums over the whole history, which makes its level depend on where the history starts."""
+    signed_volume = shared(inputs, ("signed_volume",), lambda: np.sign(changes(inputs)) * inputs["volume"])
+    return {"": shared(inputs, ("mean", "signed_volume", window), lambda: rolling_mean(signed_volume, window)) * window}
+
+
+def check_specs(specs):
+    """Raises ValueError for an indicator of an unknown kind, with unknown parameters or a duplicate name."""
+    names = set()
+    for spec in specs:
+        kind, name = spec.get("kind"), spec.get("name")
+        if kind not in INDICATORS:
+            raise ValueError(f"Unknown indicator kind {kind!r} of {name!r}, expected one of {sorted(INDICATORS)}")
+        if not name or name in names:
+            raise ValueError(f"Every indicator needs a unique name, got {name!r}")
+        names.add(name)
+        try:
+            inspect.signature(INDICATORS[kind]["compute"]).bind(None, **parameters(spec))
+        except TypeError as e:
+            raise ValueError(f"Wrong parameters for indicator {name!r}: {e}") from None
+    return specs
+
+
+def parameters(spec):
+    return {key: value for key, value in spec.items() if key not in ("name", "kind")}
+
+
+def output_names(spec):
+    return [f"{spec['name']}_{suffix}" if suffix else spec["name"] for suffix in INDICATORS[spec["kind"]]["outputs"]]
+
+
+def library_bars(specs):
+    """The number of bars the latest value of every indicator needs."""
+    return max((INDICATORS[spec["kind"]]["bars"](**parameters(spec)) for spec in specs), default=0)
+
+
+def compute_library(panel, specs):
+    """Computes the indicators over a panel with PRICE_COLUMNS. Returns {output name: ticker x bar array}."""
+    inputs = {column: panel[column] for column in PRICE_COLUMNS if column in panel}
+    values = {}
+    for spec in specs:
+        outputs = INDICATORS[spec["kind"]]["compute"](inputs, **parameters(spec))
+        for suffix, name in zip(INDICATORS[spec["kind"]]["outputs"], output_names(spec)):
+            values[name] = outputs[suffix]
+    return values
+
+
+def library_values(panel, values, start=None, end=None, latest=False):
+    """The indicator values as a long dataframe (date, name, value, yahoo_ticker), of the bars between start and
+    end or, with latest, of every ticker's latest bar. NaN values (the warm-up) are left out."""
+    bars_kept = slice(-1, None) if latest else slice(None)
+    dates = panel["dates"][:, bars_kept]
+    keep = ~np.isnat(dates)
+    if start is not None:
+        keep &= dates >= np.datetime64(start, "D")
+    if end is not None:
+        keep &= dates <= np.datetime64(end, "D")
+
+    frames = []
+    for name, array in values.items():
+        array = array[:, bars_kept]
+        rows, bars = np.nonzero(keep & ~np.isnan(array))
+        frames.append(pd.DataFrame({
+            "date": dates[rows, bars],
+            "name": name,
+            "value": array[rows, bars],
+            "yahoo_ticker": panel["tickers"][rows],
+        }))
+    if not frames:
+        return pd.DataFrame(columns=VALUE_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,81 @@
+import math
+
+# Per asset indicator state, so a new bar can be added in constant time instead of recomputing from raw closes.
+# A state is a plain dict that maps 1:1 onto a row of the indicator_state table:
+#   date        date of the last bar applied
+#   closes      the last few closes, enough to drop the value leaving any window
+#   short_sum   sum of the last short_sma_window closes
+#   long_sum    sum of the last long_sma_window closes
+#   avg_gain    average gain over the RSI window (None until the first full window)
+#   avg_loss    average loss over the RSI window (None until the first full window)
+#   n_changes   number of price changes seen so far, used to seed the RSI averages
+#   rsi_method  "simple" (rolling mean, same as calculate_rsi) or "wilder" (Wilder smoothing)
+
+RSI_METHODS = ("simple", "wilder")
+
+
+def new_state(rsi_method="simple"):
+    if rsi_method not in RSI_METHODS:
+        raise ValueError(f"Unknown rsi_method {rsi_method}, expected one of {RSI_METHODS}")
+    return {
+        "date": None,
+        "closes": [],
+        "short_sum": 0.0,
+        "long_sum": 0.0,
+        "avg_gain": None,
+        "avg_loss": None,
+        "n_changes": 0,
+        "rsi_method": rsi_method,
+    }
+
+
+def closes_to_keep(rsi_window, short_sma_window, long_sma_window):
+    # one more than the largest window, so the close (or price change) leaving each window is still available
+    return max(short_sma_window, long_sma_window, rsi_window + 1) + 1
+
+
+def update_state(state, bar_date, close, rsi_window, short_sma_window, long_sma_window):
+    """Applies one new bar to the state in place and returns the indicators for that bar."""
+    closes = state["closes"]
+    closes.append(float(close))
+
+    # SMAs: add the new close, drop the one that just left the window
+    state["short_sum"] += closes[-1] - (closes[-short_sma_window - 1] if len(closes) > short_sma_window else 0.0)
+    state["long_sum"] += closes[-1] - (closes[-long_sma_window - 1] if len(closes) > long_sma_window else 0.0)
+
+    # RSI: average gain and loss over the last rsi_window price changes
+    if len(closes) >= 2:
+        state["n_changes"] += 1
+        change = closes[-1] - closes[-2]
+        if state["n_changes"] == rsi_window:
+            # seed both methods with the plain mean of the first full window
+            changes = [closes[i] - closes[i - 1] for i in range(len(closes) - rsi_window, len(closes))]
+            state["avg_gain"] = sum(max(c, 0.0) for c in changes) / rsi_window
+            state["avg_loss"] = sum(max(-c, 0.0) for c in changes) / rsi_window
+        elif state["n_changes"] > rsi_window:
+            if state["rsi_method"] == "wilder":
+                state["avg_gain"] = (state["avg_gain"] * (rsi_window - 1) + max(change, 0.0)) / rsi_window
+                state["avg_loss"] = (state["avg_loss"] * (rsi_window - 1) + max(-change, 0.0)) / rsi_window
+            else:
+                old_change = closes[-rsi_window - 1] - closes[-rsi_window - 2]
+                state["avg_gain"] += (max(change, 0.0) - max(old_change, 0.0)) / rsi_window
+                state["avg_loss"] += (max(-change, 0.0) - max(-old_change, 0.0)) / rsi_window
+
+    del closes[:-closes_to_keep(rsi_window, short_sma_window, long_sma_window)]
+    state["date"] = bar_date
+    return state_indicators(state, short_sma_window, long_sma_window)
+
+
+def state_indicators(state, short_sma_window, long_sma_window):
+    """Reads the current SMA and RSI values out of a state. Values without a full window are NaN."""
+    n_closes = len(state["closes"])
+    short_sma = state["short_sum"] / short_sma_window if n_closes >= short_sma_window else math.nan
+    long_sma = state["long_sum"] / long_sma_window if n_closes >= long_sma_window else math.nan
+    avg_gain, avg_loss = state["avg_gain"], state["avg_loss"]
+    if avg_gain is None:
+        rsi = math.nan
+    elif avg_loss == 0:
+        rsi = 100.0 if avg_gain > 0 else math.nan # same as calculate_rsi: gain / 0 -> 100, 0 / 0 -> NaN
+    else:
+        rsi = 100 - (100 / (1 + avg_gain / avg_loss))
+    return {"sma_5": short_sma, "sma_10": long_sma, "rsi": rsi}
@@ -1,6 +1,7 @@
 import json
 import logging
 import logging.config
+import threading
 from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
 from pathlib import Path
 
@@ -17,14 +18,13 @@ def load_config():
     with LOG_CONFIG_PATH.open("r") as f:
         return json.load(f)
 
-def setup_logging():
-    """Sets up logging with rotation support."""
-    config = load_config()
-
+def build_handler(config):
+    """Builds the log file handler with rotation support."""
     # Get log rotation settings
     rotation = config.get("rotation", {})
     rotation_type = rotation.get("type", "time")  # Default: time-based rotation
 
+    LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
     if rotation_type == "size":
         handler = RotatingFileHandler(
             str(LOG_PATH),
@@ -41,16 +41,40 @@ def setup_logging():
 
     # Set formatter
     log_format = config.get("format", "%(asctime)s - %(levelname)s - %(message)s")
-    formatter = logging.Formatter(log_format)
-    handler.setFormatter(formatter)
+    handler.setFormatter(logging.Formatter(log_format))
+    handler.setLevel(config.get("log_level", "INFO").upper())
+    return handler
 
-    # Set up logger
-    logger = logging.getLogger("investassist")
-    logger.setLevel(config.get("log_level", "INFO").upper())
-    logger.addHandler(handler)
 
+class DeferredFileHandler(logging.Handler):
+    """Reads the logging config and opens the log file on the first record instead of at import, so importing a
+    module doesn't touch the file system."""
+    def __init__(self):
+        super().__init__()
+        self.handler = None
+        self.setup_lock = threading.Lock()
+
+    def emit(self, record):
+        if self.handler is None:
+            with self.setup_lock:
+                if self.handler is None:
+                    self.handler = build_handler(load_config())
+        if record.levelno >= self.handler.level:
+            self.handler.handle(record)
+
+    def close(self):
+        if self.handler is not None:
+            self.handler.close()
+        super().close()
+
+
+def setup_logging():
+    """Sets up logging with rotation support."""
+    logger = logging.getLogger("investassist")
+    if not any(isinstance(handler, DeferredFileHandler) for handler in logger.handlers):
+        logger.setLevel(logging.DEBUG) # the file handler filters by the configured log_level
+        logger.addHandler(DeferredFileHandler())
     return logger
 
 # Initialize logger once
 logger = setup_logging()
-logger.info("Logging initialized.")
\ No newline at end of file
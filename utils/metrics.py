@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+from utils.logging_config import logger
+
+# Run metrics shared by all scripts: counters (rows, retries, round trips), timers (stages, requests, queries) and
+# gauges. Every metric can carry labels, e.g. stage="load" or ticker="AAPL".
+#
+#   with metrics.timer("stage", stage="clean"):           # time a block
+#   @metrics.timed("stage", stage="screen")               # time every call of a function
+#   metrics.increment("rows_loaded", 250, table="price")  # count something
+#   metrics.sleep(5, reason="yahoo_retry")                # sleep and count the time spent waiting
+#
+# write_run_report() writes the run as JSON and in the Prometheus text format (for node_exporter's textfile collector).
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+METRICS_DIR = BASE_DIR / "logs" / "metrics"
+PREFIX = "investassist"
+REPORTS_KEPT = 30 # JSON reports kept per run name, older ones are deleted
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_timers = {} # key -> [count, total seconds, max seconds]
+_started_at = datetime.now()
+
+
+def _key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def increment(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        timer_ = _timers.setdefault(key, [0, 0.0, 0.0])
+        timer_[0] += 1
+        timer_[1] += seconds
+        timer_[2] = max(timer_[2], seconds)
+
+
+@contextmanager
+def timer(name, **labels):
+    """Times the block, also when it raises (the error is counted as <name>_errors)."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment(f"{name}_errors", **labels)
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+    """Decorator version of timer()."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def sleep(seconds, **labels):
+    """time.sleep that records how long the run spent waiting, e.g. between retries."""
+    increment("sleep_seconds", seconds, **labels)
+    time.sleep(seconds)
+
+
+def reset():
+    global _started_at
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timers.clear()
+        _started_at = datetime.now()
+
+
+def snapshot():
+    """All metrics as a JSON friendly dict."""
+    def rows(metrics, value):
+        return [{"name": name, "labels": dict(labels), **value(v)} for (name, labels), v in sorted(metrics.items())]
+    with _lock:
+        return {
+            "started_at": _started_at.isoformat(timespec="seconds"),
+            "finished_at": datetime.now().isoformat(timespec="seconds"),
+            "counters": rows(_counters, lambda v: {"value": v}),
+            "gauges": rows(_gauges, lambda v: {"value": v}),
+            "timers": rows(_timers, lambda v: {"count": v[0], "seconds": round(v[1], 6), "max_seconds": round(v[2], 6)}),
+        }
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + "}"
+
+
+def prometheus_text():
+    lines = []
+
+    def family(metric, type_, samples):
+        lines.append(f"# TYPE {metric} {type_}")
+        lines.extend(f"{metric}{_prometheus_labels(labels)} {value}" for labels, value in samples)
+
+    with _lock:
+        counters, gauges, timers = dict(_counters), dict(_gauges), dict(_timers)
+    for name in sorted({name for name, _ in counters}):
+        family(f"{PREFIX}_{name}_total", "counter", [(l, v) for (n, l), v in sorted(counters.items()) if n == name])
+    for name in sorted({name for name, _ in gauges}):
+        family(f"{PREFIX}_{name}", "gauge", [(l, v) for (n, l), v in sorted(gauges.items()) if n == name])
+    for name in sorted({name for name, _ in timers}):
+        samples = [(l, v) for (n, l), v in sorted(timers.items()) if n == name]
+        lines.append(f"# TYPE {PREFIX}_{name}_seconds summary")
+        lines.extend(f"{PREFIX}_{name}_seconds_count{_prometheus_labels(l)} {v[0]}" for l, v in samples)
+        lines.extend(f"{PREFIX}_{name}_seconds_sum{_prometheus_labels(l)} {v[1]:.6f}" for l, v in samples)
+        family(f"{PREFIX}_{name}_seconds_max", "gauge", [(l, f"{v[2]:.6f}") for l, v in samples])
+    return "\n".join(lines) + "\n"
+
+
+def write_run_report(run_name="pipeline", metrics_dir=None):
+    """Writes logs/metrics/<run_name>_<timestamp>.json and refreshes investassist_<run_name>.prom. Only the last
+    REPORTS_KEPT JSON reports of the run name are kept. Returns the JSON path."""
+    metrics_dir = Path(metrics_dir or METRICS_DIR)
+    metrics_dir.mkdir(parents=True, exist_ok=True)
+    set_gauge("last_run_timestamp_seconds", int(time.time()), run=run_name)
+    report = {"run": run_name, **snapshot()}
+    report_path = metrics_dir / f"{run_name}_{datetime.now():%Y%m%d_%H%M%S}.json"
+    report_path.write_text(json.dumps(report, indent=2, default=str))
+    # the timestamp sorts by name, and the digit keeps e.g. "all" from matching the reports of "all_stages"
+    reports = sorted(metrics_dir.glob(f"{run_name}_[0-9]*.json"))
+    for old_report in reports[:-REPORTS_KEPT]:
+        old_report.unlink(missing_ok=True)
+
+    # write next to the file and swap it in, the textfile collector must never read half a file
+    prometheus_path = metrics_dir / f"{PREFIX}_{run_name}.prom"
+    tmp_path = prometheus_path.with_suffix(".tmp")
+    tmp_path.write_text(prometheus_text())
+    tmp_path.replace(prometheus_path)
+    logger.info(f"Run metrics written to {report_path} and {prometheus_path}")
+    return report_path
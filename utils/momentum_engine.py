@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+# Cross-sectional momentum on the close window of the whole universe: a ticker x bar array of every ticker's last
+# closes, right aligned like the indicator engine's panel (utils/indicator_engine.py), so the last column is each
+# ticker's latest bar.
+#
+# For every horizon the momentum of a ticker is its log return over the horizon divided by its volatility scaled
+# to the horizon (daily volatility x sqrt(bars)), so a steady climb beats an equally large but erratic one. Every
+# horizon's momentum is turned into a z-score across the universe and the z-scores are averaged with the
+# momentum_weights, which gives the momentum score. The score is ranked across the universe: score 100 is the
+# strongest ticker, rank 1 as well.
+#
+# All scores only need the last window_bars closes of a ticker, so the daily run keeps that window (see
+# scripts/etl_momentum.py) and appends the new bars to it instead of reading the price history again.
+
+HORIZONS = {"1m": 21, "3m": 63, "6m": 126, "12m": 252} # bars
+Z_LIMIT = 3 # z-scores are clipped, one outlier doesn't dominate the average
+
+
+def window_bars(vol_window, skip_bars):
+    """Closes needed for every score: the longest horizon plus the skipped bars, and one close before."""
+    return max(max(HORIZONS.values()) + skip_bars, vol_window) + 1
+
+
+def append_bars(closes, new_closes, counts):
+    """Appends new bars to the close window. new_closes is a right aligned ticker x bar array of the new bars with
+    the same rows as closes, counts the number of new bars of every row. Every row keeps its last closes.shape[1]
+    closes, rows without new bars are unchanged."""
+    n_bars, n_new = closes.shape[1], new_closes.shape[1]
+    combined = np.concatenate([closes, new_closes], axis=1)
+    # row i keeps its old closes from column counts[i] on, followed by its new bars, the last counts[i] columns
+    shifted = counts[:, None] + np.arange(n_bars)[None, :]
+    source = np.where(shifted < n_bars, shifted, n_new + np.arange(n_bars)[None, :])
+    return np.take_along_axis(combined, source, axis=1)
+
+
+def cross_sectional_z(values):
+    if np.isnan(values).all():
+        return values # no ticker has the horizon, nanstd would warn
+    with np.errstate(invalid="ignore"):
+        std = np.nanstd(values)
+        if not np.isfinite(std) or std == 0:
+            return np.where(np.isnan(values), np.nan, 0.0)
+        return np.clip((values - np.nanmean(values)) / std, -Z_LIMIT, Z_LIMIT)
+
+
+def momentum_scores(closes, vol_window, skip_bars=0, weights=None):
+    """Scores every row of the close window. Returns the simple return of every horizon (return_1m, ...), the
+    annualized volatility, the momentum score and its percentile (score, 0 - 100) and rank across the universe.
+    A horizon needs its full history, the volatility a full vol_window, tickers without them get NaN."""
+    weights = weights or {name: 1.0 for name in HORIZONS}
+    end = closes[:, -1 - skip_bars]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_returns = np.log(closes[:, -vol_window:] / closes[:, -vol_window - 1:-1])
+        volatility = np.std(log_returns, axis=1, ddof=1) # NaN unless the whole window has closes
+        volatility = np.where(volatility > 0, volatility, np.nan)
+
+        scores = {}
+        weighted, total_weight = np.zeros(len(closes)), np.zeros(len(closes))
+        for name, bars in HORIZONS.items():
+            log_return = np.log(end / closes[:, -1 - skip_bars - bars])
+            scores[f"return_{name}"] = np.expm1(log_return)
+            z = cross_sectional_z(log_return / (volatility * np.sqrt(bars)))
+            valid = ~np.isnan(z)
+            weighted += np.where(valid, z * weights.get(name, 0.0), 0.0)
+            total_weight += np.where(valid, weights.get(name, 0.0), 0.0)
+        momentum = np.where(total_weight > 0, weighted / total_weight, np.nan)
+
+    ranked = pd.Series(momentum)
+    scores["volatility"] = volatility * np.sqrt(252)
+    scores["momentum"] = momentum
+    scores["score"] = (ranked.rank(pct=True) * 100).to_numpy()
+    scores["rank"] = ranked.rank(ascending=False, method="min").astype("Int64").array
+    return scores
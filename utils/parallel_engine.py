@@ -0,0 +1,69 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from utils.indicator_engine import compute_indicators
+
+# Runs compute_indicators on several cores. The close panel and the result panels are allocated in shared memory
+# and every worker process computes a contiguous block of ticker rows in place, so no dataframe or array is pickled,
+# only the names of the shared blocks and the row range. Every indicator of a ticker only depends on the ticker's own
+# row, so the blocks give exactly the same numbers as the single process engine.
+
+INDICATOR_NAMES = ("sma_5", "sma_10", "rsi")
+
+
+def worker_count(workers):
+    """0 means one worker per available core."""
+    if workers == 0:
+        return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    return max(1, workers)
+
+
+def shared_array(shape, blocks):
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * 8))
+    blocks.append(block)
+    return np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+
+
+def compute_block(names, shape, start, end, rsi_window, short_sma_window, long_sma_window):
+    """Worker side: attaches to the shared panels and writes the indicators of rows start:end."""
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    arrays = []
+    try:
+        arrays.extend(np.ndarray(shape, dtype=np.float64, buffer=block.buf) for block in blocks)
+        indicators = compute_indicators({"close_price": arrays[0][start:end]}, rsi_window, short_sma_window, long_sma_window)
+        for i, name in enumerate(INDICATOR_NAMES, start=1):
+            arrays[i][start:end] = indicators[name]
+    finally:
+        arrays.clear()
+        for block in blocks:
+            block.close()
+    return end - start
+
+
+def compute_indicators_parallel(panel, rsi_window, short_sma_window, long_sma_window, workers):
+    """Same result as indicator_engine.compute_indicators, computed by `workers` processes."""
+    workers = min(worker_count(workers), len(panel["tickers"]))
+    if workers <= 1:
+        return compute_indicators(panel, rsi_window, short_sma_window, long_sma_window)
+
+    shape = panel["close_price"].shape
+    blocks, arrays = [], {}
+    try:
+        for name in ("close_price",) + INDICATOR_NAMES:
+            arrays[name] = shared_array(shape, blocks)
+        arrays["close_price"][:] = panel["close_price"]
+        names = [block.name for block in blocks]
+        bounds = np.linspace(0, shape[0], workers + 1).astype(int)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(compute_block, names, shape, start, end, rsi_window, short_sma_window, long_sma_window)
+                       for start, end in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+        # copy out of the shared blocks, they are released below
+        return {name: arrays[name].copy() for name in INDICATOR_NAMES}
+    finally:
+        arrays.clear() # a block can't be closed while an array still points into it
+        for block in blocks:
+            block.close()
+            block.unlink()
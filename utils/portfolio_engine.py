@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+# Turns the transaction log into positions. Cost basis follows the average cost method: a buy adds what was paid
+# (quantity x price plus the fee), a sell releases the sold share of the cost basis and realizes the proceeds
+# minus that share. Amounts are in the asset's own currency like the closes, the fee is added as it is.
+#
+# The average cost after a sell is cost_before * held_after / held_before, a recurrence. Written with the running
+# product P of those ratios it becomes cost_t = P_t * cumsum(added_s / P_s), so every asset is computed with
+# cumulative sums and products only. A full sell sets P to 0, so the products restart after every closed position.
+
+STATE_COLUMNS = ["asset_id", "date", "quantity", "cost_basis", "realized_pnl", "transactions"]
+
+
+def transaction_states(transactions):
+    """Takes (asset_id, date, quantity, price, fee) ordered by asset and time and returns the position after every
+    transaction: quantity held, cost basis, realized P&L so far and the number of transactions applied."""
+    if transactions.empty:
+        return pd.DataFrame(columns=STATE_COLUMNS)
+    asset = transactions["asset_id"]
+    quantity = transactions["quantity"].to_numpy(dtype=float)
+    price = transactions["price"].to_numpy(dtype=float)
+    fee = transactions["fee"].fillna(0).to_numpy(dtype=float)
+
+    held = pd.Series(quantity).groupby(asset.to_numpy()).cumsum().to_numpy()
+    held_before = held - quantity
+    buy = quantity > 0
+    added = np.where(buy, quantity * price + fee, 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(buy | (held_before == 0), 1.0, held / held_before)
+
+    # a new run of products starts after every transaction that closed the position
+    closed = pd.Series(held == 0).groupby(asset.to_numpy()).shift(fill_value=False)
+    run = closed.groupby(asset.to_numpy()).cumsum().to_numpy()
+    keys = [asset.to_numpy(), run]
+    product = pd.Series(ratio).groupby(keys).cumprod().to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scaled = np.where(product > 0, added / product, 0.0)
+    cost = np.where(held == 0, 0.0, product * pd.Series(scaled).groupby(keys).cumsum().to_numpy())
+
+    cost_before = pd.Series(cost).groupby(asset.to_numpy()).shift(fill_value=0.0).to_numpy()
+    realized = np.where(buy, 0.0, -quantity * price - fee - (cost_before - cost))
+    return pd.DataFrame({
+        "asset_id": asset.to_numpy(),
+        "date": pd.to_datetime(transactions["date"]).to_numpy(),
+        "quantity": held,
+        "cost_basis": cost,
+        "realized_pnl": pd.Series(realized).groupby(asset.to_numpy()).cumsum().to_numpy(),
+        "transactions": pd.Series(1, index=transactions.index).groupby(asset.to_numpy()).cumsum().to_numpy(),
+    })
+
+
+def daily_positions(states, closes):
+    """Joins every close (asset_id, date, close_price) to the position held at the end of that day and values it."""
+    closes = closes.assign(date=pd.to_datetime(closes["date"])).sort_values("date", kind="stable")
+    states = states.assign(date=pd.to_datetime(states["date"])).sort_values("date", kind="stable")
+    positions = pd.merge_asof(closes, states, on="date", by="asset_id", direction="backward")
+    positions = positions.dropna(subset=["transactions"]) # days before the first transaction
+    positions = positions.astype({"quantity": "int64", "transactions": "int64"})
+    positions["market_value"] = positions["quantity"] * positions["close_price"]
+    positions["unrealized_pnl"] = positions["market_value"] - positions["cost_basis"]
+    return positions.sort_values(["asset_id", "date"], ignore_index=True)
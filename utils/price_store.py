@@ -0,0 +1,100 @@
+import os
+from datetime import date
+from pathlib import Path
+from urllib.parse import quote
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+from utils.logging_config import logger
+
+# Local columnar copy of the price table, so indicators can be computed without a database connection.
+# Prices are stored as Parquet files partitioned by ticker and year:
+#   data/price_store/yahoo_ticker=<ticker>/year=<year>/part.parquet
+# Reads prune partitions (ticker, year), row groups (date) and columns, and go through memory mapped files.
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+STORE_DIR = BASE_DIR / "data" / "price_store"
+
+PRICE_COLUMNS = ["date", "close_price", "open_price", "high_price", "low_price", "volume"]
+SCHEMA = pa.schema([
+    ("date", pa.date32()),
+    ("close_price", pa.float64()),
+    ("open_price", pa.float64()),
+    ("high_price", pa.float64()),
+    ("low_price", pa.float64()),
+    ("volume", pa.int64()),
+])
+PARTITIONING = ds.partitioning(pa.schema([("yahoo_ticker", pa.string()), ("year", pa.int32())]), flavor="hive")
+
+
+def partition_path(store_dir, ticker, year):
+    # tickers like EURUSD=X or ^GSPC aren't safe in a path, hive partitioning url-decodes them again on read
+    return store_dir / f"yahoo_ticker={quote(ticker, safe='')}" / f"year={year}" / "part.parquet"
+
+
+def write_prices(prices, store_dir=None):
+    """Merges a long price dataframe (yahoo_ticker + PRICE_COLUMNS) into the store. Only the (ticker, year)
+    partitions present in the dataframe are rewritten, and rows for an existing date replace the stored ones."""
+    store_dir = Path(store_dir or STORE_DIR)
+    if prices.empty:
+        return 0
+    prices = prices.assign(date=pd.to_datetime(prices["date"]))
+    written = 0
+    for (ticker, year), new_rows in prices.groupby(["yahoo_ticker", prices["date"].dt.year]):
+        path = partition_path(store_dir, ticker, year)
+        rows = new_rows[PRICE_COLUMNS].assign(date=new_rows["date"].dt.date)
+        if path.exists():
+            stored = pq.read_table(path, memory_map=True).to_pandas()
+            rows = pd.concat([stored, rows], ignore_index=True).drop_duplicates("date", keep="last")
+        table = pa.Table.from_pandas(rows.sort_values("date"), schema=SCHEMA, preserve_index=False)
+
+        # write next to the partition and swap it in, so a reader never sees a half written file
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+        written += len(new_rows)
+    logger.info(f"Wrote {written} price rows to the local price store")
+    return written
+
+
+def read_prices(tickers=None, start=None, end=None, columns=("close_price",), store_dir=None):
+    """Reads a long dataframe (yahoo_ticker, date, <columns>) from the store. Only the partitions of the requested
+    tickers and years, and only the requested columns, are read."""
+    store_dir = Path(store_dir or STORE_DIR)
+    if not store_dir.exists():
+        return pd.DataFrame(columns=["yahoo_ticker", "date", *columns])
+    dataset = ds.dataset(str(store_dir), format="parquet", partitioning=PARTITIONING,
+                         filesystem=pafs.LocalFileSystem(use_mmap=True))
+    condition = None
+    conditions = []
+    if tickers is not None:
+        conditions.append(pc.field("yahoo_ticker").isin(list(tickers)))
+    if start is not None:
+        conditions.append(pc.field("year") >= start.year)
+        conditions.append(pc.field("date") >= pa.scalar(start, pa.date32()))
+    if end is not None:
+        conditions.append(pc.field("year") <= end.year)
+        conditions.append(pc.field("date") <= pa.scalar(end, pa.date32()))
+    for expression in conditions:
+        condition = expression if condition is None else condition & expression
+    table = dataset.to_table(columns=["yahoo_ticker", "date", *columns], filter=condition)
+    prices = table.to_pandas()
+    prices["date"] = pd.to_datetime(prices["date"])
+    return prices.sort_values(["yahoo_ticker", "date"], ignore_index=True)
+
+
+def read_recent_prices(tickers, bars, columns=("close_price",), store_dir=None):
+    """The last `bars` rows of every ticker. Reads the current and previous year first and only goes back
+    further for tickers that don't have enough bars in those."""
+    this_year = date.today().year
+    prices = read_prices(tickers, start=date(this_year - 1, 1, 1), columns=columns, store_dir=store_dir)
+    counts = prices["yahoo_ticker"].value_counts()
+    short = [ticker for ticker in tickers if counts.get(ticker, 0) < bars]
+    if short:
+        older = read_prices(short, end=date(this_year - 2, 12, 31), columns=columns, store_dir=store_dir)
+        prices = pd.concat([older, prices], ignore_index=True).sort_values(["yahoo_ticker", "date"], ignore_index=True)
+    return prices.groupby("yahoo_ticker").tail(bars).reset_index(drop=True)
@@ -0,0 +1,271 @@
+import random
+import threading
+import time
+from collections import Counter
+from utils.config_loader import CONSTANTS
+from utils import metrics
+from utils.logging_config import logger
+
+# Request scheduling for the market data sources. Every request to a source goes through its Scheduler, which
+#   - takes a token from the source's bucket and from the bucket of the ticker's exchange (token buckets refill at
+#     a steady rate and allow short bursts),
+#   - waits for a free slot under the adaptive concurrency limit,
+#   - fails fast while the source's circuit breaker is open, after too many failures in a row,
+#   - retries failed requests with exponential backoff and full jitter.
+# Rates and concurrency follow AIMD: they grow a little after every success and are halved when the source
+# throttles (HTTP 429 / "Too Many Requests") or answers slower than the target latency, so the scheduler keeps
+# probing just below the provider's limit instead of running into it.
+# All waiting is counted as sleep_seconds{reason=rate_limit|concurrency|backoff, source=...} in the run metrics.
+
+THROTTLE_MARKERS = ("too many requests", "rate limit", "429")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_throttled(error):
+    return type(error).__name__ == "YFRateLimitError" or any(marker in str(error).lower() for marker in THROTTLE_MARKERS)
+
+
+def backoff_delay(attempt, base, cap):
+    """Exponential backoff with full jitter: a random delay between 0 and min(cap, base * 2^attempt)."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    def __init__(self, name, rate, burst, min_rate):
+        self.name = name
+        self.max_rate = self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, source, tokens=1):
+        """Takes tokens, sleeping until they are available. Returns the seconds waited. More tokens than the burst
+        (a batch request for many tickers) are taken once a full burst is available and leave the bucket in debt."""
+        waited = 0.0
+        needed = min(tokens, self.burst)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return waited
+                wait = (needed - self.tokens) / self.rate
+            metrics.sleep(wait, reason="rate_limit", source=source)
+            waited += wait
+
+    def increase(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def decrease(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0) # the burst is gone too
+
+
+class AdaptiveLimit:
+    """A semaphore whose size moves between 1 and maximum."""
+
+    def __init__(self, maximum):
+        self.maximum = self.limit = maximum
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, source):
+        start = time.perf_counter()
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        waited = time.perf_counter() - start
+        if waited > 0.001:
+            metrics.increment("sleep_seconds", waited, reason="concurrency", source=source)
+        return waited
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def increase(self):
+        with self.condition:
+            self.limit = min(self.maximum, self.limit + 1)
+            self.condition.notify()
+
+    def decrease(self):
+        with self.condition:
+            self.limit = max(1, self.limit // 2)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def check(self, source):
+        """Raises CircuitOpenError while open. After reset_seconds one request is let through to probe the source."""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                raise CircuitOpenError(f"{source} circuit is open after {self.failures} failures in a row")
+            self.opened_at = time.monotonic() # half open: this request probes, the others keep failing fast
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self, source):
+        with self.lock:
+            self.failures += 1
+            if self.failures == self.failure_threshold:
+                logger.warning(f"Opening the {source} circuit after {self.failures} failures in a row")
+                metrics.increment("circuit_opened", source=source)
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic() # also when the probe of a half open circuit failed
+
+
+class Scheduler:
+    def __init__(self, source, rate, burst, exchange_rate, exchange_burst, max_concurrency, target_latency,
+                 failure_threshold, reset_seconds, backoff_base, backoff_cap):
+        self.source = source
+        self.bucket = TokenBucket(source, rate, burst, min_rate=rate / 50)
+        self.exchange_rate = exchange_rate
+        self.exchange_burst = exchange_burst
+        self.exchange_buckets = {}
+        self.concurrency = AdaptiveLimit(max_concurrency)
+        self.breaker = CircuitBreaker(failure_threshold, reset_seconds)
+        self.target_latency = target_latency
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.lock = threading.Lock()
+        self.waited = {"rate_limit": 0.0, "concurrency": 0.0, "backoff": 0.0}
+
+    def exchange_bucket(self, exchange):
+        with self.lock:
+            if exchange not in self.exchange_buckets:
+                self.exchange_buckets[exchange] = TokenBucket(f"{self.source}{exchange}", self.exchange_rate,
+                                                              self.exchange_burst, min_rate=self.exchange_rate / 50)
+            return self.exchange_buckets[exchange]
+
+    def add_wait(self, reason, seconds):
+        with self.lock:
+            self.waited[reason] += seconds
+
+    def request(self, function, *args, exchanges=(), **kwargs):
+        """Runs one request under the rate limits and the concurrency limit, without retrying. exchanges has the
+        exchange of every ticker in the request, one token per ticker is taken. Raises CircuitOpenError instead of
+        calling the source while its circuit is open."""
+        self.breaker.check(self.source)
+        counts = Counter(exchanges)
+        waited = self.bucket.acquire(self.source, max(1, len(exchanges)))
+        for exchange in sorted(counts):
+            waited += self.exchange_bucket(exchange).acquire(self.source, counts[exchange])
+        self.add_wait("rate_limit", waited)
+        self.add_wait("concurrency", self.concurrency.acquire(self.source))
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            self.failed(e, exchanges)
+            raise
+        finally:
+            self.concurrency.release()
+        self.succeeded(time.perf_counter() - start, exchanges)
+        return result
+
+    def call(self, function, *args, exchanges=(), max_retries=3, **kwargs):
+        """request() with up to max_retries attempts. Throttled attempts back off at least twice as long."""
+        for attempt in range(max_retries):
+            try:
+                return self.request(function, *args, exchanges=exchanges, **kwargs)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                if attempt == max_retries - 1:
+                    raise
+                delay = backoff_delay(attempt + (1 if is_throttled(e) else 0), self.backoff_base, self.backoff_cap)
+                logger.info(f"{self.source} request failed ({e}), retrying in {delay:.1f}s")
+                metrics.increment("retries", source=self.source)
+                self.backoff(delay)
+
+    def backoff(self, delay):
+        metrics.sleep(delay, reason="backoff", source=self.source)
+        self.add_wait("backoff", delay)
+
+    def succeeded(self, latency, exchanges=()):
+        metrics.observe("request_latency", latency, source=self.source)
+        self.breaker.success()
+        if latency > self.target_latency:
+            self.concurrency.decrease()
+            return
+        self.bucket.increase()
+        for exchange in set(exchanges):
+            self.exchange_bucket(exchange).increase()
+        self.concurrency.increase()
+
+    def failed(self, error, exchanges=()):
+        """Records a failed request. A throttled request halves the rates and the concurrency."""
+        self.breaker.failure(self.source)
+        if is_throttled(error):
+            self.throttled(exchanges)
+
+    def throttled(self, exchanges=()):
+        metrics.increment("throttled", source=self.source)
+        self.bucket.decrease()
+        for exchange in set(exchanges):
+            self.exchange_bucket(exchange).decrease()
+        self.concurrency.decrease()
+        logger.warning(f"{self.source} is throttling, rate down to {self.bucket.rate:.2f}/s, "
+                       f"concurrency {self.concurrency.limit}")
+
+    def report(self):
+        """Logs the time spent waiting and the rate and concurrency the scheduler settled on."""
+        with self.lock:
+            waited = dict(self.waited)
+        metrics.set_gauge("request_rate", round(self.bucket.rate, 3), source=self.source)
+        metrics.set_gauge("request_concurrency", self.concurrency.limit, source=self.source)
+        logger.info(f"{self.source} scheduler: waited {waited['rate_limit']:.1f}s for rate limits, "
+                    f"{waited['concurrency']:.1f}s for a free slot, {waited['backoff']:.1f}s backing off. "
+                    f"Rate {self.bucket.rate:.2f}/s, concurrency {self.concurrency.limit}")
+        return waited
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def scheduler(source):
+    """The process wide scheduler of a source, configured from the rate_limit_* keys in constants.json."""
+    with _schedulers_lock:
+        if source not in _schedulers:
+            _schedulers[source] = Scheduler(
+                source,
+                rate=CONSTANTS.get(f"rate_limit_{source}_per_second", 10),
+                burst=CONSTANTS.get(f"rate_limit_{source}_burst", 50),
+                exchange_rate=CONSTANTS.get("rate_limit_exchange_per_second", 5),
+                exchange_burst=CONSTANTS.get("rate_limit_exchange_burst", 25),
+                max_concurrency=CONSTANTS.get("download_workers", 4),
+                target_latency=CONSTANTS.get("rate_limit_target_latency", 10),
+                failure_threshold=CONSTANTS.get("circuit_failure_threshold", 5),
+                reset_seconds=CONSTANTS.get("circuit_reset_seconds", 120),
+                backoff_base=CONSTANTS.get("download_retry_delay", 5),
+                backoff_cap=CONSTANTS.get("backoff_max_seconds", 120),
+            )
+        return _schedulers[source]
+
+
+def exchange_of(ticker):
+    """The exchange suffix of a Yahoo ticker, '' for US listings (AAPL, but also ^GSPC or EURUSD=X)."""
+    return ticker[ticker.rindex("."):] if "." in ticker else ""
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import time
+from datetime import date
+from pathlib import Path
+import pandas as pd
+from utils import metrics
+from utils.logging_config import logger
+
+# On-disk cache of the raw dataframes downloaded from Yahoo, so a rerun (after a failed load, or a retried
+# extraction) reads the tickers it already downloaded today from disk instead of the network.
+#
+# Every entry is one ticker's response stored as data/cache/yahoo/<sha256 of the request>.parquet. The request
+# is the ticker, the interval and the date range, with relative ranges (period='3mo', or a start without an end)
+# pinned to today's date, because tomorrow the same request returns another range.
+# An entry's mtime is when it was downloaded and decides if it is still fresh: end-of-day data is kept for
+# ttl_eod seconds, intraday bars for ttl_intraday. Its atime is when it was last read and decides which entries
+# are evicted first once the cache is bigger than its size cap.
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+CACHE_DIR = BASE_DIR / "data" / "cache" / "yahoo"
+EOD_INTERVALS = ("1d", "5d", "1wk", "1mo", "3mo")
+
+_stats = {"hit": 0, "miss": 0, "expired": 0}
+
+
+def request_key(ticker, window, today=None):
+    request = {
+        "ticker": ticker,
+        "interval": window.get("interval", "1d"),
+        "period": window.get("period"),
+        "start": window.get("start"),
+        "end": window.get("end") or (today or date.today()).isoformat(),
+    }
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+
+def ttl_seconds(window, ttl_eod, ttl_intraday):
+    return ttl_eod if window.get("interval", "1d") in EOD_INTERVALS else ttl_intraday
+
+
+def entry_path(cache_dir, ticker, window):
+    return Path(cache_dir or CACHE_DIR) / f"{request_key(ticker, window)}.parquet"
+
+
+def get(ticker, window, ttl_eod, ttl_intraday, cache_dir=None):
+    """The cached response of the request, or None if it isn't cached or has expired."""
+    path = entry_path(cache_dir, ticker, window)
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return record("miss")
+    if time.time() - stat.st_mtime > ttl_seconds(window, ttl_eod, ttl_intraday):
+        path.unlink(missing_ok=True)
+        return record("expired")
+    try:
+        raw_df = pd.read_parquet(path)
+    except Exception as e:
+        logger.warning(f"Unreadable cache entry for {ticker}, downloading it again: {e}")
+        path.unlink(missing_ok=True)
+        return record("miss")
+    os.utime(path, (time.time(), stat.st_mtime)) # mark as recently used, keep the download time
+    record("hit")
+    return raw_df
+
+
+def record(result):
+    _stats[result] += 1
+    metrics.increment("cache_requests", cache="yahoo", result=result)
+    return None
+
+
+def put(ticker, window, raw_df, cache_dir=None):
+    """Stores a response. Failing to cache is only logged, the download itself succeeded."""
+    path = entry_path(cache_dir, ticker, window)
+    # write next to the entry and swap it in, a concurrent reader never sees half a file
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        raw_df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.warning(f"Failed to cache the response for {ticker}: {e}")
+        tmp_path.unlink(missing_ok=True)
+
+
+def evict(max_bytes, cache_dir=None):
+    """Deletes the least recently used entries until the cache fits in max_bytes. Returns the number deleted."""
+    cache_dir = Path(cache_dir or CACHE_DIR)
+    if not cache_dir.exists():
+        return 0
+    entries = []
+    for path in cache_dir.glob("*.parquet"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_atime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+        evicted += 1
+    if evicted:
+        metrics.increment("cache_evictions", evicted, cache="yahoo")
+        logger.info(f"Evicted {evicted} entries from the yahoo cache")
+    metrics.set_gauge("cache_bytes", total, cache="yahoo")
+    return evicted
+
+
+def stats():
+    """Hits, misses and expired entries of this process, and the hit ratio."""
+    requests = sum(_stats.values())
+    return {**_stats, "hit_ratio": round(_stats["hit"] / requests, 3) if requests else None}
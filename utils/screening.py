@@ -0,0 +1,134 @@
+import ast
+import operator
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+# Screening rules are expressions over the indicator columns, e.g. "rsi < rsi_oversold and sma_5 > sma_10".
+# Every expression is parsed once into a tree of numpy operations that evaluates the whole universe at a time,
+# one boolean mask per rule. Sub-expressions shared by several rules ("rsi < rsi_oversold") are evaluated only once
+# per screening pass.
+#
+# Names in an expression are either indicator columns or parameters. Parameters have a default value and can be
+# overridden per ticker, e.g. a lower oversold threshold for a volatile stock, which turns the parameter into one
+# value per ticker.
+
+COMPARISONS = {
+    ast.Lt: np.less, ast.LtE: np.less_equal, ast.Gt: np.greater, ast.GtE: np.greater_equal,
+    ast.Eq: np.equal, ast.NotEq: np.not_equal,
+}
+ARITHMETIC = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv}
+FUNCTIONS = {"abs": np.abs}
+HIT_COLUMNS = ["date", "yahoo_ticker", "rule", "value"]
+
+
+def compile_node(node, expression):
+    """Returns (key, evaluate) for an expression node. evaluate(names, memo) computes the node over the whole
+    universe, memo holds the results of the pass so far by key."""
+    key = ast.dump(node)
+
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        value = float(node.value)
+        return key, lambda names, memo: value
+
+    if isinstance(node, ast.Name):
+        name = node.id
+
+        def evaluate(names, memo):
+            if name not in names:
+                raise ValueError(f"Unknown name {name} in rule {expression!r}, expected one of {sorted(names)}")
+            return names[name]
+        return key, evaluate
+
+    if isinstance(node, ast.BoolOp):
+        combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+        parts = [compile_node(value, expression) for value in node.values]
+        return key, memoized(key, lambda names, memo: combine.reduce([run(part, names, memo) for part in parts]))
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.USub)):
+        part = compile_node(node.operand, expression)
+        apply = np.logical_not if isinstance(node.op, ast.Not) else np.negative
+        return key, memoized(key, lambda names, memo: apply(run(part, names, memo)))
+
+    if isinstance(node, ast.Compare) and all(type(op) in COMPARISONS for op in node.ops):
+        # a < b < c is a < b and b < c
+        operands = [compile_node(operand, expression) for operand in [node.left, *node.comparators]]
+        compares = [COMPARISONS[type(op)] for op in node.ops]
+
+        def evaluate(names, memo):
+            values = [run(operand, names, memo) for operand in operands]
+            masks = [compare(values[i], values[i + 1]) for i, compare in enumerate(compares)]
+            return np.logical_and.reduce(masks) if len(masks) > 1 else masks[0]
+        return key, memoized(key, evaluate)
+
+    if isinstance(node, ast.BinOp) and type(node.op) in ARITHMETIC:
+        left, right, apply = compile_node(node.left, expression), compile_node(node.right, expression), ARITHMETIC[type(node.op)]
+        return key, memoized(key, lambda names, memo: apply(run(left, names, memo), run(right, names, memo)))
+
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS \
+            and len(node.args) == 1 and not node.keywords:
+        part, apply = compile_node(node.args[0], expression), FUNCTIONS[node.func.id]
+        return key, memoized(key, lambda names, memo: apply(run(part, names, memo)))
+
+    raise ValueError(f"Unsupported syntax {ast.unparse(node)!r} in rule {expression!r}")
+
+
+def memoized(key, evaluate):
+    def cached(names, memo):
+        if key not in memo:
+            memo[key] = evaluate(names, memo)
+        return memo[key]
+    return cached
+
+
+def run(compiled, names, memo):
+    return compiled[1](names, memo)
+
+
+@lru_cache(maxsize=None)
+def compile_rule(expression):
+    """Parses a rule expression once. Raises ValueError for anything but comparisons, and/or/not, arithmetic,
+    abs(), numbers and names."""
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Can't parse rule {expression!r}: {e}") from e
+    return compile_node(tree.body, expression)
+
+
+def parameter_values(tickers, parameters, overrides):
+    """One value per parameter, or one value per ticker for parameters that are overridden for some tickers."""
+    values = {name: float(value) for name, value in parameters.items()}
+    for ticker, ticker_parameters in (overrides or {}).items():
+        for name, value in ticker_parameters.items():
+            if name not in parameters:
+                raise ValueError(f"Override of unknown parameter {name} for {ticker}")
+            if np.ndim(values[name]) == 0:
+                values[name] = np.full(len(tickers), values[name])
+            values[name][tickers == ticker] = float(value)
+    return values
+
+
+def screen(indicators, rules, parameters=None, overrides=None):
+    """Evaluates every rule over every ticker of the indicators frame in one pass and returns the hit table:
+    one row (date, yahoo_ticker, rule, value) per ticker matching a rule. value is the rule's `show` column
+    (e.g. the RSI for an RSI rule), NaN for rules that don't show one."""
+    if indicators.empty or not rules:
+        return pd.DataFrame(columns=HIT_COLUMNS)
+    tickers = indicators["yahoo_ticker"].to_numpy()
+    names = {column: pd.to_numeric(indicators[column], errors="coerce").to_numpy(dtype=float)
+             for column in indicators.columns if column not in ("date", "yahoo_ticker")}
+    names.update(parameter_values(tickers, parameters or {}, overrides))
+    memo = {}
+    hits = []
+    for rule in rules:
+        mask = np.broadcast_to(run(compile_rule(rule["expression"]), names, memo), tickers.shape)
+        rows = np.flatnonzero(mask)
+        if len(rows):
+            hits.append(pd.DataFrame({
+                "date": indicators["date"].to_numpy()[rows],
+                "yahoo_ticker": tickers[rows],
+                "rule": rule["name"],
+                "value": names[rule["show"]][rows] if rule.get("show") else np.nan,
+            }))
+    return pd.concat(hits, ignore_index=True) if hits else pd.DataFrame(columns=HIT_COLUMNS)